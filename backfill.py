@@ -0,0 +1,412 @@
+import argparse
+import calendar
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import frames
+import palettes
+import pipeline
+import rain_grid
+
+# Reprocess archived station images into published frames.
+#
+# Work items are (station, slot) pairs found under --input_dir; all images
+# of one slot make one frame. Each frame is processed in memory by one pool
+# worker, from decoding through tiles, and published into --radar_dir with
+# the same layout and manifest as the live pipeline. Finished frames are
+# appended to a checkpoint log, so a rerun after a crash only does what is
+# left.
+CHECKPOINT_NAME = "backfill.jsonl"
+# frames are staged under their own prefix so a live cycle publishing the
+# same slot never shares a staging directory with the backfill
+STAGING_PREFIX = ".backfill-"
+# manifest entries are written in batches; the checkpoint log covers the gap
+MANIFEST_BATCH = 100
+IMAGE_SUFFIXES = (".png", ".gif", ".jpg", ".jpeg")
+# radar_20240131_0750.png, phs240_202401310750.png, ...
+STAMP_PATTERN = re.compile(r"(?<!\d)(\d{4})(\d{2})(\d{2})[_-]?(\d{2})(\d{2})(?!\d)")
+
+
+def parse_time(name, utc_offset=0.0):
+    """
+    Unix time named by a file or directory: a 10-digit Unix timestamp, or a
+    ``YYYYMMDD[_]HHMM`` stamp in local time ``utc_offset`` hours from UTC.
+    None if the name carries no time.
+    """
+    stem = name.split(".")[0]
+    if stem.isdigit() and len(stem) == 10:
+        return int(stem)
+    m = STAMP_PATTERN.search(name)
+    if m is None:
+        return None
+    year, month, day, hour, minute = (int(v) for v in m.groups())
+    try:
+        local = calendar.timegm((year, month, day, hour, minute, 0))
+    except ValueError:
+        return None
+    return int(local - utc_offset * 3600)
+
+
+def station_patterns(station):
+    # names an archived image of the station may start with: the file name
+    # of its live URL, its template's name (phs240) and the station name
+    url_name = os.path.basename(urlparse(station["input"]).path)
+    prefixes = [Path(url_name).stem, Path(station["template"]).stem, station["name"]]
+    return [p.lower() for p in prefixes if p]
+
+
+def match_station(filename, stations):
+    """The station an archived image belongs to, or None."""
+    name = filename.lower()
+    best = None
+    for station in stations:
+        for prefix in station_patterns(station):
+            rest = name[len(prefix) :]
+            if name.startswith(prefix) and not rest[:1].isalpha():
+                if best is None or len(prefix) > best[0]:
+                    best = (len(prefix), station)
+    return None if best is None else best[1]
+
+
+def discover(input_dir, stations, interval=pipeline.CYCLE_SECONDS, utc_offset=0.0):
+    """
+    ``{slot: {station name: path}}`` of the images under ``input_dir``. An
+    image's time comes from its file name or, failing that, from the
+    nearest parent directory named by a time; it is filed under the start
+    of its ``interval`` slot. When a station has several images in one slot
+    the latest wins. Returns ``(work, skipped)``, skipped being paths that
+    match no station or carry no time.
+    """
+    input_dir = Path(input_dir)
+    work = {}
+    latest = {}
+    skipped = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if not filename.lower().endswith(IMAGE_SUFFIXES):
+                continue
+            path = Path(root) / filename
+            station = match_station(filename, stations)
+            when = parse_time(filename, utc_offset)
+            parent = path.parent
+            while when is None and parent != input_dir and input_dir in parent.parents:
+                when = parse_time(parent.name, utc_offset)
+                parent = parent.parent
+            if station is None or when is None:
+                skipped.append(path)
+                continue
+            slot = pipeline.cycle_timestamp(when, interval)
+            key = (slot, station["name"])
+            if key not in latest or when >= latest[key]:
+                latest[key] = when
+                work.setdefault(slot, {})[station["name"]] = str(path)
+    return work, skipped
+
+
+def read_checkpoint(path):
+    """``{slot: record}`` of the frames a checkpoint log marks as done."""
+    done = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                if "entry" in record:
+                    done[record["time"]] = record
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def open_checkpoint(path):
+    f = open(path, "a+", encoding="utf-8")
+    # end a line left unfinished by a crash so the next record starts clean
+    if f.tell():
+        f.seek(f.tell() - 1)
+        if f.read(1) != "\n":
+            f.write("\n")
+    return f
+
+
+def append_checkpoint(f, record):
+    f.write(json.dumps(record) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def backfill_frame(task):
+    """
+    Process and publish one frame in a pool worker. Never raises: returns
+    a record with the manifest ``entry``, or with ``error`` if no station
+    of the slot could be processed.
+    """
+    import radar_process as rp
+
+    slot, items, opts = task
+    started = time.monotonic()
+    record = {"time": slot, "inputs": items, "errors": {}}
+    georefs = []
+    for station in opts["stations"]:
+        path = items.get(station["name"])
+        if path is None:
+            continue
+        try:
+            if opts["levels"] and not station["legend"]:
+                raise ValueError("no legend to decode levels with (see calibrate.py)")
+            georefs.append(
+                rp.render_station(
+                    path,
+                    station["template"],
+                    mask=station["mask"],
+                    gaps=station["gaps"],
+                    style=station["style"],
+                    heatmap=station["heatmap"],
+                    legend=station["legend"] if opts["levels"] else None,
+                    cache_dir=opts["cache_dir"],
+                )
+            )
+        except Exception as e:
+            record["errors"][station["name"]] = f"{type(e).__name__}: {e}"
+    if not georefs:
+        record["error"] = "no station processed successfully"
+        record["seconds"] = time.monotonic() - started
+        return record
+
+    staging = Path(opts["radar_dir"]) / f"{STAGING_PREFIX}{slot}"
+    try:
+        shutil.rmtree(staging, ignore_errors=True)
+        mosaic, transform = rp.mosaic_stations(
+            georefs, cache_dir=opts["cache_dir"], rule=opts["composite"]
+        )
+        del georefs
+        tiles = rp.build_tile_pyramid(
+            mosaic,
+            transform,
+            staging,
+            zmin=opts["zmin"],
+            zmax=opts["zmax"],
+            resampling=opts["resampling"],
+            workers=opts["tile_threads"],
+            tile_format=opts["tile_format"],
+            encodings=opts["encodings"],
+            palette=opts["palette"],
+        )
+        rain_grid.write_grid(staging, rp.rain_levels(mosaic), transform)
+        del mosaic
+        pipeline.publish_frame(staging, opts["radar_dir"], slot)
+    except Exception as e:
+        shutil.rmtree(staging, ignore_errors=True)
+        record["error"] = f"{type(e).__name__}: {e}"
+        record["seconds"] = time.monotonic() - started
+        return record
+
+    used = [s["name"] for s in opts["stations"] if s["name"] in items]
+    used = [name for name in used if name not in record["errors"]]
+    record["entry"] = pipeline.frame_entry(
+        slot,
+        used,
+        tiles,
+        opts["tile_format"],
+        opts["encodings"],
+        opts["zmin"],
+        opts["zmax"],
+        levels=opts["levels"],
+    )
+    record["seconds"] = time.monotonic() - started
+    return record
+
+
+def run_backfill(args):
+    # like the live pipeline, leave out disabled stations unless named
+    stations = pipeline.load_stations(args.config, include_disabled=bool(args.stations))
+    if args.stations:
+        stations = [s for s in stations if s["name"] in args.stations]
+    work, skipped = discover(args.input_dir, stations, args.interval, args.utc_offset)
+    if args.start is not None:
+        work = {t: v for t, v in work.items() if t >= args.start}
+    if args.end is not None:
+        work = {t: v for t, v in work.items() if t <= args.end}
+
+    checkpoint = Path(args.checkpoint or Path(args.cache_dir) / CHECKPOINT_NAME)
+    done = {} if args.force else read_checkpoint(checkpoint)
+    # frames finished before a crash may be missing from the manifest
+    listed = {f["time"] for f in frames.read_manifest(args.radar_dir) or []}
+    missing = [r["entry"] for t, r in sorted(done.items()) if t not in listed]
+    missing = [e for e in missing if (Path(args.radar_dir) / str(e["time"])).is_dir()]
+    if missing:
+        frames.add_frames(args.radar_dir, missing)
+    # published frames are never replaced (see pipeline.publish_frame)
+    published = {t for t in work if (Path(args.radar_dir) / str(t)).is_dir()}
+    todo = sorted(t for t in work if t not in done and t not in published)
+
+    print(
+        f"[BACKFILL] {len(work)} frames found, {len(work) - len(todo)} already done, "
+        f"{len(todo)} to process ({len(skipped)} files skipped)"
+    )
+    unlisted = published - listed - {e["time"] for e in missing}
+    if unlisted:
+        print(
+            f"[WARN] {len(unlisted)} frames are published but not in the manifest; "
+            "delete their directories to redo them",
+            file=sys.stderr,
+        )
+    if not todo:
+        return True
+
+    opts = {
+        "stations": stations,
+        "cache_dir": args.cache_dir,
+        "radar_dir": args.radar_dir,
+        "composite": args.composite,
+        "zmin": args.zmin,
+        "zmax": args.zmax,
+        "resampling": args.resampling,
+        "tile_threads": args.tile_threads,
+        "tile_format": args.tile_format,
+        "encodings": ("png", "webp") if args.webp else ("png",),
+        "palette": None,
+        "levels": None,
+    }
+    if args.levels:
+        legend = pipeline.frame_legend(stations)
+        opts["palette"] = palettes.level_palette(args.palette, legend)
+        opts["levels"] = (len(legend), args.palette)
+    # templates and colour tables are loaded once and inherited by the pool
+    pipeline.warm_up(stations, args.cache_dir, args.levels)
+    Path(args.radar_dir).mkdir(parents=True, exist_ok=True)
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+
+    started = time.monotonic()
+    failed = 0
+    entries = []
+    tasks = ((t, work[t], opts) for t in todo)
+    # every worker holds one frame at a time, and is replaced after
+    # --max_tasks_per_worker frames so fragmentation cannot build up
+    with open_checkpoint(checkpoint) as log, multiprocessing.Pool(
+        args.processes, maxtasksperchild=args.max_tasks_per_worker
+    ) as pool:
+        try:
+            for n, record in enumerate(pool.imap_unordered(backfill_frame, tasks), 1):
+                append_checkpoint(log, record)
+                notes = "".join(f", {k} failed" for k in record["errors"])
+                if "entry" in record:
+                    entries.append(record["entry"])
+                    stations_used = ",".join(record["entry"]["stations"])
+                    print(
+                        f"[{n}/{len(todo)}] {record['time']} "
+                        f"({stations_used}{notes}) {record['seconds']:.1f}s"
+                    )
+                else:
+                    failed += 1
+                    print(
+                        f"[{n}/{len(todo)}] {record['time']} FAILED: "
+                        f"{record['error']}{notes}",
+                        file=sys.stderr,
+                    )
+                if len(entries) >= MANIFEST_BATCH:
+                    frames.add_frames(args.radar_dir, entries)
+                    entries = []
+        finally:
+            if entries:
+                frames.add_frames(args.radar_dir, entries)
+
+    elapsed = time.monotonic() - started
+    print(
+        f"[DONE] {len(todo) - failed} frames published, {failed} failed "
+        f"in {elapsed:.0f}s ({elapsed / len(todo):.1f}s per frame)"
+    )
+    return failed == 0
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Reprocess archived station images into published frames"
+    )
+    ap.add_argument(
+        "--input_dir",
+        required=True,
+        help="Archive of station images, named or filed by time",
+    )
+    ap.add_argument("--config", default=pipeline.DEFAULT_CONFIG)
+    ap.add_argument(
+        "--stations",
+        nargs="+",
+        default=None,
+        help="Only these stations, disabled ones included",
+    )
+    ap.add_argument(
+        "--radar_dir",
+        default="radar_history",
+        help="Where frames are published; keep it apart from the live radar/, "
+        "whose retention would delete them",
+    )
+    ap.add_argument("--cache_dir", default="cache")
+    ap.add_argument(
+        "--checkpoint",
+        default=None,
+        help=f"Log of finished frames (default <cache_dir>/{CHECKPOINT_NAME})",
+    )
+    ap.add_argument(
+        "--force",
+        action="store_true",
+        help="Ignore the checkpoint log and redo every frame not published yet",
+    )
+    ap.add_argument("--start", type=int, default=None, help="First slot, Unix time")
+    ap.add_argument("--end", type=int, default=None, help="Last slot, Unix time")
+    ap.add_argument(
+        "--interval",
+        type=int,
+        default=pipeline.CYCLE_SECONDS,
+        help="Frame slot length in seconds",
+    )
+    ap.add_argument(
+        "--utc_offset",
+        type=float,
+        default=0.0,
+        help="Hours from UTC of YYYYMMDD_HHMM stamps in file names (7 for TMD)",
+    )
+    ap.add_argument("--processes", type=int, default=None)
+    ap.add_argument(
+        "--max_tasks_per_worker",
+        type=int,
+        default=50,
+        help="Frames a worker processes before it is replaced",
+    )
+    ap.add_argument(
+        "--tile_threads",
+        type=int,
+        default=1,
+        help="Encoding threads per worker; frames already run in parallel",
+    )
+    ap.add_argument("--zmin", type=int, default=5)
+    ap.add_argument("--zmax", type=int, default=11)
+    ap.add_argument("--resampling", default="near", choices=["near", "average"])
+    ap.add_argument(
+        "--composite",
+        default="last",
+        choices=["last", "max", "nearest", "alpha"],
+    )
+    ap.add_argument("--tile_format", default="dir", choices=["dir", "pack", "cog"])
+    ap.add_argument("--webp", action="store_true")
+    ap.add_argument("--levels", action="store_true")
+    ap.add_argument("--palette", default=palettes.LEGEND, choices=palettes.PALETTES)
+    args = ap.parse_args()
+    if args.levels and args.resampling != "near":
+        ap.error("--levels needs --resampling near")
+    if not run_backfill(args):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
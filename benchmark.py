@@ -0,0 +1,805 @@
+import argparse
+import contextlib
+import ctypes
+import gc
+import glob
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import pipeline
+import radar_process as rp
+import tile_codec
+from tile_archive import open_archive
+
+# --------------------------------------------------------------------------- #
+# Reference implementations: the code the optimised functions replaced, kept
+# verbatim so speed, memory and output can be compared against it.
+# --------------------------------------------------------------------------- #
+
+
+def mask_rain_reference(
+    png_path,
+    out_path,
+    h_low=25,
+    h_high=110,
+    s_min=160,
+    v_min=70,
+    include_red=False,
+    red_low=245,
+    red_high=15,
+    disk_shrink=0.96,
+    left_crop_frac=0.18,
+):
+
+    im = Image.open(png_path).convert("RGBA")
+    w, h = im.size
+
+    hsv = im.convert("RGB").convert("HSV")
+    arr = np.array(hsv, dtype=np.uint8)
+    H, S, V = arr[..., 0], arr[..., 1], arr[..., 2]
+
+    gy = (H >= h_low) & (H <= h_high)
+    sv = (S >= s_min) & (V >= v_min)
+
+    if include_red:
+        red = (H >= red_low) | (H <= red_high)
+        hsv_mask = (gy | red) & sv
+    else:
+        hsv_mask = gy & sv
+
+    cy, cx = h / 2.0, w / 2.0
+    R = disk_shrink * min(w, h) * 0.5
+    yy, xx = np.ogrid[:h, :w]
+    circ = (xx - cx) ** 2 + (yy - cy) ** 2 <= R**2
+
+    left_mask = np.ones((h, w), dtype=bool)
+    cut = int(w * left_crop_frac)
+    left_mask[:, :cut] = False
+
+    keep = hsv_mask & circ & left_mask
+
+    rgba = np.array(im, dtype=np.uint8)
+    alpha = np.where(keep, 255, 0).astype(np.uint8)
+    rgba[..., 3] = alpha
+
+    rgb = rgba[..., :3]
+    rgb[alpha == 0] = 0
+    rgba[..., :3] = rgb
+
+    Image.fromarray(rgba).convert("RGBA").save(out_path)
+    return out_path
+
+
+def heatmap_reference(
+    input_path,
+    smooth_px=8,
+    gamma=0.85,
+    low_cut=0.15,
+    feather=0.12,
+    use_green_only=False,
+):
+    from matplotlib.colors import LinearSegmentedColormap
+    import matplotlib.pyplot as plt
+
+    image = cv2.imread(str(input_path))
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    h, w, _ = image_rgb.shape
+
+    gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255.0
+
+    if smooth_px > 0:
+        gray_smooth = cv2.GaussianBlur(
+            gray, ksize=(0, 0), sigmaX=smooth_px, sigmaY=smooth_px
+        )
+    else:
+        gray_smooth = gray
+
+    intensity = np.clip(gray_smooth, 0, 1) ** gamma
+
+    alpha = np.clip((intensity - low_cut) / max(feather, 1e-6), 0.0, 1.0)
+
+    if use_green_only:
+        colors = [
+            (0.0, 0.0, 0.0, 0.0),
+            (0.85, 1.0, 0.85, 0.6),
+            (0.5, 0.9, 0.5, 0.85),
+            (0.0, 0.75, 0.0, 1.0),
+        ]
+        rain_cmap = LinearSegmentedColormap.from_list("rain_green_soft", colors, N=512)
+    else:
+        colors = [
+            (0.0, 0.0, 0.0, 0.0),
+            (0.80, 1.00, 0.80, 0.6),
+            (0.00, 0.85, 0.00, 0.8),
+            (0.90, 0.90, 0.00, 0.9),
+            (1.00, 0.60, 0.10, 0.95),
+        ]
+        rain_cmap = LinearSegmentedColormap.from_list("rain_soft", colors, N=512)
+
+    dpi = 100
+    fig = plt.figure(figsize=(w / dpi, h / dpi), dpi=dpi)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.imshow(intensity, cmap=rain_cmap, alpha=alpha, interpolation="bilinear")
+    ax.axis("off")
+
+    plt.savefig(
+        str(input_path).replace(".png", "_smooth.png"),
+        dpi=dpi,
+        bbox_inches="tight",
+        pad_inches=0,
+        transparent=True,
+    )
+    plt.close(fig)
+
+
+def png_tile_reference(tile):
+    # full 32-bit RGBA PNG, as gdal2tiles and the first native tiler wrote
+    ok, buf = cv2.imencode(".png", cv2.cvtColor(tile, cv2.COLOR_RGBA2BGRA))
+    return buf.tobytes()
+
+
+# --------------------------------------------------------------------------- #
+# Measurement
+# --------------------------------------------------------------------------- #
+
+
+def _proc_status(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # hand freed heap back to the OS first so an earlier run's pages are not
+    # reused for free, then (Linux >= 4.0) reset VmHWM to the current RSS
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def measure(fn, repeat):
+    """
+    Run ``fn`` ``repeat`` times. Returns wall/CPU seconds (median) and the
+    peak memory of one call: the rise of the process high-water mark where
+    Linux lets us reset it (covers PIL's buffers too), plus the tracemalloc
+    peak of Python/numpy allocations.
+    """
+    walls, cpus = [], []
+    for _ in range(repeat):
+        gc.collect()
+        w0, c0 = time.perf_counter(), time.process_time()
+        fn()
+        walls.append(time.perf_counter() - w0)
+        cpus.append(time.process_time() - c0)
+
+    gc.collect()
+    peak_rss = None
+    if _reset_peak_rss():
+        rss0 = _proc_status("VmRSS")
+        fn()
+        peak_rss = _proc_status("VmHWM") - rss0
+
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "wall": statistics.median(walls),
+        "cpu": statistics.median(cpus),
+        "peak_rss": peak_rss,
+        "peak_traced": traced,
+    }
+
+
+def _mb(n):
+    return "-" if n is None else f"{n / 2**20:.1f} MB"
+
+
+def _report(name, base, new):
+    print(f"\n{name}")
+    print(f"  {'':10} {'wall':>9} {'cpu':>9} {'peak rss':>11} {'peak traced':>12}")
+    for label, r in (("reference", base), ("current", new)):
+        print(
+            f"  {label:10} {r['wall'] * 1000:7.1f}ms {r['cpu'] * 1000:7.1f}ms "
+            f"{_mb(r['peak_rss']):>11} {_mb(r['peak_traced']):>12}"
+        )
+    print(f"  speedup    {base['wall'] / new['wall']:.1f}x")
+
+
+# --------------------------------------------------------------------------- #
+# Benchmarks
+# --------------------------------------------------------------------------- #
+
+
+def bench_mask(args):
+    """mask_rain_from_png against the per-pixel HSV reference."""
+    params = dict(
+        h_low=args.h_low, h_high=args.h_high, s_min=args.s_min, v_min=args.v_min
+    )
+
+    # build the colour table and geometry mask up front; they are per
+    # process, not per frame
+    t0 = time.perf_counter()
+    rp.rain_color_lut(**params)
+    print(f"colour table: {time.perf_counter() - t0:.2f}s (once per process)")
+
+    ok = True
+    for path in args.images:
+        with open(path, "rb") as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as im:
+            w, h = im.size
+        rp.radar_area_mask(w, h)
+
+        tmp = tempfile.mkdtemp(prefix="bench_")
+        ref_out = os.path.join(tmp, "reference.png")
+        new_out = os.path.join(tmp, "current.png")
+
+        def ref():
+            mask_rain_reference(io.BytesIO(data), ref_out, **params)
+
+        def new():
+            rp.mask_rain_from_png(io.BytesIO(data), new_out, **params)
+
+        _report(
+            f"{os.path.basename(path)} ({w}x{h})",
+            measure(ref, args.repeat),
+            measure(new, args.repeat),
+        )
+
+        same = np.array_equal(
+            np.asarray(Image.open(ref_out)), np.asarray(Image.open(new_out))
+        )
+        ok &= same
+        print(f"  identical  {'yes' if same else 'NO'}")
+        shutil.rmtree(tmp)
+    return ok
+
+
+def bench_gaps(args):
+    """fix_radar_gaps: region-of-interest mode against the full-frame pass."""
+    params = dict(
+        nonblack_threshold=args.nonblack_threshold,
+        neighbor_kernel_size=args.neighbor_kernel_size,
+        min_neighbors=args.min_neighbors,
+        disk_dilate=args.disk_dilate,
+        inpaint_radius=args.inpaint_radius,
+    )
+
+    ok = True
+    for path in args.images:
+        with Image.open(path) as im:
+            rgba = np.array(im.convert("RGBA"), dtype=np.uint8)
+        rp.mask_rain(rgba)
+        bgra = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+        h, w = bgra.shape[:2]
+
+        results = {}
+
+        def ref():
+            results["reference"] = rp.fix_radar_gaps(bgra, **params)
+
+        def new():
+            results["current"] = rp.fix_radar_gaps(bgra, roi=True, **params)
+
+        _report(
+            f"{os.path.basename(path)} ({w}x{h})",
+            measure(ref, args.repeat),
+            measure(new, args.repeat),
+        )
+
+        same = np.array_equal(results["reference"], results["current"])
+        ok &= same
+        print(f"  identical  {'yes' if same else 'NO'}")
+    return ok
+
+
+def bench_heatmap(args):
+    """create_radar_heatmap: lookup-table renderer against the matplotlib one."""
+    ok = True
+    for path in args.images:
+        tmp = tempfile.mkdtemp(prefix="bench_")
+        masked = os.path.join(tmp, "rain_only.png")
+        rp.mask_rain_from_png(path, masked)
+        ref_out = os.path.join(tmp, "rain_only_smooth.png")
+        new_out = os.path.join(tmp, "rain_only_heatmap.png")
+
+        def ref():
+            heatmap_reference(masked, use_green_only=args.green)
+
+        def new():
+            rp.create_radar_heatmap(masked, use_green_only=args.green, out_path=new_out)
+
+        with Image.open(masked) as im:
+            w, h = im.size
+        _report(
+            f"{os.path.basename(path)} ({w}x{h})",
+            measure(ref, args.repeat),
+            measure(new, args.repeat),
+        )
+
+        # matplotlib resamples, may crop a pixel and leaves colour behind
+        # transparent pixels, so compare the premultiplied images loosely
+        def premultiplied(p):
+            px = np.asarray(Image.open(p).convert("RGBA"), dtype=np.float32)
+            px[:, :, :3] *= px[:, :, 3:] / 255.0
+            return px
+
+        ref_px, new_px = premultiplied(ref_out), premultiplied(new_out)
+        ok &= new_px.shape[:2] == (h, w)
+        print(
+            f"  size       reference {ref_px.shape[1]}x{ref_px.shape[0]}, "
+            f"current {new_px.shape[1]}x{new_px.shape[0]}"
+        )
+        if ref_px.shape == new_px.shape:
+            diff = np.abs(ref_px - new_px)
+            print(
+                f"  |diff|     mean {diff.mean():.2f}, "
+                f"99th pct {np.percentile(diff, 99):.1f} (premultiplied RGBA)"
+            )
+        shutil.rmtree(tmp)
+    return ok
+
+
+def _frame_tiles(frame_dir):
+    # decoded RGBA tiles of a published frame, from its archive or PNG files
+    archive = open_archive(frame_dir)
+    if archive is not None:
+        blobs = [bytes(archive.get(*key)) for key in sorted(archive.keys())]
+    else:
+        blobs = []
+        for path in sorted(glob.glob(os.path.join(frame_dir, "*", "*", "*.png"))):
+            with open(path, "rb") as f:
+                blobs.append(f.read())
+    return [np.asarray(Image.open(io.BytesIO(b)).convert("RGBA")) for b in blobs]
+
+
+def bench_codec(args):
+    """Bytes per tile and encode time per frame of each tile encoding."""
+    encoders = {
+        "rgba png": png_tile_reference,
+        "palette png": tile_codec.encode_png,
+        "webp": tile_codec.encode_webp,
+    }
+    ok = True
+    for frame_dir in args.frames:
+        tiles = _frame_tiles(frame_dir)
+        if not tiles:
+            print(f"\n{frame_dir}: no tiles")
+            continue
+        print(f"\n{frame_dir} ({len(tiles)} tiles)")
+        print(
+            f"  {'':12} {'bytes/tile':>11} {'frame':>10} {'encode':>9} {'per tile':>9}"
+        )
+        for name, encode in encoders.items():
+            walls = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                blobs = [encode(tile) for tile in tiles]
+                walls.append(time.perf_counter() - t0)
+            wall = statistics.median(walls)
+            size = sum(len(b) for b in blobs)
+            print(
+                f"  {name:12} {size / len(tiles):11.0f} {_mb(size):>10} "
+                f"{wall * 1000:7.0f}ms {wall * 1000 / len(tiles):7.2f}ms"
+            )
+            if encode is png_tile_reference:
+                continue
+            # lossless apart from the colour of fully transparent pixels
+            for tile, blob in zip(tiles, blobs):
+                decoded = np.asarray(Image.open(io.BytesIO(blob)).convert("RGBA"))
+                ok &= np.array_equal(
+                    np.where(decoded[..., 3:] > 0, decoded, 0),
+                    np.where(tile[..., 3:] > 0, tile, 0),
+                )
+        print(f"  lossless   {'yes' if ok else 'NO'}")
+    return ok
+
+
+# --------------------------------------------------------------------------- #
+# Synthetic station frames
+# --------------------------------------------------------------------------- #
+
+# NWS-style reflectivity colours, weakest to strongest echo. Close enough to
+# the TMD legend to exercise the masks: the blues and the reds fall outside
+# the default hue window just like on the real frames.
+SYNTHETIC_LEGEND = np.array(
+    [
+        (0, 236, 236),
+        (1, 160, 246),
+        (0, 255, 0),
+        (0, 200, 0),
+        (0, 144, 0),
+        (255, 255, 0),
+        (231, 192, 0),
+        (255, 144, 0),
+        (255, 0, 0),
+        (214, 0, 0),
+        (192, 0, 0),
+        (255, 0, 255),
+    ],
+    dtype=np.uint8,
+)
+# the suite's sky conditions, as the fraction of the radar disk with echoes
+COVERAGES = (0.0, 0.02, 0.1, 0.3, 0.6)
+
+
+def synthetic_frame(width, height, coverage, seed=0):
+    """
+    RGB frame laid out like a TMD HQ image: dark radar disk with range rings,
+    white legend strip on the left, and smooth colour-coded echo cells over
+    ``coverage`` of the disk, strongest at their cores, with the odd black
+    speckle the gap repair exists for.
+    """
+    rng = np.random.default_rng(seed)
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    cy, cx = height // 2, width // 2
+    radius = int(0.98 * min(width, height) * 0.5)
+
+    disk = np.zeros((height, width), dtype=np.uint8)
+    cv2.circle(disk, (cx, cy), radius, 1, -1)
+    disk = disk.astype(bool)
+    img[disk] = (24, 24, 32)
+
+    if coverage > 0:
+        noise = rng.random((height // 48 + 2, width // 48 + 2), dtype=np.float32)
+        field = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+        field = cv2.GaussianBlur(field, ksize=(0, 0), sigmaX=8)
+        inside = field[disk]
+        cut = np.quantile(inside, 1.0 - min(coverage, 1.0))
+        echo = disk & (field >= cut)
+        scale = len(SYNTHETIC_LEGEND) / max(float(inside.max()) - cut, 1e-6)
+        level = np.clip(
+            ((field - cut) * scale).astype(np.int32), 0, len(SYNTHETIC_LEGEND) - 1
+        )
+        img[echo] = SYNTHETIC_LEGEND[level[echo]]
+        img[echo & (rng.random((height, width), dtype=np.float32) < 0.02)] = 0
+
+    for r in range(radius // 4, radius + 1, radius // 4):
+        cv2.circle(img, (cx, cy), r, (90, 90, 90), 1)
+    cv2.line(img, (cx - radius, cy), (cx + radius, cy), (90, 90, 90), 1)
+    cv2.line(img, (cx, cy - radius), (cx, cy + radius), (90, 90, 90), 1)
+
+    strip = int(width * 0.18)
+    img[:, :strip] = (235, 235, 235)
+    box = max(height // (2 * len(SYNTHETIC_LEGEND)), 4)
+    for i, color in enumerate(SYNTHETIC_LEGEND):
+        y = height // 4 + i * box
+        img[y : y + box - 2, 20 : 20 + box] = color
+        cv2.putText(
+            img,
+            f"{10 + 5 * i} dBZ",
+            (30 + box, y + box - 4),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            box / 40,
+            (0, 0, 0),
+            1,
+        )
+    return img
+
+
+# --------------------------------------------------------------------------- #
+# Stage suite
+# --------------------------------------------------------------------------- #
+
+
+def _cpu_seconds(who):
+    r = resource.getrusage(who)
+    return r.ru_utime + r.ru_stime
+
+
+def run_stage(fn, repeat):
+    """
+    Median wall and CPU seconds of ``repeat`` calls and the largest peak RSS
+    rise of one call. CPU time includes pool workers that have been reaped.
+    """
+    walls, cpus, peaks = [], [], []
+    for _ in range(repeat):
+        gc.collect()
+        reset = _reset_peak_rss()
+        rss0 = _proc_status("VmRSS")
+        cpu0 = _cpu_seconds(resource.RUSAGE_SELF) + _cpu_seconds(
+            resource.RUSAGE_CHILDREN
+        )
+        w0 = time.perf_counter()
+        fn()
+        walls.append(time.perf_counter() - w0)
+        cpus.append(
+            _cpu_seconds(resource.RUSAGE_SELF)
+            + _cpu_seconds(resource.RUSAGE_CHILDREN)
+            - cpu0
+        )
+        if reset and rss0 is not None:
+            peaks.append(_proc_status("VmHWM") - rss0)
+    return {
+        "wall": statistics.median(walls),
+        "cpu": statistics.median(cpus),
+        "peak_rss": max(peaks) if peaks else None,
+    }
+
+
+def _suite_stations(args, frame_dir):
+    with open(args.config, "r", encoding="utf-8") as f:
+        defaults = json.load(f).get("defaults", {})
+    templates = sorted(glob.glob(os.path.join(args.geotif_dir, "*.tif")))
+    if not templates:
+        raise SystemExit(f"no templates in {args.geotif_dir}")
+
+    stations = []
+    for i in range(args.stations or len(templates)):
+        template = templates[i % len(templates)]
+        stations.append(
+            {
+                "name": f"syn{i}",
+                "template": template,
+                "input": os.path.join(frame_dir, f"syn{i}.png"),
+                "style": defaults.get("style", "echoes"),
+                "mask": dict(defaults.get("mask", {})),
+                "gaps": dict(defaults.get("gaps", {})),
+                "heatmap": dict(defaults.get("heatmap", {})),
+            }
+        )
+    return stations
+
+
+def bench_suite(args):
+    """Every stage of a cycle on synthetic frames, from clear sky to storms."""
+    tmp = tempfile.mkdtemp(prefix="bench_suite_")
+    cache_dir = os.path.join(tmp, "cache")
+    stations = _suite_stations(args, tmp)
+    results = {}
+    try:
+        for coverage in args.coverage:
+            print(f"\ncoverage {coverage:g} ({len(stations)} stations)")
+            for i, st in enumerate(stations):
+                _, _, w, h = rp.load_template(st["template"])
+                frame = synthetic_frame(w, h, coverage, seed=args.seed + i)
+                Image.fromarray(frame, "RGB").save(st["input"])
+
+            state = {}
+
+            def decode():
+                state["frames"] = [rp.read_rgba(st["input"]) for st in stations]
+
+            def mask():
+                state["masked"] = []
+                for st, frame in zip(stations, state["frames"]):
+                    rgba = frame.copy()
+                    rp.mask_rain(rgba, cache_dir=cache_dir, **st["mask"])
+                    state["masked"].append(rgba)
+
+            def gaps():
+                state["repaired"] = []
+                for st, rgba in zip(stations, state["masked"]):
+                    bgra = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+                    out = rp.fix_radar_gaps(img_bgra=bgra, **st["gaps"])
+                    state["repaired"].append(cv2.cvtColor(out, cv2.COLOR_BGRA2RGBA))
+
+            def heatmap():
+                for st, rgba in zip(stations, state["masked"]):
+                    bgr = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+                    rp.render_heatmap(bgr, **st["heatmap"])
+
+            def mosaic():
+                georefs = [
+                    (rgba, *rp.load_template(st["template"])[:2])
+                    for st, rgba in zip(stations, state["repaired"])
+                ]
+                state["mosaic"] = rp.mosaic_stations(georefs, cache_dir=cache_dir)
+
+            def tiles():
+                tiles_dir = os.path.join(tmp, "tiles")
+                shutil.rmtree(tiles_dir, ignore_errors=True)
+                mosaic, transform = state["mosaic"]
+                rp.build_tile_pyramid(
+                    mosaic, transform, tiles_dir, zmin=args.zmin, zmax=args.zmax
+                )
+
+            def cycle():
+                # a cold cycle: no station output or tiles to reuse
+                shutil.rmtree(os.path.join(cache_dir, "stations"), ignore_errors=True)
+                tiles_dir = os.path.join(tmp, "cycle_tiles")
+                shutil.rmtree(tiles_dir, ignore_errors=True)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    done = pipeline.run_stations(
+                        stations, tmp, cache_dir, processes=args.processes
+                    )
+                    failed = [r for r in done if not r["ok"]]
+                    if failed:
+                        raise RuntimeError(failed[0]["error"])
+                    pipeline.build_tiles(
+                        done, tiles_dir, args.zmin, args.zmax, cache_dir
+                    )
+
+            # one untimed pass builds the colour and remap tables
+            for stage in (decode, mask, gaps, heatmap, mosaic):
+                stage()
+
+            results[f"{coverage:g}"] = row = {}
+            for stage in (decode, mask, gaps, heatmap, mosaic, tiles, cycle):
+                row[stage.__name__] = r = run_stage(stage, args.repeat)
+                print(
+                    f"  {stage.__name__:8} {r['wall'] * 1000:9.1f}ms wall "
+                    f"{r['cpu'] * 1000:9.1f}ms cpu {_mb(r['peak_rss']):>10} peak"
+                )
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "cpus": os.cpu_count(),
+            "stations": len(stations),
+            "templates": sorted({os.path.basename(s["template"]) for s in stations}),
+            "repeat": args.repeat,
+            "zoom": [args.zmin, args.zmax],
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[OK] results → {args.out}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            return compare(json.load(f), report, args.threshold)
+    return True
+
+
+def compare(baseline, current, threshold=0.15):
+    """
+    Print stage-by-stage changes against a baseline report. A stage regresses
+    when its wall time or peak RSS grows by more than ``threshold`` (and by
+    more than timer/allocator noise). Returns False if anything regressed.
+    """
+    ok = True
+    print(
+        f"\n{'coverage':>8} {'stage':8} {'baseline':>10} {'current':>10} {'change':>8}"
+    )
+    for coverage, stages in current["results"].items():
+        for stage, cur in stages.items():
+            base = baseline["results"].get(coverage, {}).get(stage)
+            if base is None:
+                continue
+            change = cur["wall"] / base["wall"] - 1 if base["wall"] else 0.0
+            flags = []
+            if change > threshold and cur["wall"] - base["wall"] > 0.005:
+                flags.append("SLOWER")
+            elif change < -threshold and base["wall"] - cur["wall"] > 0.005:
+                flags.append("faster")
+            if (
+                cur.get("peak_rss") is not None
+                and base.get("peak_rss") is not None
+                and cur["peak_rss"] > base["peak_rss"] * (1 + threshold)
+                and cur["peak_rss"] - base["peak_rss"] > 4 * 2**20
+            ):
+                flags.append("MORE MEMORY")
+            ok &= not any(flag.isupper() for flag in flags)
+            print(
+                f"{coverage:>8} {stage:8} {base['wall'] * 1000:8.1f}ms "
+                f"{cur['wall'] * 1000:8.1f}ms {change:+7.0%} {' '.join(flags)}"
+            )
+    print(
+        "\nno regressions"
+        if ok
+        else "\nREGRESSIONS (threshold {:.0%})".format(threshold)
+    )
+    return ok
+
+
+def bench_compare(args):
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)
+    return compare(baseline, current, args.threshold)
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Benchmark pipeline stages against their reference implementations"
+    )
+    sub = ap.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("mask", help="rain masking of station PNGs")
+    p.add_argument(
+        "images", nargs="+", help="station PNGs, e.g. the *_HQ_latest.png frames"
+    )
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--h_low", type=int, default=25)
+    p.add_argument("--h_high", type=int, default=110)
+    p.add_argument("--s_min", type=int, default=160)
+    p.add_argument("--v_min", type=int, default=70)
+    p.set_defaults(run=bench_mask)
+
+    p = sub.add_parser("gaps", help="gap repair of masked station PNGs")
+    p.add_argument("images", nargs="+", help="station PNGs, masked with defaults")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--nonblack_threshold", type=int, default=5)
+    p.add_argument("--neighbor_kernel_size", type=int, default=3)
+    p.add_argument("--min_neighbors", type=int, default=3)
+    p.add_argument("--disk_dilate", type=int, default=31)
+    p.add_argument("--inpaint_radius", type=int, default=3)
+    p.set_defaults(run=bench_gaps)
+
+    p = sub.add_parser("heatmap", help="heatmap rendering of masked station PNGs")
+    p.add_argument("images", nargs="+", help="station PNGs, masked with defaults")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--green", action="store_true", help="rain_green_soft ramp")
+    p.set_defaults(run=bench_heatmap)
+
+    p = sub.add_parser("codec", help="tile encodings on published frames")
+    p.add_argument("frames", nargs="+", help="frame directories, e.g. radar/<ts>")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=bench_codec)
+
+    p = sub.add_parser("suite", help="every stage on synthetic frames")
+    p.add_argument(
+        "--coverage",
+        type=float,
+        nargs="+",
+        default=list(COVERAGES),
+        help="Fractions of the radar disk covered by echoes",
+    )
+    p.add_argument("--config", default="stations.json", help="Station defaults")
+    p.add_argument("--geotif_dir", default="geotif")
+    p.add_argument(
+        "--stations",
+        type=int,
+        default=None,
+        help="Synthetic stations per cycle (default: one per template)",
+    )
+    p.add_argument("--processes", type=int, default=None)
+    p.add_argument("--zmin", type=int, default=5)
+    p.add_argument("--zmax", type=int, default=11)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", default=None, help="Write results as JSON")
+    p.add_argument("--baseline", default=None, help="Compare against this JSON")
+    p.add_argument("--threshold", type=float, default=0.15)
+    p.set_defaults(run=bench_suite)
+
+    p = sub.add_parser("compare", help="compare two suite results")
+    p.add_argument("baseline")
+    p.add_argument("current")
+    p.add_argument("--threshold", type=float, default=0.15)
+    p.set_defaults(run=bench_compare)
+
+    args = ap.parse_args()
+    if not args.run(args):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+import argparse
+import io
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import fetch
+import pipeline
+import radar_process as rp
+
+# Pick a station's HSV mask thresholds (h_low, h_high, s_min, v_min) from
+# sample frames instead of by trial and error.
+#
+# Every pixel of the radar area is labelled rain or not rain, either by
+# matching the colours of the legend bar on the left of the frame or by a
+# reference mask. The labelled pixels are counted once into 3-D (H, S, V)
+# histograms. Suffix sums over S and V and a prefix sum over H then give
+# the true and false positives of any threshold set as two lookups, so all
+# combinations are scored in one vectorized sweep without re-masking a frame.
+# Thresholds are searched in steps of --step on PIL's 0-255 HSV scale, the
+# one mask_rain uses.
+STEP = 4
+# legend blocks are at least this share of the frame height
+LEGEND_MIN_RUN = 0.02
+# legend colours below this saturation (white, greys) are not kept: they
+# also draw text and lines on the map
+LEGEND_MIN_SATURATION = 16
+
+
+def rgb_words(rgb):
+    # R | G << 8 | B << 16, as indexed by rain_color_lut
+    rgb = rgb.astype(np.uint32)
+    return rgb[..., 0] | rgb[..., 1] << 8 | rgb[..., 2] << 16
+
+
+def hex_color(word):
+    return f"#{word & 0xFF:02x}{word >> 8 & 0xFF:02x}{word >> 16 & 0xFF:02x}"
+
+
+def color_word(hex_string):
+    r, g, b = (int(hex_string[i : i + 2], 16) for i in (1, 3, 5))
+    return r | g << 8 | b << 16
+
+
+def legend_colors(rgb, left_crop_frac=0.18):
+    """
+    Colours of the legend bar in the strip left of the radar disk, weakest
+    first. The bar is the column with the most saturated pixels; its
+    colours are read as runs of at least LEGEND_MIN_RUN of the frame height,
+    from the bottom up.
+    """
+    h, w = rgb.shape[:2]
+    strip = rgb[:, : max(1, int(w * left_crop_frac))]
+    hsv = np.asarray(Image.fromarray(np.ascontiguousarray(strip)).convert("HSV"))
+    saturated = (hsv[..., 1] >= 100) & (hsv[..., 2] >= 100)
+    col = int(saturated.sum(axis=0).argmax())
+    words = rgb_words(strip[:, col])
+    edges = np.flatnonzero(np.diff(words)) + 1
+    starts, ends = np.r_[0, edges], np.r_[edges, h]
+    colors = []
+    for start, end in zip(starts[::-1], ends[::-1]):
+        word = int(words[start])
+        if end - start < LEGEND_MIN_RUN * h or word in colors:
+            continue
+        if hsv[start, col, 1] < LEGEND_MIN_SATURATION:
+            continue
+        colors.append(word)
+    return colors
+
+
+def read_sample(source, cache_dir=None):
+    """RGB array of a sample frame: a local file or a URL."""
+    data = fetch.fetch(source, cache_dir)["data"]
+    return np.ascontiguousarray(rp.read_rgba(io.BytesIO(data))[..., :3])
+
+
+def read_reference(path, shape):
+    # rain where a reference mask is opaque (RGBA) or non-black
+    img = Image.open(path)
+    if img.size != (shape[1], shape[0]):
+        raise ValueError(f"{path}: reference is {img.size}, frame is {shape[1::-1]}")
+    if img.mode in ("RGBA", "LA", "PA"):
+        return np.asarray(img.convert("RGBA"))[..., 3] > 0
+    return np.asarray(img.convert("L")) > 0
+
+
+def histograms(samples, step=STEP):
+    """
+    ``(rain, other)`` counts of labelled pixels per (H, S, V) bin of
+    ``step``; ``samples`` yields ``(rgb, area, labels)``.
+    """
+    n = 256 // step
+    rain = np.zeros(n**3, dtype=np.int64)
+    other = np.zeros(n**3, dtype=np.int64)
+    for rgb, area, labels in samples:
+        hsv = np.asarray(Image.fromarray(np.ascontiguousarray(rgb)).convert("HSV"))
+        bins = hsv[area].astype(np.int64) // step
+        index = (bins[:, 0] * n + bins[:, 1]) * n + bins[:, 2]
+        is_rain = labels[area]
+        rain += np.bincount(index[is_rain], minlength=n**3)
+        other += np.bincount(index[~is_rain], minlength=n**3)
+    return rain.reshape(n, n, n), other.reshape(n, n, n)
+
+
+def _box_sums(hist):
+    # P[k, a, b]: pixels with H bin < k, S bin >= a and V bin >= b
+    tail = hist[:, ::-1, ::-1].cumsum(axis=1).cumsum(axis=2)[:, ::-1, ::-1]
+    head = np.zeros((hist.shape[0] + 1,) + hist.shape[1:], dtype=np.int64)
+    np.cumsum(tail, axis=0, out=head[1:])
+    return head
+
+
+def _scores(rain, other, lo, total):
+    # F1 of every (h_high, s_min, v_min) for one h_low; h_high < h_low
+    # wraps around through red
+    n = rain.shape[0] - 1
+    hi = np.arange(n)[:, None, None]
+    wrap = hi < lo
+
+    def count(p):
+        inside = p[1:] - p[lo]
+        return np.where(wrap, p[1:] + p[n] - p[lo], inside)
+
+    tp = count(rain)
+    fp = count(other)
+    fn = total - tp
+    return 2 * tp / np.maximum(2 * tp + fp + fn, 1), tp, fp
+
+
+def legend_bins(legend, step=STEP):
+    """(H, S, V) bins of ``step`` of the legend colours, Nx3."""
+    rgb = np.array([[c & 0xFF, c >> 8 & 0xFF, c >> 16 & 0xFF] for c in legend])
+    rgb = rgb.astype(np.uint8).reshape(1, -1, 3)
+    hsv = np.asarray(Image.fromarray(rgb).convert("HSV"))
+    return hsv[0].astype(np.int64) // step
+
+
+def _keeps(bins, lo, n):
+    # whether every (h_high, s_min, v_min) for h_low ``lo`` keeps all bins
+    hi = np.arange(n)[:, None, None]
+    s = np.arange(n)[None, :, None]
+    v = np.arange(n)[None, None, :]
+    keeps = np.ones((n, n, n), dtype=bool)
+    for h_bin, s_bin, v_bin in bins:
+        # h_high < h_low wraps around through red, as in _scores
+        in_hue = np.where(
+            hi < lo, (h_bin >= lo) | (h_bin <= hi), (lo <= h_bin) & (h_bin <= hi)
+        )
+        keeps &= in_hue & (s <= s_bin) & (v <= v_bin)
+    return keeps
+
+
+def sweep(rain, other, step=STEP, legend=None):
+    """
+    Best thresholds for the histograms by F1. Among equally good
+    combinations the one nearest their per-threshold median is taken, to
+    keep a margin on every side. Thresholds that drop a colour of
+    ``legend`` are never picked, however rare the colour is in the samples.
+    Returns ``(params, stats)``.
+    """
+    total = int(rain.sum())
+    if total == 0:
+        raise ValueError("no rain pixels in the samples")
+    rain, other = _box_sums(rain), _box_sums(other)
+    n = rain.shape[0] - 1
+    bins = legend_bins(legend, step) if legend else np.empty((0, 3), np.int64)
+
+    def f1(lo):
+        return np.where(_keeps(bins, lo, n), _scores(rain, other, lo, total)[0], -1)
+
+    best = -1.0
+    for lo in range(n):
+        best = max(best, float(f1(lo).max()))
+    # per-threshold median of the tied combinations, then the tie nearest it
+    counts = np.zeros((4, n), dtype=np.int64)
+    for lo in range(n):
+        tied = f1(lo) >= best - 1e-12
+        counts[0, lo] += tied.sum()
+        for axis in range(3):
+            other_axes = tuple(a for a in range(3) if a != axis)
+            counts[axis + 1] += tied.sum(axis=other_axes)
+    cum = counts.cumsum(axis=1)
+    centre = (cum < cum[:, -1:] / 2).sum(axis=1)
+    grid = np.arange(n)
+    nearest = None
+    for lo in range(n):
+        tied = f1(lo) >= best - 1e-12
+        if not tied.any():
+            continue
+        distance = (
+            abs(lo - centre[0])
+            + np.abs(grid - centre[1])[:, None, None]
+            + np.abs(grid - centre[2])[None, :, None]
+            + np.abs(grid - centre[3])[None, None, :]
+        )
+        i = np.where(tied, distance, np.iinfo(np.int64).max).argmin()
+        hi, s, v = np.unravel_index(i, tied.shape)
+        if nearest is None or distance[hi, s, v] < nearest[0]:
+            nearest = (distance[hi, s, v], lo, int(hi), int(s), int(v))
+    _, lo, hi, s, v = nearest
+    _, tp, fp = _scores(rain, other, lo, total)
+    tp, fp = int(tp[hi, s, v]), int(fp[hi, s, v])
+    ties = int(counts[0].sum())
+
+    h_low, h_high = lo * step, hi * step + step - 1
+    params = {"s_min": s * step, "v_min": v * step}
+    if hi < lo:
+        # [h_low, 255] and [0, h_high] as the mask's red band
+        params.update(
+            h_low=0, h_high=h_high, include_red=True, red_low=h_low, red_high=h_high
+        )
+    else:
+        params.update(h_low=h_low, h_high=h_high, include_red=False)
+    stats = {
+        "f1": best,
+        "precision": tp / max(tp + fp, 1),
+        "recall": tp / total,
+        "rain_pixels": total,
+        "candidates": n * n * n * n,
+        "ties": ties,
+    }
+    return params, stats
+
+
+def _f1(tp, fp, total):
+    return {
+        "f1": 2 * tp / max(tp + fp + total, 1),
+        "precision": tp / max(tp + fp, 1),
+        "recall": tp / max(total, 1),
+    }
+
+
+def write_station(config_path, name, mask, legend):
+    """Merge ``mask`` and ``legend`` into one station of the config file."""
+    config_path = Path(config_path)
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    for entry in config["stations"]:
+        if entry["name"] == name:
+            entry["mask"] = {**entry.get("mask", {}), **mask}
+            if legend:
+                entry["legend"] = [hex_color(c) for c in legend]
+            break
+    else:
+        raise KeyError(f"no station {name!r} in {config_path}")
+    tmp = config_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    os.replace(tmp, config_path)
+
+
+def calibrate_station(station, sources, references=None, cache_dir=None, step=STEP):
+    """
+    Calibrate one station on the sample frames ``sources``, labelled by
+    ``references`` masks or else by the legend of the first sample.
+    ``cache_dir`` is the pipeline's: colour tables are shared from it, and
+    downloads are cached in the station's own directory below it.
+    Returns ``(params, stats, legend)``.
+    """
+    mask = station["mask"]
+    source_dir = pipeline.station_cache(cache_dir, station) if cache_dir else None
+    frames = [read_sample(s, source_dir) for s in sources]
+    legend = station.get("legend")
+    legend = [color_word(c) for c in legend] if legend else None
+    if legend is None:
+        legend = legend_colors(frames[0], mask.get("left_crop_frac", 0.18))
+    if not references and not legend:
+        raise ValueError(f"{station['name']}: no legend found, pass --reference")
+
+    def samples():
+        for i, rgb in enumerate(frames):
+            h, w = rgb.shape[:2]
+            area = rp.radar_area_mask(
+                w, h, mask.get("disk_shrink", 0.96), mask.get("left_crop_frac", 0.18)
+            )
+            if references:
+                labels = read_reference(references[i], rgb.shape)
+            else:
+                labels = np.isin(rgb_words(rgb), legend)
+            # score of the current thresholds, with the pipeline's own table
+            kept = current[rgb_words(rgb)] & area
+            tally[0] += np.count_nonzero(kept & labels)
+            tally[1] += np.count_nonzero(kept & ~labels)
+            tally[2] += np.count_nonzero(labels & area)
+            yield rgb, area, labels
+
+    colors = {
+        k: v for k, v in mask.items() if k not in ("disk_shrink", "left_crop_frac")
+    }
+    current = rp.rain_color_lut(cache_dir=cache_dir, **colors)
+    tally = [0, 0, 0]
+    rain, other = histograms(samples(), step)
+    params, stats = sweep(rain, other, step, legend)
+    stats["current"] = _f1(*tally)
+    return params, stats, legend
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Fit a station's HSV mask thresholds to sample frames"
+    )
+    ap.add_argument("--config", default=pipeline.DEFAULT_CONFIG)
+    ap.add_argument("--station", required=True)
+    ap.add_argument(
+        "--samples",
+        nargs="+",
+        default=None,
+        help="Sample frames, files or URLs (default: the station's input)",
+    )
+    ap.add_argument(
+        "--reference",
+        nargs="+",
+        default=None,
+        help="Rain masks, one per sample, instead of the legend colours",
+    )
+    ap.add_argument("--cache_dir", default="cache")
+    ap.add_argument("--step", type=int, default=STEP, choices=[1, 2, 4, 8, 16])
+    ap.add_argument(
+        "--write",
+        action="store_true",
+        help="Store the thresholds and legend in the config",
+    )
+    args = ap.parse_args()
+
+    stations = pipeline.load_stations(args.config, include_disabled=True)
+    station = next((s for s in stations if s["name"] == args.station), None)
+    if station is None:
+        raise SystemExit(f"no station {args.station!r} in {args.config}")
+    sources = args.samples or [station["input"]]
+    if args.reference and len(args.reference) != len(sources):
+        raise SystemExit("--reference needs one mask per sample")
+
+    started = time.monotonic()
+    try:
+        params, stats, legend = calibrate_station(
+            station, sources, args.reference, args.cache_dir, args.step
+        )
+    except ValueError as e:
+        raise SystemExit(f"[FAIL] {e}")
+    elapsed = time.monotonic() - started
+
+    current = stats["current"]
+    print(f"[LEGEND] {' '.join(hex_color(c) for c in legend)}")
+    print(
+        f"[CURRENT] F1 {current['f1']:.4f} precision {current['precision']:.4f} "
+        f"recall {current['recall']:.4f}"
+    )
+    print(
+        f"[BEST] F1 {stats['f1']:.4f} precision {stats['precision']:.4f} "
+        f"recall {stats['recall']:.4f} ({stats['candidates']} combinations, "
+        f"{stats['rain_pixels']} rain pixels, {elapsed:.1f}s)"
+    )
+    print(json.dumps(params))
+    if args.write:
+        write_station(args.config, station["name"], params, legend)
+        print(f"[OK] written to {args.config}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import math
+import os
+import threading
+
+import numpy as np
+
+import tile_codec
+
+# Alternative frame layout: instead of a pre-rendered pyramid, a frame holds
+# one internally tiled Cloud-Optimized GeoTIFF of the EPSG:3857 mosaic with
+# overviews, and the web service renders tiles from it on first request.
+# Cycle time then no longer depends on the maximum zoom.
+#
+# rasterio is imported inside the functions so the web service only loads
+# GDAL once it actually serves a COG frame.
+COG_NAME = "mosaic.tif"
+TILE_SIZE = 256
+ORIGIN_SHIFT = math.pi * 6378137.0
+# deepest zoom served; past the mosaic resolution tiles are upsampled
+MAX_ZOOM = 22
+
+
+def write_cog(path, mosaic, transform, resampling="near", palette=None):
+    """
+    Write an HxWx4 RGBA mosaic on the tile-aligned EPSG:3857 grid as a COG
+    with 256 px blocks and overviews, next to ``path`` then renamed into
+    place.
+
+    The raster is padded so its origin and size are multiples of 2**zoom
+    pixels of the grid's zoom, with one overview per zoom down to 0.
+    Each overview pixel is then the top-left pixel of a block aligned to the
+    global tile grid, the pixel build_tile_pyramid's nearest resampling
+    keeps, and every zoom reads one overview without further resampling.
+
+    A single-band mosaic of levels is written with ``palette`` as
+    its colour map; TIFF colour maps have no alpha, so the RGBA palette is
+    also kept in the ``PALETTE`` tag.
+    """
+    import rasterio
+    from rasterio.crs import CRS
+    from rasterio.enums import ColorInterp
+    from rasterio.transform import Affine
+    from rasterio.windows import Window
+
+    if mosaic.ndim == 2:
+        mosaic = mosaic[:, :, None]
+    h, w = mosaic.shape[:2]
+    res = transform.a
+    zoom = round(math.log2(2 * ORIGIN_SHIFT / (TILE_SIZE * res)))
+    align = 2**zoom
+    pc = round((transform.c + ORIGIN_SHIFT) / res) % align
+    pr = round((ORIGIN_SHIFT - transform.f) / res) % align
+    tmp = f"{path}.{os.getpid()}.tmp"
+    profile = {
+        "driver": "COG",
+        "dtype": "uint8",
+        "count": mosaic.shape[2],
+        "width": -(-(w + pc) // align) * align,
+        "height": -(-(h + pr) // align) * align,
+        "crs": CRS.from_epsg(3857),
+        "transform": transform * Affine.translation(-pc, -pr),
+        "compress": "deflate",
+        "blocksize": TILE_SIZE,
+        "overview_resampling": "nearest" if resampling == "near" else "average",
+        "overview_count": zoom,
+    }
+    with rasterio.open(tmp, "w", **profile) as dst:
+        if mosaic.shape[2] == 1 and palette is not None:
+            dst.colorinterp = [ColorInterp.palette]
+            dst.write_colormap(1, {i: tuple(c) for i, c in enumerate(palette.tolist())})
+            dst.update_tags(PALETTE=palette.tobytes().hex())
+        else:
+            dst.colorinterp = [
+                ColorInterp.red,
+                ColorInterp.green,
+                ColorInterp.blue,
+                ColorInterp.alpha,
+            ][: mosaic.shape[2]]
+        dst.write(mosaic.transpose(2, 0, 1), window=Window(pc, pr, w, h))
+    os.replace(tmp, path)
+    return path
+
+
+class CogTiles:
+    """
+    Renders XYZ/TMS tiles from one frame's COG. Reads are serialized per
+    file because a GDAL dataset handle is not thread-safe.
+    """
+
+    def __init__(self, path):
+        import rasterio
+
+        self.path = path
+        self._ds = rasterio.open(path)
+        self._lock = threading.Lock()
+        t = self._ds.transform
+        res = t.a
+        # zoom whose pixel grid the mosaic sits on, and the mosaic's origin
+        # in that zoom's global pixel coordinates
+        self.grid_zoom = round(math.log2(2 * ORIGIN_SHIFT / (TILE_SIZE * res)))
+        self.col0 = round((t.c + ORIGIN_SHIFT) / res)
+        self.row0 = round((ORIGIN_SHIFT - t.f) / res)
+        self.width = self._ds.width
+        self.height = self._ds.height
+        # single-band level mosaics are colourized with their RGBA palette
+        self.palette = None
+        palette = self._ds.tags().get("PALETTE")
+        if self._ds.count == 1 and palette:
+            self.palette = np.frombuffer(bytes.fromhex(palette), np.uint8)
+            self.palette = self.palette.reshape(-1, 4)
+
+    def close(self):
+        self._ds.close()
+
+    def _read(self, col, row, width, height, out_w, out_h):
+        from rasterio.enums import Resampling
+        from rasterio.windows import Window
+
+        with self._lock:
+            data = self._ds.read(
+                window=Window(col, row, width, height),
+                out_shape=(self._ds.count, out_h, out_w),
+                resampling=Resampling.nearest,
+            )
+        if self._ds.count == 1:
+            return data[0]
+        return data.transpose(1, 2, 0)
+
+    def render(self, z, x, y):
+        """
+        RGBA tile ``z/x/y`` (TMS row), or None where the mosaic has no data.
+        Single-band mosaics give a tile of levels.
+        """
+        if z > MAX_ZOOM or x >= 2**z or y >= 2**z:
+            return None
+        y = 2**z - 1 - y
+        bands = () if self._ds.count == 1 else (self._ds.count,)
+        tile = np.zeros((TILE_SIZE, TILE_SIZE) + bands, dtype=np.uint8)
+
+        if z <= self.grid_zoom:
+            # each output pixel covers f x f mosaic pixels; read the window
+            # of whole blocks inside the mosaic, letting GDAL decimate
+            # through the overviews
+            f = 2 ** (self.grid_zoom - z)
+            c = x * TILE_SIZE * f - self.col0
+            r = y * TILE_SIZE * f - self.row0
+            i0, i1 = max(0, -(c // f)), min(TILE_SIZE, (self.width - c) // f)
+            j0, j1 = max(0, -(r // f)), min(TILE_SIZE, (self.height - r) // f)
+            if i1 <= i0 or j1 <= j0:
+                return None
+            tile[j0:j1, i0:i1] = self._read(
+                c + i0 * f,
+                r + j0 * f,
+                (i1 - i0) * f,
+                (j1 - j0) * f,
+                i1 - i0,
+                j1 - j0,
+            )
+        else:
+            # each mosaic pixel covers k x k output pixels: read the native
+            # pixels and repeat them
+            k = 2 ** (z - self.grid_zoom)
+            cols = (x * TILE_SIZE + np.arange(TILE_SIZE)) // k - self.col0
+            rows = (y * TILE_SIZE + np.arange(TILE_SIZE)) // k - self.row0
+            ci = np.flatnonzero((cols >= 0) & (cols < self.width))
+            rj = np.flatnonzero((rows >= 0) & (rows < self.height))
+            if not len(ci) or not len(rj):
+                return None
+            c0, c1 = cols[ci[0]], cols[ci[-1]] + 1
+            r0, r1 = rows[rj[0]], rows[rj[-1]] + 1
+            native = self._read(c0, r0, c1 - c0, r1 - r0, c1 - c0, r1 - r0)
+            tile[rj[0] : rj[-1] + 1, ci[0] : ci[-1] + 1] = native[
+                np.ix_(rows[rj] - r0, cols[ci] - c0)
+            ]
+
+        if not (tile if tile.ndim == 2 else tile[:, :, 3]).any():
+            return None
+        return tile
+
+    def tile_bytes(self, z, x, y, encoding="png"):
+        tile = self.render(z, x, y)
+        if tile is None:
+            return None
+        return tile_codec.encode(tile, encoding, self.palette)
+
+
+def open_cog(frame_dir):
+    """CogTiles of a frame directory, or None if it has no COG."""
+    path = os.path.join(frame_dir, COG_NAME)
+    if not os.path.exists(path):
+        return None
+    return CogTiles(path)
@@ -0,0 +1,174 @@
+import io
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from pathlib import Path
+
+# Download stage of a cycle. All station images are fetched at once on a
+# thread pool, each with its own deadline and a few retries. The last image
+# and its ETag / Last-Modified of every station are kept in the station
+# cache, so an unchanged image is answered with 304 and read from disk.
+SOURCE_NAME = "source"
+VALIDATORS_NAME = "source.json"
+TIMEOUT = 60
+RETRIES = 2
+# seconds before the first retry; doubles after every attempt
+BACKOFF = 1.0
+CHUNK_SIZE = 64 * 1024
+USER_AGENT = "OpenTH-Radar"
+
+
+class FetchError(Exception):
+    pass
+
+
+def is_url(source):
+    return source.startswith(("http://", "https://"))
+
+
+def _retryable(exc):
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code >= 500 or exc.code == 429
+    # URLError and timeouts are OSErrors; FetchError is a truncated body
+    return isinstance(exc, (OSError, HTTPException, FetchError))
+
+
+def read_validators(cache_dir, url):
+    """Validators of the cached copy of ``url``, or {} if there is none."""
+    cache_dir = Path(cache_dir)
+    try:
+        with open(cache_dir / VALIDATORS_NAME, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if saved.get("url") != url or not (cache_dir / SOURCE_NAME).exists():
+        return {}
+    return saved
+
+
+def save_source(cache_dir, url, data, headers):
+    # body first, then the validators that refer to it
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for name, payload in (
+        (SOURCE_NAME, data),
+        (
+            VALIDATORS_NAME,
+            json.dumps(
+                {
+                    "url": url,
+                    "etag": headers.get("ETag"),
+                    "last_modified": headers.get("Last-Modified"),
+                }
+            ).encode(),
+        ),
+    ):
+        tmp = cache_dir / f"{name}.{os.getpid()}.tmp"
+        tmp.write_bytes(payload)
+        os.replace(tmp, cache_dir / name)
+
+
+def _socket(resp):
+    # http.client keeps the connection's socket behind its file object
+    return getattr(getattr(resp.fp, "raw", None), "_sock", None)
+
+
+def _request(url, validators, timeout):
+    # one attempt; the timeout bounds the whole transfer, not just each read
+    headers = {"User-Agent": USER_AGENT}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    deadline = time.monotonic() + timeout
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        resp = urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return 304, None, e.headers
+        raise
+    with resp:
+        sock = _socket(resp)
+        buf = io.BytesIO()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"download exceeded {timeout}s")
+            # a stalled read must not outlive the deadline either
+            if sock is not None:
+                sock.settimeout(remaining)
+            chunk = resp.read1(CHUNK_SIZE)
+            if not chunk:
+                break
+            buf.write(chunk)
+        length = resp.headers.get("Content-Length")
+        if length is not None and int(length) != buf.tell():
+            raise FetchError(f"got {buf.tell()} of {length} bytes")
+        return resp.status, buf.getvalue(), resp.headers
+
+
+def fetch(source, cache_dir=None, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+    """
+    Fetch one station image into memory. URLs are requested conditionally
+    against the copy kept in ``cache_dir``; a 304 answer returns that copy.
+    Connection errors, timeouts, 5xx and 429 answers are retried up to
+    ``retries`` times with exponential backoff.
+
+    Returns a dict with ``data``, ``status`` (200, 304, or None for local
+    files), ``attempts`` and ``seconds``. Raises the last error when every
+    attempt failed.
+    """
+    started = time.monotonic()
+    if not is_url(source):
+        with open(source, "rb") as f:
+            data = f.read()
+        return {"data": data, "status": None, "attempts": 1, "seconds": 0.0}
+
+    validators = read_validators(cache_dir, source) if cache_dir else {}
+    for attempt in range(retries + 1):
+        try:
+            status, data, headers = _request(source, validators, timeout)
+            break
+        except Exception as e:
+            if attempt == retries or not _retryable(e):
+                raise
+            time.sleep(backoff * 2**attempt)
+    if status == 304:
+        data = (Path(cache_dir) / SOURCE_NAME).read_bytes()
+    elif cache_dir:
+        save_source(cache_dir, source, data, headers)
+    return {
+        "data": data,
+        "status": status,
+        "attempts": attempt + 1,
+        "seconds": time.monotonic() - started,
+    }
+
+
+def fetch_all(sources, cache_dirs=None, workers=None, timeout=TIMEOUT, retries=RETRIES):
+    """
+    Fetch ``{name: source}`` concurrently. ``cache_dirs`` maps names to the
+    directory holding each source's cached copy. Returns ``{name: result}``
+    where a failed fetch has ``error`` instead of ``data``.
+    """
+    cache_dirs = cache_dirs or {}
+
+    def one(name):
+        started = time.monotonic()
+        try:
+            return fetch(sources[name], cache_dirs.get(name), timeout, retries)
+        except Exception as e:
+            return {
+                "error": f"{type(e).__name__}: {e}",
+                "seconds": time.monotonic() - started,
+            }
+
+    if not sources:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers or len(sources)) as pool:
+        return dict(zip(sources, pool.map(one, sources)))
@@ -0,0 +1,118 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+
+# Index of published frames, maintained by the pipeline and read by the web
+# service instead of scanning the radar directory on every request.
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+# held while the manifest is read, changed and replaced, so the pipeline
+# and a backfill running side by side do not drop each other's frames
+LOCK_NAME = ".manifest.lock"
+
+
+def manifest_path(radar_dir):
+    return os.path.join(radar_dir, MANIFEST_NAME)
+
+
+def scan_frames(radar_dir):
+    """Frame entries for every ``<timestamp>`` directory, oldest first."""
+    frames = []
+    for name in os.listdir(radar_dir):
+        if name.isdigit() and os.path.isdir(os.path.join(radar_dir, name)):
+            frames.append({"time": int(name), "path": f"/radar/{name}"})
+    frames.sort(key=lambda f: f["time"])
+    return frames
+
+
+def read_manifest(radar_dir):
+    """Frame entries of the manifest, or None if there is no manifest yet."""
+    try:
+        with open(manifest_path(radar_dir), "r", encoding="utf-8") as f:
+            return json.load(f)["frames"]
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(radar_dir, frames):
+    # write-then-rename: readers see either the old or the new manifest
+    path = manifest_path(radar_dir)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "frames": frames}, f)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def _locked(radar_dir):
+    os.makedirs(radar_dir, exist_ok=True)
+    with open(os.path.join(radar_dir, LOCK_NAME), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def add_frame(radar_dir, entry):
+    """
+    Record a published frame. The first call seeds the manifest from the
+    frame directories already on disk so older frames stay listed.
+    """
+    return add_frames(radar_dir, [entry])
+
+
+def add_frames(radar_dir, entries):
+    with _locked(radar_dir):
+        frames = read_manifest(radar_dir)
+        if frames is None:
+            frames = scan_frames(radar_dir)
+        times = {e["time"] for e in entries}
+        frames = [f for f in frames if f["time"] not in times]
+        frames.extend(entries)
+        frames.sort(key=lambda f: f["time"])
+        write_manifest(radar_dir, frames)
+    return frames
+
+
+def remove_frames(radar_dir, times):
+    """
+    Drop frames from the manifest, before their directories go away.
+    Returns the removed entries; frames the manifest did not list get a
+    minimal entry.
+    """
+    times = set(times)
+    with _locked(radar_dir):
+        frames = read_manifest(radar_dir)
+        if frames is None:
+            frames = scan_frames(radar_dir)
+        listed = {f["time"]: f for f in frames if f["time"] in times}
+        write_manifest(radar_dir, [f for f in frames if f["time"] not in times])
+    return [listed.get(t, {"time": t, "path": f"/radar/{t}"}) for t in sorted(times)]
+
+
+class ManifestCache:
+    """
+    Parsed manifest kept in memory; the file is re-read only when its
+    modification time changes.
+    """
+
+    def __init__(self, radar_dir):
+        self.radar_dir = radar_dir
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._frames = None
+        self._times = []
+
+    def get(self):
+        """(frames, times) sorted by time, or (None, None) without a manifest."""
+        try:
+            mtime = os.stat(manifest_path(self.radar_dir)).st_mtime_ns
+        except FileNotFoundError:
+            return None, None
+        with self._lock:
+            if mtime != self._mtime:
+                frames = read_manifest(self.radar_dir) or []
+                self._frames = frames
+                self._times = [f["time"] for f in frames]
+                self._mtime = mtime
+            return self._frames, self._times
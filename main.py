@@ -1,11 +1,61 @@
 import os
+import math
 import time
-from fastapi import FastAPI
+import bisect
+import hashlib
+import struct
+import threading
+from collections import OrderedDict
+from typing import Optional
+from fastapi import FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import JSONResponse, Response
 from PIL import Image
+import numpy as np
 import io
 from fastapi.responses import HTMLResponse
+from frames import ManifestCache, scan_frames
+from tile_archive import open_archive
+from cog_tiles import open_cog
+from rain_grid import GridStack
+import tile_codec
+import palettes
+import metrics
+
+RADAR_DIR = os.environ.get("RADAR_DIR", "/app/radar")
+TILE_CACHE_BYTES = int(os.environ.get("TILE_CACHE_MB", "128")) * 1024 * 1024
+# written by the pipeline as the last entry of a frame, so its presence
+# means the frame is complete and will not change any more
+FRAME_INDEX = "tile_hashes.json"
+IMMUTABLE = "public, max-age=31536000, immutable"
+# state file the pipeline writes after every cycle (--metrics_file)
+PIPELINE_METRICS = os.environ.get("PIPELINE_METRICS", "/app/cache/metrics.json")
+# also save tiles rendered from a frame's COG as radar/<timestamp>/{z}/{x}/{y}.<ext>
+# so they survive restarts and are removed with the frame
+COG_DISK_CACHE = os.environ.get("COG_DISK_CACHE", "0") == "1"
+# time stacks: every frame of one tile in one response, for animation
+STACK_CACHE_BYTES = int(os.environ.get("STACK_CACHE_MB", "64")) * 1024 * 1024
+STACK_MAX_FRAMES = int(os.environ.get("STACK_MAX_FRAMES", "72"))
+# bundle layout, little-endian: magic, version, frame count, then per frame
+# its time, flags, length and the tile bytes (length 0 where it is missing)
+STACK_MAGIC = b"RSTK"
+STACK_VERSION = 1
+STACK_HEADER = struct.Struct("<4sHH")
+STACK_FRAME = struct.Struct("<IBI")
+STACK_PRESENT = 1
+STACK_WEBP = 2
+STACK_CACHE_CONTROL = "public, max-age=60"
+# zoom range of frames the manifest does not describe (pipeline defaults)
+TILE_ZMIN = int(os.environ.get("TILE_ZMIN", "5"))
+TILE_ZMAX = int(os.environ.get("TILE_ZMAX", "11"))
+# tiles past a frame's zoom range are synthesized from the nearest level it
+# has: cropped and upscaled from the parent, or decimated from the children
+MAX_OVERZOOM = 8
+MAX_UNDERZOOM = 2
+SYNTH_CACHE_BYTES = int(os.environ.get("SYNTH_CACHE_MB", "64")) * 1024 * 1024
+# keep the stacked rain grids of /api/v1/point and /api/v1/area in this
+# memory-mapped file instead of the heap
+GRID_STACK_FILE = os.environ.get("GRID_STACK_FILE") or None
 
 app = FastAPI()
 app.add_middleware(
@@ -14,6 +64,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Radar-Frames", "X-Radar-Missing"],
 )
 
 # ลบการ mount static files
@@ -38,60 +89,639 @@ def create_empty_tile():
     return img_byte_arr.getvalue()
 
 
+def make_etag(data):
+    return '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+
+
+EMPTY_TILE = create_empty_tile()
+EMPTY_TILE_ETAG = make_etag(EMPTY_TILE)
+
+
+class TileCache:
+    """Bounded LRU of encoded tiles keyed by (timestamp, z, x, y)."""
+
+    # accounting size of an entry that records "no tile here"
+    MISSING_SIZE = 64
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.empty = 0
+        self.not_modified = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, data, etag, size=None):
+        if size is None:
+            size = len(data) if data is not None else self.MISSING_SIZE
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (data, etag, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+
+    def record(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "empty_tiles": self.empty,
+                "not_modified": self.not_modified,
+            }
+
+
+tile_cache = TileCache(TILE_CACHE_BYTES)
+stack_cache = TileCache(STACK_CACHE_BYTES)
+synth_cache = TileCache(SYNTH_CACHE_BYTES)
+
+
+def frame_is_published(timestamp):
+    return os.path.exists(os.path.join(RADAR_DIR, timestamp, FRAME_INDEX))
+
+
+class ArchiveCache:
+    """
+    Open readers of recently requested frames: memory-mapped tiles.pack
+    archives by default, or whatever ``opener(frame_dir)`` returns.
+    """
+
+    def __init__(self, max_open=64, opener=open_archive):
+        self.max_open = max_open
+        self.opener = opener
+        self._archives = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, timestamp):
+        with self._lock:
+            if timestamp in self._archives:
+                self._archives.move_to_end(timestamp)
+                return self._archives[timestamp]
+        try:
+            archive = self.opener(os.path.join(RADAR_DIR, timestamp))
+        except (OSError, ValueError):
+            archive = None
+        if archive is None and not frame_is_published(timestamp):
+            # frame may still be published later, do not remember the miss
+            return None
+        with self._lock:
+            self._archives[timestamp] = archive
+            while len(self._archives) > self.max_open:
+                self._archives.popitem(last=False)
+        return archive
+
+
+archive_caches = {
+    "png": ArchiveCache(),
+    "webp": ArchiveCache(opener=lambda frame_dir: open_archive(frame_dir, "webp")),
+}
+cog_cache = ArchiveCache(max_open=16, opener=open_cog)
+manifest_cache = ManifestCache(RADAR_DIR)
+tile_metrics = metrics.TileMetrics()
+grid_stack = GridStack(RADAR_DIR, GRID_STACK_FILE)
+
+
+def read_tile(timestamp, zoom, x, y, encoding="png"):
+    tile_path = f"{RADAR_DIR}/{timestamp}/{zoom}/{x}/{y}.{encoding}"
+    try:
+        with open(tile_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def render_tile(timestamp, zoom, x, y, encoding="png"):
+    """Render a tile from the frame's COG, or None if it has none or no data there."""
+    cog = cog_cache.get(timestamp)
+    if cog is None:
+        return None
+    data = cog.tile_bytes(int(zoom), int(x), int(y), encoding)
+    if data is not None and COG_DISK_CACHE:
+        tile_path = f"{RADAR_DIR}/{timestamp}/{zoom}/{x}/{y}.{encoding}"
+        try:
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            tmp = f"{tile_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, tile_path)
+        except OSError:
+            pass
+    return data
+
+
+def etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
 @app.get("/radar/{timestamp}/{zoom}/{x}/{y}.png")
-def serve_tile(timestamp: str, zoom: str, x: str, y: str):
-    radar_dir = "/app/radar"
-    tile_path = f"{radar_dir}/{timestamp}/{zoom}/{x}/{y}.png"
-    if os.path.exists(tile_path):
-        return FileResponse(
-            tile_path,
-            media_type="image/png",
-            headers={"Cache-Control": "public, max-age=3600"}
-        )
+@app.get("/radar/{timestamp}/{zoom}/{x}/{y}.webp")
+def serve_tile(request: Request, timestamp: str, zoom: str, x: str, y: str,
+               palette: Optional[str] = None):
+    started = time.perf_counter()
+    ext = request.url.path.rsplit(".", 1)[-1]
+    response, result = tile_response(request, timestamp, zoom, x, y, ext, palette)
+    tile_metrics.observe(
+        zoom, result, time.perf_counter() - started, len(response.body)
+    )
+    return response
+
+
+def find_tile(timestamp, zoom, x, y, encoding):
+    """
+    (data, etag, cache_control, rendered) of one tile in one encoding; data
+    is None where the frame has no such tile.
+    """
+    archive = archive_caches[encoding].get(timestamp)
+    if archive is not None:
+        # served straight from the mapping; no copy and no LRU entry needed
+        tile = (int(zoom), int(x), int(y))
+        data = archive.get(*tile)
+        if data is None:
+            return synthesize_tile(timestamp, zoom, x, y, encoding)
+        return data, '"' + archive.digest(*tile).hex() + '"', IMMUTABLE, False
+
+    key = (timestamp, zoom, x, y, encoding)
+    entry = tile_cache.get(key)
+    if entry is not None:
+        data, etag, _ = entry
+        if data is None:
+            # a remembered miss of a complete frame
+            return synthesize_tile(timestamp, zoom, x, y, encoding)
+        return data, etag, IMMUTABLE, False
+
+    data = read_tile(timestamp, zoom, x, y, encoding)
+    rendered = False
+    if data is None:
+        data = render_tile(timestamp, zoom, x, y, encoding)
+        rendered = data is not None
+    if data is not None:
+        etag = make_etag(data)
+        tile_cache.put(key, data, etag)
+        return data, etag, IMMUTABLE, rendered
+    if frame_is_published(timestamp):
+        # a complete frame never gains tiles: remember the miss
+        tile_cache.put(key, None, EMPTY_TILE_ETAG)
+        return synthesize_tile(timestamp, zoom, x, y, encoding)
+    return None, EMPTY_TILE_ETAG, "public, max-age=300", False
+
+
+def manifest_entry(timestamp):
+    """The manifest's entry of a frame, or {} if it is not listed."""
+    frames, times = manifest_cache.get()
+    if frames is not None:
+        i = bisect.bisect_left(times, int(timestamp))
+        if i < len(times) and times[i] == int(timestamp):
+            return frames[i]
+    return {}
+
+
+def frame_zoom_range(timestamp):
+    """(zmin, zmax) of a frame's pre-rendered tiles; None for COG frames."""
+    entry = manifest_entry(timestamp)
+    if entry.get("format") == "cog" or (not entry and cog_cache.get(timestamp)):
+        # COG frames render every zoom themselves
+        return None
+    return entry.get("zmin", TILE_ZMIN), entry.get("zmax", TILE_ZMAX)
+
+
+def decode_tile(timestamp, zoom, x, y, levels=False):
+    """
+    (array, palette) of an existing tile in any encoding, or None: RGBA and
+    no palette, or for frames of levels the levels of its PNG and the
+    frame's palette.
+    """
+    for encoding in ("png",) if levels else ("png", "webp"):
+        data = find_tile(timestamp, str(zoom), str(x), str(y), encoding)[0]
+        if data is None:
+            continue
+        img = Image.open(io.BytesIO(data))
+        palette = tile_codec.png_palette(data) if levels else None
+        if palette is not None:
+            return np.asarray(img), palette
+        return np.asarray(img.convert("RGBA")), None
+    return None
+
+
+def has_coverage(tile):
+    # levels use 0 as no-data, RGBA tiles their alpha
+    return (tile if tile.ndim == 2 else tile[:, :, 3]).any()
+
+
+def overzoom_tile(timestamp, zoom, x, y, zmax, levels=False):
+    # crop the ancestor at zmax and repeat its pixels; TMS rows count from
+    # the south, image rows from the north
+    d = zoom - zmax
+    decoded = decode_tile(timestamp, zmax, x >> d, y >> d, levels)
+    if decoded is None:
+        return None
+    parent, palette = decoded
+    size = 256 >> d
+    col = (x - ((x >> d) << d)) * size
+    row = ((((y >> d) + 1) << d) - 1 - y) * size
+    crop = parent[row : row + size, col : col + size]
+    if not has_coverage(crop):
+        return None
+    return crop.repeat(1 << d, axis=0).repeat(1 << d, axis=1), palette
+
+
+def underzoom_tile(timestamp, zoom, x, y, zmin, levels=False):
+    # every (1 << d)-th pixel of each descendant at zmin, like the
+    # pipeline's nearest resampling
+    d = zmin - zoom
+    n = 1 << d
+    size = 256 >> d
+    tile = palette = None
+    for i in range(n):
+        for j in range(n):
+            decoded = decode_tile(timestamp, zmin, (x << d) + i, (y << d) + j, levels)
+            if decoded is None:
+                continue
+            child, palette = decoded
+            if tile is None:
+                tile = np.zeros((256, 256) + child.shape[2:], dtype=np.uint8)
+            row = (n - 1 - j) * size
+            tile[row : row + size, i * size : (i + 1) * size] = child[::n, ::n]
+    if tile is None or not has_coverage(tile):
+        return None
+    return tile, palette
+
+
+def synthesize_tile(timestamp, zoom, x, y, encoding):
+    """
+    find_tile result for a tile outside the frame's zoom range, built from
+    the nearest zoom it has and kept in synth_cache.
+    """
+    missing = None, EMPTY_TILE_ETAG, IMMUTABLE, False
+    zoom_range = frame_zoom_range(timestamp)
+    if zoom_range is None:
+        return missing
+    zmin, zmax = zoom_range
+    z, x, y = int(zoom), int(x), int(y)
+    if not (zmax < z <= zmax + MAX_OVERZOOM or zmin - MAX_UNDERZOOM <= z < zmin):
+        return missing
+
+    key = (timestamp, zoom, str(x), str(y), encoding)
+    entry = synth_cache.get(key)
+    if entry is None:
+        # tiles of level frames stay levels, so their palette can be swapped
+        levels = "levels" in manifest_entry(timestamp)
+        if z > zmax:
+            tile = overzoom_tile(timestamp, z, x, y, zmax, levels)
+        else:
+            tile = underzoom_tile(timestamp, z, x, y, zmin, levels)
+        data = None if tile is None else tile_codec.encode(tile[0], encoding, tile[1])
+        entry = (data, EMPTY_TILE_ETAG if data is None else make_etag(data), 0)
+        synth_cache.put(key, *entry[:2])
+    data, etag, _ = entry
+    return data, etag, IMMUTABLE, data is not None
+
+
+def negotiate_tile(request, timestamp, zoom, x, y, ext="png"):
+    """find_tile in the best encoding the frame has, plus that encoding."""
+    # WebP when the URL or the Accept header asks for it and the frame has
+    # it, PNG otherwise
+    encodings = ["png"]
+    if ext == "webp" or tile_codec.accepts(request.headers.get("accept"), "webp"):
+        encodings.insert(0, "webp")
+    for encoding in encodings:
+        data, etag, cache_control, rendered = find_tile(timestamp, zoom, x, y, encoding)
+        if data is not None:
+            break
+    return data, etag, cache_control, rendered, encoding
+
+
+def recolor_tile(timestamp, zoom, x, y, palette, levels):
+    """
+    find_tile result of a frame of ``levels`` levels with its PNG recoloured
+    to heatmap ramp ``palette``: only the PLTE and tRNS chunks are rewritten.
+    """
+    data, etag, cache_control, rendered = find_tile(timestamp, zoom, x, y, "png")
+    swapped = None
+    if data is not None:
+        swapped = tile_codec.swap_palette(data, palettes.ramp_palette(palette, levels))
+    if swapped is None:
+        return data, etag, cache_control, rendered
+    return swapped, etag[:-1] + f'-{palette}"', cache_control, rendered
+
+
+def tile_response(request, timestamp, zoom, x, y, ext="png", palette=None):
+    """(Response, result) for one tile request; result labels the metrics."""
+    if not (timestamp.isdigit() and zoom.isdigit() and x.isdigit() and y.isdigit()
+            and palette in (None,) + palettes.PALETTES):
+        response = Response(content=EMPTY_TILE, media_type="image/png", status_code=404)
+        return response, "invalid"
+
+    # frames of levels can be recoloured to another ramp on request
+    entry = manifest_entry(timestamp) if palette in palettes.HEATMAP_RAMPS else {}
+    if "levels" in entry and palette != entry.get("palette"):
+        data, etag, cache_control, rendered = recolor_tile(
+            timestamp, zoom, x, y, palette, entry["levels"])
+        encoding = "png"
+    else:
+        data, etag, cache_control, rendered, encoding = negotiate_tile(
+            request, timestamp, zoom, x, y, ext)
+
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept"}
+    if etag_matches(request, etag):
+        tile_cache.record("not_modified")
+        return Response(status_code=304, headers=headers), "not_modified"
+    if data is None:
+        tile_cache.record("empty")
+        response = Response(content=EMPTY_TILE, media_type="image/png", headers=headers)
+        return response, "empty"
+    media_type = tile_codec.MEDIA_TYPES[encoding]
+    response = Response(content=data, media_type=media_type, headers=headers)
+    return response, "rendered" if rendered else "tile"
+
+
+def select_frames(frames, times, start, end, limit):
+    """Frames with start <= time <= end, the most recent ``limit`` of them."""
+    lo = bisect.bisect_left(times, start)
+    hi = len(times) if end is None else bisect.bisect_right(times, end)
+    selected = frames[lo:hi]
+    if limit is not None and limit >= 0:
+        # keep the most recent frames
+        selected = selected[-limit:] if limit else []
+    return selected
+
+
+def build_stack(request, times, zoom, x, y, sprite):
+    """
+    (content, etag, media_type, missing) of tile z/x/y over ``times``: a
+    bundle, or a vertical sprite sheet with one 256 px row per frame.
+    Built from the per-frame tiles and kept in ``stack_cache`` once every
+    frame is complete.
+    """
+    webp = tile_codec.accepts(request.headers.get("accept"), "webp")
+    key = (zoom, x, y, tuple(times), sprite, webp)
+    entry = stack_cache.get(key)
+    if entry is not None:
+        (content, media_type, missing), etag, _ = entry
+        return content, etag, media_type, missing
+
+    tiles = []
+    final = True
+    for t in times:
+        data, _, cache_control, _, encoding = negotiate_tile(
+            request, str(t), zoom, x, y, "webp" if webp else "png")
+        tiles.append((t, data, encoding))
+        final = final and cache_control == IMMUTABLE
+    missing = [t for t, data, _ in tiles if data is None]
+
+    if sprite and not tiles:
+        # no frames in range: no sheet either
+        content = b""
+        media_type = tile_codec.MEDIA_TYPES["webp" if webp else "png"]
+    elif sprite:
+        sheet = Image.new("RGBA", (256, 256 * len(tiles)))
+        for i, (_, data, _) in enumerate(tiles):
+            if data is not None:
+                sheet.paste(Image.open(io.BytesIO(data)).convert("RGBA"), (0, 256 * i))
+        # taller sheets than WebP can hold stay PNG
+        fits = sheet.height <= tile_codec.WEBP_MAX_SIZE
+        encoding = "webp" if webp and fits else "png"
+        content = tile_codec.encode(np.asarray(sheet), encoding)
+        media_type = tile_codec.MEDIA_TYPES[encoding]
     else:
-        empty_tile = create_empty_tile()
-        return Response(
-            content=empty_tile,
-            media_type="image/png",
-            headers={"Cache-Control": "public, max-age=300"}
-        )
+        parts = [STACK_HEADER.pack(STACK_MAGIC, STACK_VERSION, len(tiles))]
+        for t, data, encoding in tiles:
+            if data is None:
+                parts.append(STACK_FRAME.pack(t, 0, 0))
+                continue
+            flags = STACK_PRESENT | (STACK_WEBP if encoding == "webp" else 0)
+            parts.append(STACK_FRAME.pack(t, flags, len(data)))
+            parts.append(data)
+        content = b"".join(parts)
+        media_type = "application/octet-stream"
+
+    etag = make_etag(content)
+    if final:
+        stack_cache.put(key, (content, media_type, missing), etag, len(content))
+    return content, etag, media_type, missing
+
+
+@app.get("/api/v1/stack/{zoom}/{x}/{y}.bin")
+@app.get("/api/v1/stack/{zoom}/{x}/{y}.png")
+def serve_stack(
+    request: Request,
+    zoom: str,
+    x: str,
+    y: str,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=0),
+):
+    """
+    Every frame of one tile between ``start`` and ``end`` (default: the
+    last 6 hours, as /api/v1/weather) in one response. The frame times are
+    listed in X-Radar-Frames and those without a tile in X-Radar-Missing.
+    A sprite of a range without frames is a 204.
+    """
+    if not (zoom.isdigit() and x.isdigit() and y.isdigit()):
+        return Response(status_code=404)
+    if start is None:
+        start = int(time.time()) - (6 * 60 * 60)
+    limit = STACK_MAX_FRAMES if limit is None else min(limit, STACK_MAX_FRAMES)
+
+    frames, times = manifest_cache.get()
+    if frames is None:
+        frames = scan_frames(RADAR_DIR)
+        times = [f["time"] for f in frames]
+    times = [f["time"] for f in select_frames(frames, times, start, end, limit)]
+
+    sprite = request.url.path.endswith(".png")
+    content, etag, media_type, missing = build_stack(request, times, zoom, x, y, sprite)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": STACK_CACHE_CONTROL,
+        "Vary": "Accept",
+        "X-Radar-Frames": ",".join(map(str, times)),
+        "X-Radar-Missing": ",".join(map(str, missing)),
+    }
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if not content:
+        return Response(status_code=204, headers=headers)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+def current_grids():
+    """grid_stack brought up to the frames currently listed."""
+    frames, times = manifest_cache.get()
+    if frames is None:
+        times = [f["time"] for f in scan_frames(RADAR_DIR)]
+    return grid_stack.update(times)
+
+
+def level_scales(times):
+    """
+    Scale of each frame's grid levels and its top value: "hue" ranks of
+    RGBA frames (radar_process.rain_intensity, up to 255) or "legend"
+    indices of level frames, up to the manifest's ``levels``.
+    """
+    scales, tops = [], []
+    for t in times:
+        count = manifest_entry(t).get("levels")
+        scales.append("legend" if count else "hue")
+        tops.append(count or 255)
+    return scales, tops
+
+
+def bad_query(message):
+    return JSONResponse(status_code=400, content={"error": message})
+
+
+@app.get("/api/v1/point")
+def get_point(
+    lat: float,
+    lon: float,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+):
+    """
+    Rain level at one location for every frame, oldest first (0 = no rain),
+    with the scale of each frame's levels.
+    """
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return bad_query("lat/lon out of range")
+    times, levels = current_grids().point(lon, lat, start, end)
+    times = times.tolist()
+    scales, tops = level_scales(times)
+    return {
+        "version": "1.0",
+        "lat": lat,
+        "lon": lon,
+        "times": times,
+        "level": levels.tolist(),
+        "scale": scales,
+        "scale_max": tops,
+    }
+
+
+@app.get("/api/v1/area")
+def get_area(
+    bbox: str,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+):
+    """
+    Rain over ``bbox=west,south,east,north`` for every frame: the strongest
+    level, the mean level where it rains and the share of the area with rain.
+    Levels are on each frame's scale, as in /api/v1/point.
+    """
+    try:
+        west, south, east, north = (float(v) for v in bbox.split(","))
+    except ValueError:
+        return bad_query("bbox must be west,south,east,north")
+    if not all(map(math.isfinite, (west, south, east, north))):
+        return bad_query("bbox must be finite")
+    if west > east or south > north:
+        return bad_query("bbox must be west,south,east,north")
+    times, stats = current_grids().area(west, south, east, north, start, end)
+    times = times.tolist()
+    scales, tops = level_scales(times)
+    return {
+        "version": "1.0",
+        "bbox": [west, south, east, north],
+        "cells": stats["cells"],
+        "times": times,
+        "scale": scales,
+        "scale_max": tops,
+        "max": stats["max"].tolist(),
+        "mean": stats["mean"].round(2).tolist(),
+        "coverage": stats["coverage"].round(4).tolist(),
+    }
+
+
+@app.get("/api/v1/tiles/stats")
+def get_tile_stats():
+    stats = tile_cache.stats()
+    stats["stacks"] = stack_cache.stats()
+    stats["synthesized"] = synth_cache.stats()
+    return stats
+
+
+@app.get("/metrics")
+def get_metrics():
+    lines = []
+    tile_metrics.render(lines)
+
+    stats = tile_cache.stats()
+    metrics.metric(lines, "radar_tile_cache_lookups_total", "counter",
+                   "Tile LRU lookups by outcome",
+                   [({"outcome": "hit"}, stats["hits"]),
+                    ({"outcome": "miss"}, stats["misses"])])
+    metrics.metric(lines, "radar_tile_cache_bytes", "gauge",
+                   "Bytes held in the tile LRU", [({}, stats["bytes"])])
+    metrics.metric(lines, "radar_tile_cache_entries", "gauge",
+                   "Entries in the tile LRU", [({}, stats["entries"])])
+
+    metrics.pipeline_metrics(lines, metrics.read_state(PIPELINE_METRICS))
+    return Response(content="\n".join(lines) + "\n", media_type=metrics.CONTENT_TYPE)
 
 
 @app.get("/api/v1/weather")
-def get_weather_data():
+def get_weather_data(
+    request: Request,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    limit: Optional[int] = None,
+):
 
-    radar_dir = "/app/radar"
+    radar_dir = RADAR_DIR
 
     if not os.path.exists(radar_dir):
         return {"error": "Radar directory not found"}
 
     current_time = int(time.time())
-    six_hours_ago = current_time - (6 * 60 * 60)  # Exclude data older than 6h
-    radar_folders = []
-    try:
-        for folder_name in os.listdir(radar_dir):
-            folder_path = os.path.join(radar_dir, folder_name)
-            if os.path.isdir(folder_path) and folder_name.isdigit():
-                timestamp = int(folder_name)
-                # Include only folders within the last 6 hours
-                if timestamp >= six_hours_ago:
-                    radar_folders.append(timestamp)
-    except Exception as e:
-        return {"error": f"Failed to read radar directory: {str(e)}"}
-
-    radar_folders.sort()
-
-    past_data = []
-    for timestamp in radar_folders:
-        past_data.append({
-            "time": timestamp,
-            "path": f"/radar/{timestamp}"
-        })
+    if start is None:
+        start = current_time - (6 * 60 * 60)  # Exclude data older than 6h
+
+    frames, times = manifest_cache.get()
+    if frames is None:
+        # no manifest yet (frames published before the pipeline wrote one)
+        try:
+            frames = scan_frames(radar_dir)
+        except Exception as e:
+            return {"error": f"Failed to read radar directory: {str(e)}"}
+        times = [f["time"] for f in frames]
+
+    past_data = select_frames(frames, times, start, end, limit)
 
     response = {
         "version": "1.0",
         "generated": current_time,
-        "host": "http://localhost:8000",
+        "host": str(request.base_url).rstrip("/"),
         "radar": {
             "past": past_data
         }
@@ -0,0 +1,275 @@
+import json
+import math
+import os
+import threading
+import time
+
+# The pipeline and the web service are separate processes. After every cycle
+# the pipeline rewrites a small JSON state file; the web service reads it
+# when /metrics is scraped and exports it next to its own tile counters.
+STATE_NAME = "metrics.json"
+# tile latency histogram buckets, seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def state_path(cache_dir):
+    return os.path.join(cache_dir, STATE_NAME)
+
+
+def read_state(path):
+    """Pipeline state, or None if the pipeline has not written one yet."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_state(path, state):
+    # write-then-rename: a scrape never sees a half-written file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def record_cycle(path, cycle):
+    """
+    Fold one cycle into the state file. ``cycle`` holds the slot
+    ``timestamp``, ``result`` ("ok"/"failed"), ``seconds``, per-stage
+    ``stages`` seconds and per-station ``stations`` measurements; a
+    ``published`` frame timestamp marks a successful publish.
+    """
+    state = read_state(path) or {}
+    counts = state.setdefault("cycles", {"ok": 0, "failed": 0})
+    counts[cycle["result"]] = counts.get(cycle["result"], 0) + 1
+    state["last_cycle"] = cycle
+    if cycle["result"] == "ok":
+        state["last_success"] = cycle["finished"]
+    if cycle.get("published") is not None:
+        state["last_frame"] = cycle["published"]
+    write_state(path, state)
+    return state
+
+
+# ---------------- Exposition ----------------
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def metric(lines, name, kind, help_text, samples):
+    """
+    Append one metric family in the Prometheus text format. ``samples`` is a
+    list of ``(labels, value)`` or ``(suffix, labels, value)`` tuples.
+    """
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ("", *sample)
+        label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        label_text = "{" + label_text + "}" if label_text else ""
+        lines.append(f"{name}{suffix}{label_text} {_number(value)}")
+
+
+def pipeline_metrics(lines, state, now=None):
+    """Metrics of the last pipeline cycles, from the state file."""
+    now = time.time() if now is None else now
+    metric(
+        lines,
+        "radar_pipeline_state_present",
+        "gauge",
+        "1 if the pipeline has written its metrics state file",
+        [({}, int(state is not None))],
+    )
+    if state is None:
+        return
+
+    cycle = state.get("last_cycle", {})
+    metric(
+        lines,
+        "radar_pipeline_cycles_total",
+        "counter",
+        "Pipeline cycles by result",
+        [({"result": k}, v) for k, v in sorted(state.get("cycles", {}).items())],
+    )
+    if "last_success" in state:
+        metric(
+            lines,
+            "radar_pipeline_last_success_timestamp_seconds",
+            "gauge",
+            "Unix time the last successful cycle finished",
+            [({}, state["last_success"])],
+        )
+    if "last_frame" in state:
+        metric(
+            lines,
+            "radar_pipeline_last_frame_timestamp_seconds",
+            "gauge",
+            "Slot timestamp of the newest published frame",
+            [({}, state["last_frame"])],
+        )
+        metric(
+            lines,
+            "radar_pipeline_frame_age_seconds",
+            "gauge",
+            "Age of the newest published frame",
+            [({}, now - state["last_frame"])],
+        )
+    if not cycle:
+        return
+
+    metric(
+        lines,
+        "radar_pipeline_cycle_duration_seconds",
+        "gauge",
+        "Duration of the last cycle",
+        [({}, cycle["seconds"])],
+    )
+    metric(
+        lines,
+        "radar_pipeline_last_cycle_success",
+        "gauge",
+        "1 if the last cycle succeeded",
+        [({}, int(cycle["result"] == "ok"))],
+    )
+    metric(
+        lines,
+        "radar_pipeline_stage_duration_seconds",
+        "gauge",
+        "Duration of each stage of the last cycle",
+        [({"stage": k}, v) for k, v in cycle.get("stages", {}).items()],
+    )
+    stations = sorted(cycle.get("stations", {}).items())
+    metric(
+        lines,
+        "radar_pipeline_station_up",
+        "gauge",
+        "1 if the station was processed in the last cycle",
+        [({"station": name}, int(s["ok"])) for name, s in stations],
+    )
+    metric(
+        lines,
+        "radar_pipeline_station_reused",
+        "gauge",
+        "1 if the station's image was unchanged and its output reused",
+        [({"station": name}, int(s.get("reused", False))) for name, s in stations],
+    )
+    metric(
+        lines,
+        "radar_pipeline_station_not_modified",
+        "gauge",
+        "1 if the station's server answered 304 Not Modified",
+        [
+            ({"station": name}, int(s["not_modified"]))
+            for name, s in stations
+            if "not_modified" in s
+        ],
+    )
+    metric(
+        lines,
+        "radar_pipeline_station_duration_seconds",
+        "gauge",
+        "Time spent on each station in the last cycle, by step",
+        [({"station": name, "step": "total"}, s["seconds"]) for name, s in stations]
+        + [
+            ({"station": name, "step": step}, seconds)
+            for name, s in stations
+            for step, seconds in s.get("stages", {}).items()
+        ],
+    )
+    metric(
+        lines,
+        "radar_pipeline_download_bytes",
+        "gauge",
+        "Size of each station's source image in the last cycle",
+        [({"station": name}, s["bytes"]) for name, s in stations if "bytes" in s],
+    )
+    if "tiles" in cycle:
+        metric(
+            lines,
+            "radar_pipeline_tiles",
+            "gauge",
+            "Tiles in the last frame, and how many were unchanged",
+            [({"kind": k}, v) for k, v in cycle["tiles"].items()],
+        )
+
+
+class TileMetrics:
+    """Request counters and latency histograms of the tile endpoint."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._bytes = {}
+        self._latency = {}
+
+    def observe(self, zoom, result, seconds, nbytes):
+        """
+        Count one request. ``result`` is "tile", "rendered" (first request of
+        a tile rendered from a COG, or synthesized outside the frame's zoom
+        range), "empty", "not_modified" or "invalid";
+        ``nbytes`` is the size of the response body.
+        """
+        zoom = str(zoom) if str(zoom).isdigit() and int(zoom) <= 30 else "other"
+        with self._lock:
+            key = (zoom, result)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._bytes[zoom] = self._bytes.get(zoom, 0) + nbytes
+            hist = self._latency.get(zoom)
+            if hist is None:
+                hist = self._latency[zoom] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[0][i] += 1
+            hist[1] += 1
+            hist[2] += seconds
+
+    def render(self, lines):
+        with self._lock:
+            requests = sorted(self._requests.items())
+            sent = sorted(self._bytes.items())
+            latency = sorted(
+                (z, ([*h[0]], h[1], h[2])) for z, h in self._latency.items()
+            )
+        metric(
+            lines,
+            "radar_tile_requests_total",
+            "counter",
+            "Tile requests by zoom and result "
+            "(tile, rendered, empty, not_modified, invalid)",
+            [({"zoom": z, "result": r}, n) for (z, r), n in requests],
+        )
+        metric(
+            lines,
+            "radar_tile_response_bytes_total",
+            "counter",
+            "Tile response body bytes served, by zoom",
+            [({"zoom": z}, n) for z, n in sent],
+        )
+        samples = []
+        for zoom, (counts, count, total) in latency:
+            for bound, n in zip(self.buckets, counts):
+                samples.append(("_bucket", {"zoom": zoom, "le": repr(bound)}, n))
+            samples.append(("_bucket", {"zoom": zoom, "le": "+Inf"}, count))
+            samples.append(("_sum", {"zoom": zoom}, total))
+            samples.append(("_count", {"zoom": zoom}, count))
+        metric(
+            lines,
+            "radar_tile_request_duration_seconds",
+            "histogram",
+            "Time to answer a tile request, by zoom",
+            samples,
+        )
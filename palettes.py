@@ -0,0 +1,79 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Colour tables. Level frames (pipeline.py --levels) hold one uint8 level
+# per pixel instead of RGBA: 0 is no echo and level i is the i-th colour of
+# the station's legend, weakest first (see calibrate.py). They are only
+# colourized when tiles are encoded, with a palette of levels + 1 RGBA
+# entries, so the colour scheme can change without reprocessing. "legend"
+# gives back the radar's own colours; the heatmap ramps spread their colours
+# evenly over the levels.
+LEGEND = "legend"
+
+# colour stops of the heatmap ramps, evenly spaced from intensity 0 to 1
+HEATMAP_RAMPS = {
+    "rain_soft": [
+        (0.0, 0.0, 0.0, 0.0),
+        (0.80, 1.00, 0.80, 0.6),
+        (0.00, 0.85, 0.00, 0.8),
+        (0.90, 0.90, 0.00, 0.9),
+        (1.00, 0.60, 0.10, 0.95),
+    ],
+    "rain_green_soft": [
+        (0.0, 0.0, 0.0, 0.0),
+        (0.85, 1.0, 0.85, 0.6),
+        (0.5, 0.9, 0.5, 0.85),
+        (0.0, 0.75, 0.0, 1.0),
+    ],
+}
+PALETTES = (LEGEND,) + tuple(HEATMAP_RAMPS)
+
+
+@lru_cache(maxsize=None)
+def heatmap_lut(name="rain_soft", n=512):
+    """
+    ``n`` RGBA entries (float32, 0..1) sampled linearly between the ramp's
+    stops, the same table matplotlib's ``LinearSegmentedColormap.from_list``
+    builds.
+    """
+    stops = np.asarray(HEATMAP_RAMPS[name], dtype=np.float64)
+    x = np.linspace(0.0, 1.0, len(stops))
+    at = np.linspace(0.0, 1.0, n)
+    lut = np.stack([np.interp(at, x, stops[:, c]) for c in range(4)], axis=1)
+    lut = lut.astype(np.float32)
+    lut.flags.writeable = False
+    return lut
+
+
+def legend_rgb(legend):
+    """Nx3 uint8 RGB of a legend's ``#rrggbb`` colours."""
+    return np.array(
+        [[int(c[i : i + 2], 16) for i in (1, 3, 5)] for c in legend], dtype=np.uint8
+    ).reshape(-1, 3)
+
+
+def legend_palette(legend):
+    """Palette of a legend: transparent, then its colours, opaque."""
+    palette = np.zeros((len(legend) + 1, 4), dtype=np.uint8)
+    palette[1:, :3] = legend_rgb(legend)
+    palette[1:, 3] = 255
+    return palette
+
+
+def ramp_palette(name, levels):
+    """Palette of ``levels`` levels spread over a heatmap ramp, 0 transparent."""
+    lut = heatmap_lut(name)
+    at = np.arange(1, levels + 1) * (len(lut) - 1) // max(levels, 1)
+    palette = np.zeros((levels + 1, 4), dtype=np.uint8)
+    palette[1:] = np.rint(lut[at] * 255)
+    return palette
+
+
+def level_palette(name, legend):
+    """Palette ``name`` (one of PALETTES) for levels decoded with ``legend``."""
+    if name == LEGEND:
+        return legend_palette(legend)
+    if name not in HEATMAP_RAMPS:
+        raise ValueError(f"Unknown palette '{name}'")
+    return ramp_palette(name, len(legend))
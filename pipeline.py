@@ -0,0 +1,731 @@
+import argparse
+import fcntl
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+import fetch
+import frames
+import metrics
+import palettes
+import rain_grid
+
+DEFAULT_CONFIG = "stations.json"
+# frames are labelled with the start of their 10-minute slot, like main.sh
+CYCLE_SECONDS = 600
+# processed station image in the station cache, HxWx4 RGBA (HxW levels
+# with --levels)
+STATION_RASTER = "station.npy"
+# "echoes": gap-repaired radar colours; "heatmap": soft colour-ramp rendering
+STYLES = ("echoes", "heatmap")
+# frames are built in <radar_dir>/.staging-<timestamp>, and retired frames
+# are renamed to .trash-<timestamp> before being deleted
+STAGING_PREFIX = ".staging-"
+TRASH_PREFIX = ".trash-"
+# default retention, the window /api/v1/weather lists by default
+RETENTION_HOURS = 6
+
+
+def load_stations(config_path, include_disabled=False):
+    """
+    Read the station config. Each station's ``mask``/``gaps``/``heatmap``
+    parameters are merged over the config-wide ``defaults``, and ``style``
+    and ``legend`` fall back to the default ones; relative template and
+    input paths are resolved against the config file's directory.
+    """
+    config_path = Path(config_path)
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    base = config_path.resolve().parent
+    defaults = config.get("defaults", {})
+    stations = []
+    for entry in config["stations"]:
+        if not entry.get("enabled", True) and not include_disabled:
+            continue
+        station = dict(entry)
+        for key in ("mask", "gaps", "heatmap"):
+            station[key] = {**defaults.get(key, {}), **entry.get(key, {})}
+        station["style"] = entry.get("style", defaults.get("style", "echoes"))
+        station["legend"] = entry.get("legend", defaults.get("legend"))
+        if station["style"] not in STYLES:
+            raise ValueError(f"{station['name']}: unknown style {station['style']!r}")
+        station["template"] = str(base / entry["template"])
+        if not fetch.is_url(entry["input"]):
+            station["input"] = str(base / entry["input"])
+        stations.append(station)
+    return stations
+
+
+def station_cache(cache_dir, station):
+    return Path(cache_dir) / "stations" / station["name"]
+
+
+def download_stations(
+    stations, cache_dir, timeout=fetch.TIMEOUT, retries=fetch.RETRIES
+):
+    """
+    Fetch every station's image concurrently (see fetch.py), conditionally
+    against the copy kept in the station cache. Returns ``{name: result}``.
+    """
+    return fetch.fetch_all(
+        {s["name"]: s["input"] for s in stations},
+        cache_dirs={s["name"]: station_cache(cache_dir, s) for s in stations},
+        timeout=timeout,
+        retries=retries,
+    )
+
+
+def station_key(station, data, levels=False):
+    # input image bytes plus everything that shapes the processed output
+    params = {k: station[k] for k in ("template", "mask", "gaps", "style")}
+    if levels:
+        params["legend"] = station["legend"]
+    elif station["style"] == "heatmap":
+        params["heatmap"] = station["heatmap"]
+    h = hashlib.sha256(data)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def process_station(
+    station, workdir, cache_dir, debug_dump=False, download=None, levels=False
+):
+    """
+    Mask, gap-repair (or render as a heatmap) and georeference one station.
+    With ``levels`` the image is decoded to legend levels instead (see
+    radar_process.render_station), which needs the station's ``legend``.
+    Runs in a pool worker and never raises: failures are reported in the
+    returned dict, which also carries the time spent per step and the
+    download size for the metrics. ``download`` is the station's result from
+    download_stations; without it the image is fetched here.
+
+    Everything happens in memory. The result is stored as a ``.npy`` array
+    in ``cache_dir/stations/<name>``, keyed by a hash of the input image and
+    parameters, and handed back by path so the parent can memory-map it
+    instead of receiving it through the pool. When TMD serves the same image
+    again the cached array is reused. ``debug_dump`` also writes the
+    intermediate images to ``workdir/<name>``.
+    """
+    import radar_process as rp
+
+    name = station["name"]
+    cached = station_cache(cache_dir, station)
+    started = time.monotonic()
+    result = {"name": name, "template": station["template"], "stages": {}}
+    try:
+        if download is None:
+            download = fetch.fetch(station["input"], cached)
+        data = download["data"]
+        result["bytes"] = len(data)
+        result["stages"]["download"] = download["seconds"]
+        result["not_modified"] = download["status"] == 304
+        if levels and not station.get("legend"):
+            raise ValueError("no legend to decode levels with (see calibrate.py)")
+        key = station_key(station, data, levels)
+
+        raster = cached / STATION_RASTER
+        key_file = cached / "key"
+        if key_file.exists() and key_file.read_text() == key and raster.exists():
+            result.update(ok=True, reused=True, raster=str(raster))
+            result["seconds"] = time.monotonic() - started
+            return result
+
+        rgba, _, _ = rp.render_station(
+            io.BytesIO(data),
+            station["template"],
+            mask=station["mask"],
+            gaps=station["gaps"],
+            style=station["style"],
+            heatmap=station["heatmap"],
+            legend=station["legend"] if levels else None,
+            cache_dir=cache_dir,
+            dump_dir=Path(workdir) / name if debug_dump else None,
+            timings=result["stages"],
+        )
+
+        cached.mkdir(parents=True, exist_ok=True)
+        tmp = cached / f"{STATION_RASTER}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, rgba)
+        os.replace(tmp, raster)
+        key_file.write_text(key)
+    except Exception as e:
+        result.update(ok=False, error=f"{type(e).__name__}: {e}")
+        result["seconds"] = time.monotonic() - started
+        return result
+    result.update(ok=True, reused=False, raster=str(raster))
+    result["seconds"] = time.monotonic() - started
+    return result
+
+
+def load_station_raster(result):
+    """(array, crs, transform) of a processed station, memory-mapped."""
+    import radar_process as rp
+
+    crs, transform, _, _ = rp.load_template(result["template"])
+    return np.load(result["raster"], mmap_mode="r"), crs, transform
+
+
+def run_stations(
+    stations,
+    workdir,
+    cache_dir,
+    processes=None,
+    timeout=240,
+    debug_dump=False,
+    downloads=None,
+    levels=False,
+):
+    """
+    Process all stations in parallel. Stations still running when ``timeout``
+    seconds have passed are reported as failed and their workers killed, so
+    one stuck worker or corrupt image cannot hold up the cycle.
+
+    With ``downloads`` from download_stations the workers get the images in
+    memory, and stations whose download failed are reported without being
+    processed.
+
+    Returns one result dict per station, in config order.
+    """
+    if not stations:
+        return []
+    processes = processes or len(stations)
+    deadline = time.monotonic() + timeout
+    results = []
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        pending = []
+        for s in stations:
+            download = downloads.get(s["name"]) if downloads is not None else None
+            if download is not None and "error" in download:
+                failed = {"name": s["name"], "ok": False, "error": download["error"]}
+                failed["seconds"] = download["seconds"]
+                failed["stages"] = {"download": download["seconds"]}
+                pending.append((s, failed))
+                continue
+            args = (s, workdir, cache_dir, debug_dump, download, levels)
+            pending.append((s, pool.apply_async(process_station, args)))
+        for station, res in pending:
+            if isinstance(res, dict):
+                results.append(res)
+                continue
+            try:
+                results.append(res.get(timeout=max(deadline - time.monotonic(), 0)))
+            except multiprocessing.TimeoutError:
+                results.append(
+                    {
+                        "name": station["name"],
+                        "ok": False,
+                        "error": f"timed out after {timeout}s",
+                        "seconds": timeout,
+                    }
+                )
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def report(results):
+    for r in results:
+        if r["ok"]:
+            note = ", unchanged" if r["reused"] else ""
+            print(f"[OK] {r['name']} ({r['seconds']:.1f}s{note}) → {r['raster']}")
+        else:
+            print(f"[FAIL] {r['name']} ({r['seconds']:.1f}s): {r['error']}")
+
+
+def build_tiles(
+    results,
+    tiles_dir,
+    zmin,
+    zmax,
+    cache_dir,
+    resampling="near",
+    previous_dir=None,
+    tile_format="dir",
+    dump_dir=None,
+    composite="last",
+    encodings=("png",),
+    palette=None,
+):
+    import radar_process as rp
+
+    georefs = [load_station_raster(r) for r in results if r["ok"]]
+    mosaic, transform = rp.mosaic_stations(georefs, cache_dir=cache_dir, rule=composite)
+    del georefs
+    if dump_dir is not None:
+        Path(dump_dir).mkdir(parents=True, exist_ok=True)
+        rp.write_georef(
+            Path(dump_dir) / "mosaic_3857.tif", mosaic, rp.WEB_MERCATOR, transform
+        )
+    tiles = rp.build_tile_pyramid(
+        mosaic,
+        transform,
+        tiles_dir,
+        zmin=zmin,
+        zmax=zmax,
+        resampling=resampling,
+        previous_dir=previous_dir,
+        tile_format=tile_format,
+        encodings=encodings,
+        palette=palette,
+    )
+    rain_grid.write_grid(tiles_dir, rp.rain_levels(mosaic), transform)
+    previous = rp.read_tile_hashes(previous_dir) if previous_dir else {}
+    unchanged = sum(previous.get(k) == d for k, d in tiles.items())
+    print(f"[DONE] {len(tiles)} tiles ({unchanged} unchanged) at: {tiles_dir}")
+    return tiles, unchanged
+
+
+def cycle_timestamp(now, interval=CYCLE_SECONDS):
+    return int(now // interval) * interval
+
+
+def acquire_lock(lock_file):
+    """
+    Take an exclusive, non-blocking lock on ``lock_file``. Returns the open
+    file (keep it referenced to hold the lock) or None if another cycle
+    already holds it.
+    """
+    Path(lock_file).parent.mkdir(parents=True, exist_ok=True)
+    f = open(lock_file, "a+")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def latest_frame(radar_dir, before):
+    """Newest published frame directory older than ``before``, or None."""
+    try:
+        names = os.listdir(radar_dir)
+    except FileNotFoundError:
+        return None
+    times = [int(n) for n in names if n.isdigit() and int(n) < before]
+    if not times:
+        return None
+    return Path(radar_dir) / str(max(times))
+
+
+def publish_frame(staging_dir, radar_dir, timestamp):
+    """
+    Move a complete frame from ``staging_dir`` to ``radar_dir/<timestamp>``
+    with a single rename, so readers see either no frame or all of it. The
+    staging directory must be on the same filesystem.
+
+    Published frames are never replaced: the web service and browsers cache
+    their tiles as immutable under the timestamp, so publishing a timestamp
+    again raises FileExistsError.
+    """
+    frame_dir = Path(radar_dir) / str(timestamp)
+    if frame_dir.exists():
+        raise FileExistsError(f"{frame_dir} is already published")
+    os.rename(staging_dir, frame_dir)
+    return frame_dir
+
+
+def prune_frames(radar_dir, max_age, now=None, archive_dir=None):
+    """
+    Retire frames older than ``max_age`` seconds. They are dropped from
+    the manifest first, so the API stops listing them before they go. Then
+    they are moved to ``archive_dir`` (and listed in its own manifest), or
+    deleted. Staging directories of builds that crashed before publishing
+    are deleted once their timestamp is as old. Returns the retired
+    timestamps.
+    """
+    now = time.time() if now is None else now
+    radar_dir = Path(radar_dir)
+    names = os.listdir(radar_dir)
+    old = sorted(int(n) for n in names if n.isdigit() and int(n) < now - max_age)
+    # left behind by an interrupted publish or prune
+    trash = [radar_dir / n for n in names if n.startswith(TRASH_PREFIX)]
+    # and by a build that never published; such old slots are not rebuilt
+    for n in names:
+        stamp = n[len(STAGING_PREFIX) :]
+        if n.startswith(STAGING_PREFIX) and stamp.isdigit():
+            if int(stamp) < now - max_age:
+                trash.append(radar_dir / n)
+    if old:
+        retired = frames.remove_frames(radar_dir, old)
+        for timestamp in old:
+            src = radar_dir / str(timestamp)
+            if archive_dir is None:
+                # out of sight in one rename, deleted below
+                trash.append(radar_dir / f"{TRASH_PREFIX}{timestamp}")
+                os.rename(src, trash[-1])
+                continue
+            dst = Path(archive_dir) / str(timestamp)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            if dst.exists():
+                shutil.rmtree(dst)
+            shutil.move(str(src), str(dst))
+        if archive_dir is not None:
+            frames.add_frames(archive_dir, retired)
+    for path in trash:
+        shutil.rmtree(path, ignore_errors=True)
+    return old
+
+
+def frame_entry(
+    timestamp, stations, tiles, tile_format, encodings, zmin, zmax, levels=None
+):
+    """
+    Manifest entry of a published frame. ``levels`` is ``(count, palette
+    name)`` for frames of legend levels.
+    """
+    entry = {
+        "time": timestamp,
+        "path": f"/radar/{timestamp}",
+        "stations": stations,
+        "tiles": len(tiles),
+        "format": tile_format,
+        "encodings": list(encodings),
+        "zmin": zmin,
+        "zmax": zmax,
+        "published": int(time.time()),
+    }
+    if levels is not None:
+        entry["levels"], entry["palette"] = levels
+    return entry
+
+
+def frame_legend(stations):
+    """
+    Legend the level palette is built from: the first station's. Level i
+    means the i-th colour of each station's own legend, so the legends
+    should list the same scale.
+    """
+    for s in stations:
+        if s.get("legend"):
+            return s["legend"]
+    raise ValueError("--levels needs a legend per station (see calibrate.py)")
+
+
+def run_cycle(stations, timestamp, args):
+    """
+    One full cycle: stations → mosaic → tiles → ``radar_dir/<timestamp>``.
+    Stage and station timings are recorded in ``args.metrics_file`` whether
+    the cycle succeeds or not.
+    """
+    if args.radar_dir and (Path(args.radar_dir) / str(timestamp)).exists():
+        # a restarted daemon or a manual run in a slot already published
+        print(f"[SKIP] {timestamp} is already published")
+        return
+    workdir = Path(args.workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+    started = time.monotonic()
+    cycle = {"timestamp": timestamp, "result": "failed", "stages": {}}
+    try:
+        _run_cycle(stations, timestamp, args, workdir, cycle)
+        cycle["result"] = "ok"
+    finally:
+        cycle["seconds"] = time.monotonic() - started
+        cycle["finished"] = int(time.time())
+        try:
+            metrics.record_cycle(args.metrics_file, cycle)
+        except OSError as e:
+            print(f"[WARN] cannot write {args.metrics_file}: {e}", file=sys.stderr)
+
+
+def _run_cycle(stations, timestamp, args, workdir, cycle):
+    started = time.monotonic()
+    downloads = download_stations(
+        stations,
+        args.cache_dir,
+        timeout=args.download_timeout,
+        retries=args.download_retries,
+    )
+    cycle["stages"]["download"] = time.monotonic() - started
+    stage = time.monotonic()
+    results = run_stations(
+        stations,
+        workdir,
+        args.cache_dir,
+        processes=args.processes,
+        timeout=args.station_timeout,
+        debug_dump=args.debug_dump,
+        downloads=downloads,
+        levels=args.levels,
+    )
+    cycle["stages"]["stations"] = time.monotonic() - stage
+    cycle["stations"] = {
+        r["name"]: {
+            k: r[k]
+            for k in ("ok", "reused", "not_modified", "seconds", "bytes", "stages")
+            if k in r
+        }
+        for r in results
+    }
+    report(results)
+    if not any(r["ok"] for r in results):
+        raise RuntimeError("No station processed successfully")
+    if args.skip_tiles:
+        return
+
+    stage = time.monotonic()
+    previous = None
+    encodings = ("png", "webp") if args.webp else ("png",)
+    legend = frame_legend(stations) if args.levels else None
+    palette = palettes.level_palette(args.palette, legend) if legend else None
+    if args.radar_dir:
+        # build next to the published frames so unchanged tiles can be
+        # hard-linked and publishing is a single rename
+        tiles_dir = Path(args.radar_dir) / f"{STAGING_PREFIX}{timestamp}"
+        shutil.rmtree(tiles_dir, ignore_errors=True)
+        previous = latest_frame(args.radar_dir, before=timestamp)
+    else:
+        tiles_dir = Path(args.tiles_dir or workdir / "tiles")
+    tiles, unchanged = build_tiles(
+        results,
+        tiles_dir,
+        args.zmin,
+        args.zmax,
+        args.cache_dir,
+        args.resampling,
+        previous_dir=previous,
+        tile_format=args.tile_format,
+        dump_dir=workdir if args.debug_dump else None,
+        composite=args.composite,
+        encodings=encodings,
+        palette=palette,
+    )
+    cycle["stages"]["tiles"] = time.monotonic() - stage
+    cycle["tiles"] = {"total": len(tiles), "unchanged": unchanged}
+    if args.radar_dir:
+        stage = time.monotonic()
+        frame_dir = publish_frame(tiles_dir, args.radar_dir, timestamp)
+        frames.add_frame(
+            args.radar_dir,
+            frame_entry(
+                timestamp,
+                [r["name"] for r in results if r["ok"]],
+                tiles,
+                args.tile_format,
+                encodings,
+                args.zmin,
+                args.zmax,
+                levels=(len(legend), args.palette) if legend else None,
+            ),
+        )
+        cycle["stages"]["publish"] = time.monotonic() - stage
+        cycle["published"] = timestamp
+        if args.retention_hours > 0:
+            stage = time.monotonic()
+            retired = prune_frames(
+                args.radar_dir,
+                args.retention_hours * 3600,
+                archive_dir=args.archive_dir,
+            )
+            cycle["stages"]["retention"] = time.monotonic() - stage
+            if retired:
+                where = args.archive_dir or "deleted"
+                print(f"[RETIRED] {len(retired)} frames ({where})")
+        if not args.debug_dump:
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"[PUBLISHED] {frame_dir} ({time.monotonic() - started:.1f}s)")
+
+
+def warm_up(stations, cache_dir, levels=False):
+    # import the processing stack, parse templates and build the colour
+    # tables once; pool workers are forked from this process and inherit them
+    import radar_process as rp
+
+    for station in stations:
+        try:
+            rp.load_template(station["template"])
+        except Exception as e:
+            print(f"[WARN] {station['name']}: cannot read template: {e}")
+        if levels:
+            if station["legend"]:
+                rp.legend_level_lut(station["legend"])
+            continue
+        colors = {
+            k: v
+            for k, v in station["mask"].items()
+            if k not in ("disk_shrink", "left_crop_frac")
+        }
+        rp.rain_color_lut(cache_dir=cache_dir, **colors)
+
+
+def run_daemon(args):
+    """
+    Stay resident and run one cycle per ``--interval`` slot. Cycles never
+    overlap: the loop is sequential and each cycle also takes the lock file,
+    so a manual ``main.sh`` run cannot race it. When a cycle overruns its
+    slot, the missed slots are coalesced into a single cycle for the
+    current one.
+    """
+    stations = load_stations(args.config)
+    warm_up(stations, args.cache_dir, args.levels)
+    print(f"[DAEMON] {len(stations)} stations, every {args.interval}s")
+
+    last = None
+    while True:
+        slot = cycle_timestamp(time.time(), args.interval)
+        if slot == last:
+            time.sleep(max(slot + args.interval - time.time(), 0) + args.delay)
+            continue
+        if last is not None and slot - last > args.interval:
+            skipped = (slot - last) // args.interval - 1
+            print(f"[DAEMON] behind schedule, skipped {skipped} slot(s)")
+
+        lock = acquire_lock(args.lock_file)
+        if lock is None:
+            print(f"[DAEMON] {slot}: another cycle holds {args.lock_file}, skipping")
+        else:
+            try:
+                print(
+                    f"[CYCLE] {slot} ({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(slot))})"
+                )
+                run_cycle(stations, slot, args)
+            except Exception as e:
+                print(f"[ERROR] cycle {slot}: {type(e).__name__}: {e}", file=sys.stderr)
+            finally:
+                lock.close()
+        last = slot
+
+
+def run_once(args):
+    lock = acquire_lock(args.lock_file)
+    if lock is None:
+        print(f"[SKIP] another cycle holds {args.lock_file}", file=sys.stderr)
+        sys.exit(0)
+    try:
+        stations = load_stations(args.config)
+        warm_up(stations, args.cache_dir, args.levels)
+        run_cycle(stations, cycle_timestamp(time.time(), args.interval), args)
+    except RuntimeError as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        lock.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Process every configured radar station and tile the mosaic"
+    )
+    ap.add_argument("--config", default=DEFAULT_CONFIG)
+    ap.add_argument("--workdir", default="out")
+    ap.add_argument("--tiles_dir", default=None)
+    ap.add_argument("--cache_dir", default="cache")
+    ap.add_argument(
+        "--radar_dir",
+        default=None,
+        help="Publish frames as <radar_dir>/<timestamp>",
+    )
+    ap.add_argument(
+        "--retention_hours",
+        type=float,
+        default=RETENTION_HOURS,
+        help="Retire published frames older than this; 0 keeps every frame",
+    )
+    ap.add_argument(
+        "--archive_dir",
+        default=None,
+        help="Move retired frames here instead of deleting them",
+    )
+    ap.add_argument("--zmin", type=int, default=5)
+    ap.add_argument("--zmax", type=int, default=11)
+    ap.add_argument("--resampling", default="near", choices=["near", "average"])
+    ap.add_argument(
+        "--composite",
+        default="last",
+        choices=["last", "max", "nearest", "alpha"],
+        help="Where stations overlap: later in the config on top, strongest "
+        "echo, nearest radar, or alpha-weighted mean",
+    )
+    ap.add_argument(
+        "--tile_format",
+        default="dir",
+        choices=["dir", "pack", "cog"],
+        help="One PNG per tile, a single tiles.pack archive per frame, or a "
+        "COG per frame that the web service renders tiles from on request",
+    )
+    ap.add_argument(
+        "--webp",
+        action="store_true",
+        help="Also publish lossless WebP tiles, served to clients that accept them",
+    )
+    ap.add_argument(
+        "--levels",
+        action="store_true",
+        help="Decode stations to legend levels and colourize only the tiles",
+    )
+    ap.add_argument(
+        "--palette",
+        default=palettes.LEGEND,
+        choices=palettes.PALETTES,
+        help="Colours of level tiles: the legend's own or a heatmap ramp",
+    )
+    ap.add_argument("--processes", type=int, default=None)
+    ap.add_argument(
+        "--download_timeout",
+        type=float,
+        default=fetch.TIMEOUT,
+        help="Seconds allowed for each download attempt",
+    )
+    ap.add_argument(
+        "--download_retries",
+        type=int,
+        default=fetch.RETRIES,
+        help="Retries of a failed download, with exponential backoff",
+    )
+    ap.add_argument(
+        "--station_timeout",
+        type=float,
+        default=240,
+        help="Seconds before unfinished stations are abandoned",
+    )
+    ap.add_argument("--skip_tiles", action="store_true")
+    ap.add_argument(
+        "--debug_dump",
+        "--debug-dump",
+        action="store_true",
+        help="Write intermediate images and the mosaic to --workdir",
+    )
+    ap.add_argument(
+        "--daemon", action="store_true", help="Run a cycle every --interval"
+    )
+    ap.add_argument("--interval", type=int, default=CYCLE_SECONDS)
+    ap.add_argument(
+        "--delay",
+        type=float,
+        default=0,
+        help="Seconds to wait past each slot boundary before starting a cycle",
+    )
+    ap.add_argument("--lock_file", default=None)
+    ap.add_argument(
+        "--metrics_file",
+        default=None,
+        help="Cycle metrics state for the web service (default: <cache_dir>/metrics.json)",
+    )
+    args = ap.parse_args()
+    if args.levels and args.resampling != "near":
+        ap.error("--levels needs --resampling near")
+
+    if args.lock_file is None:
+        args.lock_file = os.path.join(args.cache_dir, "pipeline.lock")
+    if args.metrics_file is None:
+        args.metrics_file = metrics.state_path(args.cache_dir)
+
+    if args.daemon:
+        run_daemon(args)
+    else:
+        run_once(args)
+
+
+if __name__ == "__main__":
+    main()
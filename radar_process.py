@@ -1,13 +1,46 @@
 import argparse
+import hashlib
+import json
+import math
+import os
 import subprocess
+import time
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
 from PIL import Image
 import rasterio
-from matplotlib.colors import LinearSegmentedColormap
+import rasterio.warp
+from rasterio.crs import CRS
+from rasterio.transform import Affine, array_bounds
+from rasterio.warp import transform_bounds
 import cv2
-import matplotlib.pyplot as plt
+from tile_archive import archive_name, open_archive, write_archive
+import tile_codec
+from palettes import heatmap_lut, legend_rgb
+from cog_tiles import COG_NAME, write_cog
+
+# Spherical mercator (EPSG:3857) tile grid, same as gdal2tiles' mercator profile
+TILE_SIZE = 256
+EARTH_RADIUS = 6378137.0
+ORIGIN_SHIFT = math.pi * EARTH_RADIUS
+WEB_MERCATOR = CRS.from_epsg(3857)
+# per-frame index of tile pixel hashes, used to skip unchanged tiles
+TILE_HASHES = "tile_hashes.json"
+# tile jobs queued per encoding thread before build_tile_pyramid waits
+TILE_JOBS_PER_WORKER = 4
+# bump when the remap table format or sampling rule changes
+REMAP_VERSION = 1
+# bump when the colour table layout or classification rule changes
+COLOR_LUT_VERSION = 1
+# how mosaic_stations resolves pixels where stations overlap
+COMPOSITE_RULES = ("last", "max", "nearest", "alpha")
+# hue (0-255) where the echo intensity scale wraps: between blue, the
+# weakest echoes, and violet, the strongest
+INTENSITY_HUE_ORIGIN = 185
 
 
 def run(cmd):
@@ -21,9 +54,28 @@ def which_or_die(bin_name):
     return bin_name
 
 
-def mask_rain_from_png(
-    png_path,
-    out_path,
+def _hsv_of_all_colors():
+    # PIL's H, S, V planes for every 24-bit colour, indexed by
+    # R | G << 8 | B << 16 (the low three bytes of a little-endian RGBA word)
+    idx = np.arange(2**24, dtype="<u4")
+    rgb = Image.frombuffer("RGBX", (4096, 4096), idx, "raw", "RGBX", 0, 1)
+    hsv = rgb.convert("RGB").convert("HSV")
+    return [np.asarray(band).reshape(-1) for band in hsv.split()]
+
+
+def _compute_rain_color_lut(
+    h_low, h_high, s_min, v_min, include_red, red_low, red_high
+):
+    H, S, V = _hsv_of_all_colors()
+    lut = (H >= h_low) & (H <= h_high)
+    if include_red:
+        lut |= (H >= red_low) | (H <= red_high)
+    lut &= S >= s_min
+    lut &= V >= v_min
+    return lut
+
+
+def rain_color_lut(
     h_low=25,
     h_high=110,
     s_min=160,
@@ -31,107 +83,233 @@ def mask_rain_from_png(
     include_red=False,
     red_low=245,
     red_high=15,
-    disk_shrink=0.96,
-    left_crop_frac=0.18,
+    cache_dir=None,
 ):
+    """
+    Keep/drop flag for every 24-bit colour under one set of HSV thresholds,
+    taken from PIL's own HSV conversion so it classifies exactly like
+    converting the image does. 16 MB; kept per process and, with
+    ``cache_dir``, stored as ``colors_<hash>.npy`` and memory-mapped.
+    """
+    params = (
+        int(h_low),
+        int(h_high),
+        int(s_min),
+        int(v_min),
+        bool(include_red),
+        int(red_low),
+        int(red_high),
+    )
+    return _rain_color_lut(params, None if cache_dir is None else str(cache_dir))
 
-    im = Image.open(png_path).convert("RGBA")
-    w, h = im.size
 
-    hsv = im.convert("RGB").convert("HSV")
-    arr = np.array(hsv, dtype=np.uint8)
-    H, S, V = arr[..., 0], arr[..., 1], arr[..., 2]
+@lru_cache(maxsize=16)
+def _rain_color_lut(params, cache_dir):
+    if cache_dir is None:
+        return _compute_rain_color_lut(*params)
 
-    gy = (H >= h_low) & (H <= h_high)
-    sv = (S >= s_min) & (V >= v_min)
+    cache_dir = Path(cache_dir)
+    key = hashlib.sha256(repr((COLOR_LUT_VERSION, params)).encode()).hexdigest()[:24]
+    path = cache_dir / f"colors_{key}.npy"
+    if path.exists():
+        return np.load(path, mmap_mode="r")
+
+    lut = _compute_rain_color_lut(*params)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, lut)
+    os.replace(tmp, path)
+    return np.load(path, mmap_mode="r")
+
+
+def radar_area_mask(w, h, disk_shrink=0.96, left_crop_frac=0.18):
+    """Radar disk minus the legend strip on the left, cached per image geometry."""
+    return _radar_area_mask(int(w), int(h), float(disk_shrink), float(left_crop_frac))
 
-    if include_red:
-        red = (H >= red_low) | (H <= red_high)
-        hsv_mask = (gy | red) & sv
-    else:
-        hsv_mask = gy & sv
 
+@lru_cache(maxsize=8)
+def _radar_area_mask(w, h, disk_shrink, left_crop_frac):
     cy, cx = h / 2.0, w / 2.0
     R = disk_shrink * min(w, h) * 0.5
     yy, xx = np.ogrid[:h, :w]
-    circ = (xx - cx) ** 2 + (yy - cy) ** 2 <= R**2
+    area = (xx - cx) ** 2 + (yy - cy) ** 2 <= R**2
+    area[:, : int(w * left_crop_frac)] = False
+    area.flags.writeable = False
+    return area
 
-    left_mask = np.ones((h, w), dtype=bool)
-    cut = int(w * left_crop_frac)
-    left_mask[:, :cut] = False
 
-    keep = hsv_mask & circ & left_mask
+def mask_rain(
+    rgba,
+    h_low=25,
+    h_high=110,
+    s_min=160,
+    v_min=70,
+    include_red=False,
+    red_low=245,
+    red_high=15,
+    disk_shrink=0.96,
+    left_crop_frac=0.18,
+    cache_dir=None,
+):
+    """
+    Keep rain echoes of an HxWx4 uint8 RGBA frame, in place: kept pixels get
+    alpha 255, everything else becomes (0, 0, 0, 0).
+    """
+    h, w = rgba.shape[:2]
+    lut = rain_color_lut(
+        h_low, h_high, s_min, v_min, include_red, red_low, red_high, cache_dir
+    )
+    area = radar_area_mask(w, h, disk_shrink, left_crop_frac)
 
-    rgba = np.array(im, dtype=np.uint8)
-    alpha = np.where(keep, 255, 0).astype(np.uint8)
-    rgba[..., 3] = alpha
+    words = rgba.view("<u4")[..., 0]
+    idx = np.bitwise_and(words, 0xFFFFFF)
+    keep = lut[idx]
+    keep &= area
+    np.multiply(words, keep, out=words)
+    np.bitwise_or(words, np.uint32(0xFF000000), out=words, where=keep)
+    return rgba
 
-    rgb = rgba[..., :3]
-    rgb[alpha == 0] = 0
-    rgba[..., :3] = rgb
 
-    Image.fromarray(rgba).convert("RGBA").save(out_path)
+def mask_rain_from_png(
+    png_path,
+    out_path,
+    h_low=25,
+    h_high=110,
+    s_min=160,
+    v_min=70,
+    include_red=False,
+    red_low=245,
+    red_high=15,
+    disk_shrink=0.96,
+    left_crop_frac=0.18,
+    cache_dir=None,
+):
+
+    rgba = read_rgba(png_path)
+    mask_rain(
+        rgba,
+        h_low=h_low,
+        h_high=h_high,
+        s_min=s_min,
+        v_min=v_min,
+        include_red=include_red,
+        red_low=red_low,
+        red_high=red_high,
+        disk_shrink=disk_shrink,
+        left_crop_frac=left_crop_frac,
+        cache_dir=cache_dir,
+    )
+
+    Image.fromarray(rgba, "RGBA").save(out_path)
     return out_path
 
 
-def create_radar_heatmap(
-    input_path,
+def legend_level_lut(legend):
+    """
+    Level of every 24-bit colour under a legend (``#rrggbb`` colours,
+    weakest first): ``i + 1`` for its i-th colour, 0 for any other colour.
+    Indexed like rain_color_lut; 16 MB, kept per process.
+    """
+    return _legend_level_lut(tuple(legend))
+
+
+@lru_cache(maxsize=8)
+def _legend_level_lut(legend):
+    if not 0 < len(legend) < 256:
+        raise ValueError(f"A legend needs 1 to 255 colours, not {len(legend)}")
+    rgb = legend_rgb(legend).astype(np.uint32)
+    words = rgb[:, 0] | rgb[:, 1] << 8 | rgb[:, 2] << 16
+    lut = np.zeros(2**24, dtype=np.uint8)
+    # written strongest first so a colour listed twice keeps its weakest level
+    lut[words[::-1]] = np.arange(len(legend), 0, -1)
+    lut.flags.writeable = False
+    return lut
+
+
+def decode_levels(rgba, legend, disk_shrink=0.96, left_crop_frac=0.18):
+    """
+    HxW uint8 legend level of an HxWx4 RGBA frame (see legend_level_lut),
+    0 outside the radar area and wherever the colour is not in the legend.
+    """
+    h, w = rgba.shape[:2]
+    words = np.ascontiguousarray(rgba).view("<u4")[..., 0]
+    levels = legend_level_lut(legend)[words & 0xFFFFFF]
+    levels *= radar_area_mask(w, h, disk_shrink, left_crop_frac)
+    return levels
+
+
+def render_heatmap(
+    image_bgr,
     smooth_px=8,
     gamma=0.85,
     low_cut=0.15,
     feather=0.12,
     use_green_only=False,
+    n=512,
 ):
+    """
+    Soft heatmap of a radar frame as an RGBA uint8 array of the same size.
 
-    image = cv2.imread(str(input_path))
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    h, w, _ = image_rgb.shape
-
-    gray = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255.0
+    Intensity is the blurred, gamma-corrected grey level, stretched over its
+    own range like ``imshow`` does, and looked up in the ramp table; the
+    ramp's alpha is multiplied by a ``low_cut``/``feather`` fade-in.
+    """
+    gray = cv2.cvtColor(image_bgr[:, :, :3], cv2.COLOR_BGR2GRAY)
+    intensity = gray.astype(np.float32) / 255.0
 
     if smooth_px > 0:
-        gray_smooth = cv2.GaussianBlur(
-            gray, ksize=(0, 0), sigmaX=smooth_px, sigmaY=smooth_px
+        intensity = cv2.GaussianBlur(
+            intensity, ksize=(0, 0), sigmaX=smooth_px, sigmaY=smooth_px
         )
-    else:
-        gray_smooth = gray
 
-    intensity = np.clip(gray_smooth, 0, 1) ** gamma
+    np.clip(intensity, 0, 1, out=intensity)
+    np.power(intensity, gamma, out=intensity)
 
-    alpha = np.clip((intensity - low_cut) / max(feather, 1e-6), 0.0, 1.0)
+    alpha = intensity - low_cut
+    alpha /= max(feather, 1e-6)
+    np.clip(alpha, 0.0, 1.0, out=alpha)
 
-    if use_green_only:
-        colors = [
-            (0.0, 0.0, 0.0, 0.0),
-            (0.85, 1.0, 0.85, 0.6),
-            (0.5, 0.9, 0.5, 0.85),
-            (0.0, 0.75, 0.0, 1.0),
-        ]
-        rain_cmap = LinearSegmentedColormap.from_list("rain_green_soft", colors, N=512)
+    lo, hi = float(intensity.min()), float(intensity.max())
+    if hi > lo:
+        scaled = (intensity - lo) * (n / (hi - lo))
+        idx = np.minimum(scaled.astype(np.int32), n - 1)
     else:
-        colors = [
-            (0.0, 0.0, 0.0, 0.0),
-            (0.80, 1.00, 0.80, 0.6),
-            (0.00, 0.85, 0.00, 0.8),
-            (0.90, 0.90, 0.00, 0.9),
-            (1.00, 0.60, 0.10, 0.95),
-        ]
-        rain_cmap = LinearSegmentedColormap.from_list("rain_soft", colors, N=512)
-
-    dpi = 100
-    fig = plt.figure(figsize=(w / dpi, h / dpi), dpi=dpi)
-    ax = fig.add_axes([0, 0, 1, 1])
-    ax.imshow(intensity, cmap=rain_cmap, alpha=alpha, interpolation="bilinear")
-    ax.axis("off")
-
-    plt.savefig(
-        str(input_path).replace(".png", "_smooth.png"),
-        dpi=dpi,
-        bbox_inches="tight",
-        pad_inches=0,
-        transparent=True,
+        idx = np.zeros(intensity.shape, dtype=np.int32)
+
+    lut = heatmap_lut("rain_green_soft" if use_green_only else "rain_soft", n)
+    rgba8 = np.rint(lut * 255).astype(np.uint8)
+    rgba = rgba8[idx]
+    alpha *= lut[:, 3][idx]
+    alpha *= 255
+    np.rint(alpha, out=alpha)
+    rgba[:, :, 3] = alpha
+    rgba[rgba[:, :, 3] == 0] = 0
+    return rgba
+
+
+def create_radar_heatmap(
+    input_path,
+    smooth_px=8,
+    gamma=0.85,
+    low_cut=0.15,
+    feather=0.12,
+    use_green_only=False,
+    out_path=None,
+):
+    if out_path is None:
+        out_path = str(input_path).replace(".png", "_smooth.png")
+
+    rgba = render_heatmap(
+        cv2.imread(str(input_path)),
+        smooth_px=smooth_px,
+        gamma=gamma,
+        low_cut=low_cut,
+        feather=feather,
+        use_green_only=use_green_only,
     )
-    plt.close(fig)
+    Image.fromarray(rgba, "RGBA").save(out_path)
+    return out_path
 
 
 def fix_radar_gaps(
@@ -144,15 +322,127 @@ def fix_radar_gaps(
     feather_px: int = 1,
     max_alpha: int = 255, 
     antialias_sigma: float = 0.8, 
+    roi: bool = False,
 ) -> np.ndarray:
+    """
+    Inpaint the small black gaps between radar echoes and derive a feathered
+    alpha channel from the echo area.
+
+    With ``roi`` the work is limited to where there is rain: the frame is
+    cropped to the echoes plus a margin wide enough for every filter, and
+    the inpaint runs only in padded windows around groups of gap pixels. The
+    result is pixel-identical to the full-frame path.
 
+    A single-band level image (see decode_levels) is repaired the same way,
+    with every non-zero level counting as an echo. It comes back as levels,
+    0 where the alpha would be 0.
+    """
     if img_bgra.ndim == 3 and img_bgra.shape[2] == 4:
         bgr = img_bgra[:, :, :3].copy()
         _ = img_bgra[:, :, 3]
     else:
         bgr = img_bgra.copy()
+    if bgr.ndim == 2:
+        nonblack_threshold = 0
+
+    if not roi:
+        return _fix_radar_gaps(
+            bgr,
+            nonblack_threshold,
+            neighbor_kernel_size,
+            min_neighbors,
+            disk_dilate,
+            inpaint_radius,
+            feather_px,
+            max_alpha,
+            antialias_sigma,
+            roi=False,
+        )
+
+    if bgr.ndim == 2:
+        out = np.zeros_like(bgr)
+        gray = bgr
+    else:
+        out = np.zeros(bgr.shape[:2] + (4,), dtype=np.uint8)
+        out[:, :, :3] = bgr
+        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    rain = cv2.findNonZero((gray > nonblack_threshold).astype(np.uint8))
+    if rain is None:
+        # nothing to repair and nothing opaque
+        return out
+
+    # every pass below only reaches this far from an echo pixel
+    margin = (
+        neighbor_kernel_size
+        + disk_dilate // 2
+        + _inpaint_pad(inpaint_radius)
+        + max(int(feather_px), 0)
+        + int(np.ceil(antialias_sigma * 4))
+        + 4
+    )
+    x, y, w, h = cv2.boundingRect(rain)
+    h_img, w_img = gray.shape
+    y0, y1 = max(y - margin, 0), min(y + h + margin, h_img)
+    x0, x1 = max(x - margin, 0), min(x + w + margin, w_img)
+
+    out[y0:y1, x0:x1] = _fix_radar_gaps(
+        bgr[y0:y1, x0:x1],
+        nonblack_threshold,
+        neighbor_kernel_size,
+        min_neighbors,
+        disk_dilate,
+        inpaint_radius,
+        feather_px,
+        max_alpha,
+        antialias_sigma,
+        roi=True,
+    )
+    return out
+
+
+def _inpaint_pad(inpaint_radius):
+    # TELEA reads known pixels within the radius and the distance field two
+    # pixels beyond it
+    return int(inpaint_radius) + 4
+
+
+def _inpaint_windows(bgr, gap_mask, inpaint_radius):
+    """
+    cv2.inpaint restricted to padded windows around groups of gap pixels.
+    Gap pixels closer than two pads are grouped (dilate + connected
+    components), so every window holds everything its pixels can see.
+    """
+    repaired = bgr.copy()
+    pad = _inpaint_pad(inpaint_radius)
+    grown = cv2.dilate(gap_mask, np.ones((2 * pad + 1, 2 * pad + 1), np.uint8))
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(grown, connectivity=8)
+    for i in range(1, n):
+        x, y, w, h = stats[i, :4]
+        win = np.s_[y : y + h, x : x + w]
+        mask = gap_mask[win] & (labels[win] == i).astype(np.uint8)
+        patch = cv2.inpaint(
+            bgr[win], mask, inpaintRadius=inpaint_radius, flags=cv2.INPAINT_TELEA
+        )
+        where = mask.astype(bool)
+        if repaired.ndim == 3:
+            where = where[:, :, None]
+        np.copyto(repaired[win], patch, where=where)
+    return repaired
+
 
-    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+def _fix_radar_gaps(
+    bgr,
+    nonblack_threshold,
+    neighbor_kernel_size,
+    min_neighbors,
+    disk_dilate,
+    inpaint_radius,
+    feather_px,
+    max_alpha,
+    antialias_sigma,
+    roi,
+):
+    gray = bgr if bgr.ndim == 2 else cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
     nonblack = (gray > nonblack_threshold).astype(np.uint8)
 
     k = np.ones((neighbor_kernel_size, neighbor_kernel_size), np.uint8)
@@ -169,9 +459,12 @@ def fix_radar_gaps(
     )
     gap_mask = cv2.bitwise_and(gap_mask, (disk_area * 255).astype(np.uint8))
 
-    repaired = cv2.inpaint(
-        bgr, gap_mask, inpaintRadius=inpaint_radius, flags=cv2.INPAINT_TELEA
-    )
+    if roi:
+        repaired = _inpaint_windows(bgr, gap_mask, inpaint_radius)
+    else:
+        repaired = cv2.inpaint(
+            bgr, gap_mask, inpaintRadius=inpaint_radius, flags=cv2.INPAINT_TELEA
+        )
 
     core = cv2.morphologyEx(
         nonblack,
@@ -194,38 +487,666 @@ def fix_radar_gaps(
     if antialias_sigma > 0:
         a = cv2.GaussianBlur(a, ksize=(0, 0), sigmaX=antialias_sigma)
 
+    if repaired.ndim == 2:
+        return np.where(a > 0, repaired, 0).astype(np.uint8)
     out = np.dstack([repaired, a])
     return out
 
 
-def copy_georef_from_template(template_tif, input_rgba_png, out_tif):
+@lru_cache(maxsize=None)
+def load_template(template_tif):
+    """Parse a template's (crs, transform, width, height) once per process."""
     with rasterio.open(template_tif) as tmpl:
-        crs = tmpl.crs
-        transform = tmpl.transform
-    with Image.open(input_rgba_png).convert("RGBA") as im:
-        w, h = im.size
-        arr = np.array(im).transpose(2, 0, 1)
+        return tmpl.crs, tmpl.transform, tmpl.width, tmpl.height
+
+
+def read_rgba(source):
+    """Decode an image file or file-like object to an HxWx4 uint8 RGBA array."""
+    with Image.open(source) as im:
+        return np.array(im.convert("RGBA"), dtype=np.uint8)
+
+
+def write_georef(out_tif, rgba, crs, transform):
+    # RGBA, or a single band of levels
+    h, w = rgba.shape[:2]
     profile = {
         "driver": "GTiff",
         "dtype": "uint8",
-        "count": 4,
+        "count": 4 if rgba.ndim == 3 else 1,
         "width": w,
         "height": h,
         "crs": crs,
         "transform": transform,
         "compress": "deflate",
-        "photometric": "RGB",
+        "photometric": "RGB" if rgba.ndim == 3 else "MINISBLACK",
     }
     with rasterio.open(out_tif, "w", **profile) as dst:
-        dst.write(arr)
+        dst.write(rgba.transpose(2, 0, 1) if rgba.ndim == 3 else rgba[None])
     return out_tif
 
 
+def copy_georef_from_template(template_tif, input_rgba_png, out_tif):
+    crs, transform, _, _ = load_template(str(template_tif))
+    return write_georef(out_tif, read_rgba(input_rgba_png), crs, transform)
+
+
+def render_station(
+    source,
+    template_tif,
+    mask=None,
+    gaps=None,
+    style="echoes",
+    heatmap=None,
+    legend=None,
+    cache_dir=None,
+    dump_dir=None,
+    timings=None,
+):
+    """
+    Station image → georeferenced RGBA array, entirely in memory: decode,
+    mask, gap repair (or heatmap) and the template's georeference.
+
+    With ``legend`` the frame is decoded to an HxW array of legend levels
+    (see decode_levels) instead of masked, and gap-repaired as levels;
+    ``style`` is ignored since colours are only applied to the tiles.
+
+    Returns ``(rgba, crs, transform)``. With ``dump_dir`` the intermediate
+    images are also written there under their historical names
+    (``rain_only.png``, ``rain_only_smooth.png``, ``rain_only_georef.tif``).
+    ``timings``, if given, receives the seconds spent per step.
+    """
+    clock = [time.monotonic()]
+
+    def lap(step):
+        if timings is not None:
+            now = time.monotonic()
+            timings[step] = now - clock[0]
+            clock[0] = now
+
+    rgba = read_rgba(source)
+    lap("decode")
+    if legend is not None:
+        area = ("disk_shrink", "left_crop_frac")
+        rgba = decode_levels(
+            rgba, legend, **{k: v for k, v in (mask or {}).items() if k in area}
+        )
+    else:
+        mask_rain(rgba, cache_dir=cache_dir, **(mask or {}))
+    lap("mask")
+    if dump_dir is not None:
+        dump_dir = Path(dump_dir)
+        dump_dir.mkdir(parents=True, exist_ok=True)
+        Image.fromarray(rgba).save(dump_dir / "rain_only.png")
+
+    if legend is not None:
+        out = fix_radar_gaps(rgba, **(gaps or {}))
+        lap("gaps")
+    elif style == "heatmap":
+        out = render_heatmap(cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR), **(heatmap or {}))
+        lap("heatmap")
+    else:
+        bgra = fix_radar_gaps(cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA), **(gaps or {}))
+        out = cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGBA)
+        lap("gaps")
+
+    crs, transform, _, _ = load_template(str(template_tif))
+    if dump_dir is not None:
+        Image.fromarray(out).save(dump_dir / "rain_only_smooth.png")
+        write_georef(dump_dir / "rain_only_georef.tif", out, crs, transform)
+    return out, crs, transform
+
+
+# ---------------- Tiling ----------------
+def tile_resolution(zoom):
+    # metres per pixel of a zoom level in the EPSG:3857 tile grid
+    return 2 * ORIGIN_SHIFT / (TILE_SIZE * 2**zoom)
+
+
+def tile_range(bounds, zoom):
+    """Inclusive XYZ tile range (x0, y0, x1, y1) covering EPSG:3857 bounds."""
+    left, bottom, right, top = bounds
+    n = 2**zoom
+    span = 2 * ORIGIN_SHIFT / n
+    x0 = int(math.floor((left + ORIGIN_SHIFT) / span))
+    x1 = int(math.ceil((right + ORIGIN_SHIFT) / span)) - 1
+    y0 = int(math.floor((ORIGIN_SHIFT - top) / span))
+    y1 = int(math.ceil((ORIGIN_SHIFT - bottom) / span)) - 1
+    return max(x0, 0), max(y0, 0), min(x1, n - 1), min(y1, n - 1)
+
+
+def coverage_mask(arr):
+    # RGBA/BGRA frames carry data in alpha, single-band frames use 0 as no-data
+    if arr.ndim == 3:
+        return arr[..., -1] > 0
+    return arr > 0
+
+
+def read_raster(path):
+    """Read a georeferenced raster as (HxWxC array, crs, transform)."""
+    with rasterio.open(path) as src:
+        arr = src.read()
+        crs = src.crs
+        transform = src.transform
+    return np.ascontiguousarray(arr.transpose(1, 2, 0)), crs, transform
+
+
+def _tile_window(transform, shape, zoom, tx, ty):
+    # source pixel window (r0, r1, c0, c1) under an XYZ tile, clipped to the raster
+    span = TILE_SIZE * tile_resolution(zoom)
+    left = -ORIGIN_SHIFT + tx * span
+    top = ORIGIN_SHIFT - ty * span
+    c0 = math.floor((left - transform.c) / transform.a)
+    c1 = math.ceil((left + span - transform.c) / transform.a)
+    r0 = math.floor((top - transform.f) / transform.e)
+    r1 = math.ceil((top - span - transform.f) / transform.e)
+    h, w = shape
+    return max(r0, 0), min(r1, h), max(c0, 0), min(c1, w)
+
+
+def _sample_tile(mosaic, transform, zoom, tx, ty):
+    # nearest-neighbour sample of one tile, separable because the grid is north-up
+    res = tile_resolution(zoom)
+    offs = np.arange(TILE_SIZE) + 0.5
+    xs = -ORIGIN_SHIFT + (tx * TILE_SIZE + offs) * res
+    ys = ORIGIN_SHIFT - (ty * TILE_SIZE + offs) * res
+    cols = np.floor((xs - transform.c) / transform.a).astype(np.intp)
+    rows = np.floor((ys - transform.f) / transform.e).astype(np.intp)
+    h, w = mosaic.shape[:2]
+    cv = (cols >= 0) & (cols < w)
+    rv = (rows >= 0) & (rows < h)
+    tile = np.zeros((TILE_SIZE, TILE_SIZE) + mosaic.shape[2:], dtype=mosaic.dtype)
+    tile[np.ix_(rv, cv)] = mosaic[np.ix_(rows[rv], cols[cv])]
+    return tile
+
+
+def _downsample_children(children, like, resampling="near"):
+    # children in XYZ order: top-left, top-right, bottom-left, bottom-right
+    n = TILE_SIZE
+    block = np.zeros((2 * n, 2 * n) + like.shape[2:], dtype=like.dtype)
+    for i, child in enumerate(children):
+        if child is not None:
+            r, c = divmod(i, 2)
+            block[r * n : (r + 1) * n, c * n : (c + 1) * n] = child
+
+    if resampling == "near":
+        return block[::2, ::2].copy()
+    if resampling == "average":
+        if block.ndim != 3 or block.shape[2] != 4:
+            raise ValueError("average resampling needs RGBA tiles")
+        quads = block.reshape(n, 2, n, 2, 4).astype(np.float32)
+        a = quads[..., 3:4]
+        a_sum = a.sum(axis=(1, 3))
+        rgb = (quads[..., :3] * a).sum(axis=(1, 3)) / np.maximum(a_sum, 1.0)
+        out = np.dstack([rgb, a_sum / 4.0])
+        return np.clip(np.rint(out), 0, 255).astype(np.uint8)
+    raise ValueError(f"Unknown resampling '{resampling}'")
+
+
+def encode_tile(tile, encoding="png", palette=None):
+    return tile_codec.encode(tile, encoding, palette)
+
+
+def _write_bytes(data, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _write_tile(tile, path, encoding="png", palette=None):
+    _write_bytes(encode_tile(tile, encoding, palette), path)
+
+
+def _link_tile(src, path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, path)
+    except OSError:
+        # different filesystem or no hardlink support: still skips the encode
+        shutil.copyfile(src, path)
+
+
+def tile_digest(tile, palette=None):
+    h = hashlib.blake2b(tile.tobytes(), digest_size=16)
+    if palette is not None:
+        # the same levels under another palette are another tile
+        h.update(palette.tobytes())
+    return h.hexdigest()
+
+
+def read_tile_hashes(tiles_dir):
+    """``{(z, x, y): digest}`` recorded by build_tile_pyramid, or {} if none."""
+    path = Path(tiles_dir) / TILE_HASHES
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {
+        tuple(int(v) for v in key.split("/")): digest for key, digest in raw.items()
+    }
+
+
+def write_tile_hashes(tiles_dir, hashes):
+    raw = {f"{z}/{x}/{y}": d for (z, x, y), d in sorted(hashes.items())}
+    with open(Path(tiles_dir) / TILE_HASHES, "w", encoding="utf-8") as f:
+        json.dump(raw, f, separators=(",", ":"))
+
+
+def build_tile_pyramid(
+    mosaic,
+    transform,
+    tiles_dir,
+    zmin=5,
+    zmax=11,
+    resampling="near",
+    workers=None,
+    previous_dir=None,
+    tile_format="dir",
+    encodings=("png",),
+    palette=None,
+):
+    """
+    Cut an EPSG:3857 RGBA mosaic into a TMS tile pyramid, same layout as
+    ``gdal2tiles.py -z zmin-zmax``: ``tiles_dir/{z}/{x}/{y}.png``.
+
+    Only the ``zmax`` tiles are sampled from the mosaic; every lower zoom is
+    built by 2x2 downsampling of the four tiles above it. The pyramid is
+    walked depth-first so only one branch of tiles is held in memory, and
+    subtrees without any data are pruned with a summed-area table. Fully
+    transparent tiles are not written (``serve_tile`` answers those with
+    its empty tile). Tiles are written in each of ``encodings`` (see
+    tile_codec.py), as ``{y}.png``, ``{y}.webp``; encoding runs on a thread
+    pool, and the walk waits while TILE_JOBS_PER_WORKER tiles per thread
+    are queued.
+
+    Every tile's pixels are hashed and the hashes are saved next to the
+    tiles. With ``previous_dir`` (the last published frame), tiles whose
+    pixels did not change are hard-linked from it instead of re-encoded.
+
+    ``tile_format="pack"`` writes a single ``tiles.pack`` archive (see
+    tile_archive.py, one archive per encoding) instead of one file per tile. ``tile_format="cog"``
+    writes no tiles at all but a Cloud-Optimized GeoTIFF of the mosaic that
+    the web service renders tiles from on request (see cog_tiles.py); the
+    mosaic must then be on a tile-aligned grid as built by mosaic_stations.
+
+    A single-band mosaic of legend levels is tiled as levels and colourized
+    with ``palette`` (Nx4 RGBA, see palettes.py) when the tiles are encoded;
+    a COG stores it as a colour map.
+
+    Returns ``{(z, x, y): digest}`` of the written tiles (TMS y).
+    """
+    if transform.b != 0 or transform.d != 0:
+        raise ValueError("Mosaic must be north-up (no rotation)")
+    if zmin > zmax:
+        raise ValueError(f"zmin ({zmin}) > zmax ({zmax})")
+
+    tiles_dir = Path(tiles_dir)
+    if tile_format == "cog":
+        tiles_dir.mkdir(parents=True, exist_ok=True)
+        write_cog(
+            tiles_dir / COG_NAME,
+            mosaic,
+            transform,
+            resampling=resampling,
+            palette=palette,
+        )
+        write_tile_hashes(tiles_dir, {})
+        return {}
+
+    shape = mosaic.shape[:2]
+    h, w = shape
+    sat = np.zeros((h + 1, w + 1), dtype=np.int32)
+    sat[1:, 1:] = coverage_mask(mosaic).cumsum(axis=0, dtype=np.int32).cumsum(axis=1)
+
+    def has_data(zoom, tx, ty):
+        r0, r1, c0, c1 = _tile_window(transform, shape, zoom, tx, ty)
+        if r0 >= r1 or c0 >= c1:
+            return False
+        return sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0] > 0
+
+    if tile_format not in ("dir", "pack", "cog"):
+        raise ValueError(f"Unknown tile format '{tile_format}'")
+    for encoding in encodings:
+        if encoding not in tile_codec.ENCODERS:
+            raise ValueError(f"Unknown tile encoding '{encoding}'")
+    previous = read_tile_hashes(previous_dir) if previous_dir else {}
+    previous_archives = {
+        encoding: open_archive(previous_dir, encoding) if previous_dir else None
+        for encoding in encodings
+    }
+    written = {}
+    workers = workers or os.cpu_count()
+    # queued jobs, oldest first; each holds its tile until it has run
+    pending = deque()
+    packed = {encoding: {} for encoding in encodings}
+
+    def submit(pool, tile, key, unchanged, encoding):
+        # reuse the previous frame's encoded tile where the pixels did not
+        # change and that frame has the encoding, else encode
+        rel = Path(*(str(v) for v in key)).with_suffix(f".{encoding}")
+        archive = previous_archives[encoding]
+        if unchanged and archive is not None and key in archive:
+            if tile_format == "pack":
+                return pool.submit(bytes, archive.get(*key))
+            data = bytes(archive.get(*key))
+            return pool.submit(_write_bytes, data, tiles_dir / rel)
+        if unchanged and (Path(previous_dir) / rel).exists():
+            if tile_format == "pack":
+                return pool.submit((Path(previous_dir) / rel).read_bytes)
+            return pool.submit(_link_tile, Path(previous_dir) / rel, tiles_dir / rel)
+        if tile_format == "pack":
+            return pool.submit(encode_tile, tile, encoding, palette)
+        return pool.submit(_write_tile, tile, tiles_dir / rel, encoding, palette)
+
+    def render(pool, zoom, tx, ty):
+        if not has_data(zoom, tx, ty):
+            return None
+        if zoom == zmax:
+            tile = _sample_tile(mosaic, transform, zoom, tx, ty)
+        else:
+            children = [
+                render(pool, zoom + 1, 2 * tx + dx, 2 * ty + dy)
+                for dy in (0, 1)
+                for dx in (0, 1)
+            ]
+            if all(c is None for c in children):
+                return None
+            tile = _downsample_children(children, mosaic, resampling)
+        if not coverage_mask(tile).any():
+            return None
+        key = (zoom, tx, 2**zoom - 1 - ty)
+        digest = tile_digest(tile, palette)
+        unchanged = previous.get(key) == digest
+        for encoding in encodings:
+            fut = submit(pool, tile, key, unchanged, encoding)
+            if tile_format == "pack":
+                packed[encoding][key] = fut
+            pending.append(fut)
+            if len(pending) >= TILE_JOBS_PER_WORKER * workers:
+                pending.popleft().result()
+        written[key] = digest
+        return tile
+
+    left = transform.c
+    top = transform.f
+    bounds = (left, top + h * transform.e, left + w * transform.a, top)
+    x0, y0, x1, y1 = tile_range(bounds, zmin)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for ty in range(y0, y1 + 1):
+            for tx in range(x0, x1 + 1):
+                render(pool, zmin, tx, ty)
+        for fut in pending:
+            fut.result()
+        tiles_dir.mkdir(parents=True, exist_ok=True)
+        if tile_format == "pack":
+            for encoding, futures in packed.items():
+                blobs = {key: fut.result() for key, fut in futures.items()}
+                write_archive(tiles_dir / archive_name(encoding), blobs)
+
+    write_tile_hashes(tiles_dir, written)
+    return written
+
+
+# ---------------- Reprojection ----------------
+def grid_zoom_for(resolution):
+    # finest tile-grid zoom whose pixels are not coarser than `resolution`
+    # (the equivalent of gdalbuildvrt -resolution highest)
+    z = math.log2(2 * ORIGIN_SHIFT / (TILE_SIZE * resolution))
+    return max(0, math.ceil(z - 1e-6))
+
+
+def aligned_grid(bounds, zoom):
+    """
+    (transform, width, height) of the EPSG:3857 pixel grid of ``zoom`` that
+    covers ``bounds``. Grids of the same zoom share pixel edges, so stations
+    warped onto them can be pasted into a mosaic by integer offsets.
+    """
+    left, bottom, right, top = bounds
+    res = tile_resolution(zoom)
+    c0 = math.floor((left + ORIGIN_SHIFT) / res)
+    c1 = math.ceil((right + ORIGIN_SHIFT) / res)
+    r0 = math.floor((ORIGIN_SHIFT - top) / res)
+    r1 = math.ceil((ORIGIN_SHIFT - bottom) / res)
+    transform = Affine(
+        res, 0.0, -ORIGIN_SHIFT + c0 * res, 0.0, -res, ORIGIN_SHIFT - r0 * res
+    )
+    return transform, c1 - c0, r1 - r0
+
+
+def footprint_3857(crs, transform, width, height):
+    west, south, east, north = array_bounds(height, width, transform)
+    if crs == WEB_MERCATOR:
+        return west, south, east, north
+    return transform_bounds(crs, WEB_MERCATOR, west, south, east, north, densify_pts=21)
+
+
+def _remap_key(src_crs, src_transform, src_shape, dst_transform, dst_shape):
+    h = hashlib.sha256()
+    for part in (
+        REMAP_VERSION,
+        src_crs.to_wkt(),
+        src_transform.to_gdal(),
+        tuple(src_shape),
+        dst_transform.to_gdal(),
+        tuple(dst_shape),
+    ):
+        h.update(repr(part).encode())
+    return h.hexdigest()[:24]
+
+
+def _compute_remap_table(src_crs, src_transform, src_shape, dst_transform, dst_shape):
+    src_h, src_w = src_shape
+    dst_h, dst_w = dst_shape
+    nodata = src_h * src_w
+    dtype = np.int32 if nodata < 2**31 - 1 else np.int64
+    table = np.empty((dst_h, dst_w), dtype=dtype)
+    inv = ~src_transform
+    xs = dst_transform.c + (np.arange(dst_w) + 0.5) * dst_transform.a
+
+    if src_crs == WEB_MERCATOR and src_transform.b == 0 and src_transform.d == 0:
+        # same CRS, north-up: the lookup separates into a row and a column index
+        ys = dst_transform.f + (np.arange(dst_h) + 0.5) * dst_transform.e
+        cols = np.floor((xs - src_transform.c) / src_transform.a).astype(np.int64)
+        rows = np.floor((ys - src_transform.f) / src_transform.e).astype(np.int64)
+        idx = rows[:, None] * src_w + cols[None, :]
+        valid = ((rows >= 0) & (rows < src_h))[:, None] & (
+            (cols >= 0) & (cols < src_w)
+        )[None, :]
+        table[...] = np.where(valid, idx, nodata)
+        return table
+
+    # general case: project dst pixel centres into the source CRS row by row
+    for r in range(dst_h):
+        y = dst_transform.f + (r + 0.5) * dst_transform.e
+        sx, sy = rasterio.warp.transform(WEB_MERCATOR, src_crs, xs, np.full(dst_w, y))
+        sx = np.asarray(sx)
+        sy = np.asarray(sy)
+        ok = np.isfinite(sx) & np.isfinite(sy)
+        col = np.floor(inv.a * sx + inv.b * sy + inv.c)
+        row = np.floor(inv.d * sx + inv.e * sy + inv.f)
+        ok &= (col >= 0) & (col < src_w) & (row >= 0) & (row < src_h)
+        line = np.full(dst_w, nodata, dtype=np.int64)
+        line[ok] = row[ok].astype(np.int64) * src_w + col[ok].astype(np.int64)
+        table[r] = line
+    return table
+
+
+def remap_table(
+    src_crs, src_transform, src_shape, dst_transform, dst_shape, cache_dir=None
+):
+    """
+    Nearest-neighbour lookup table for warping a source raster onto a
+    destination grid: for every destination pixel the flat index of its
+    source pixel, or ``src_h * src_w`` where the source has no data.
+
+    The table only depends on the two grids, so it is computed once and
+    stored in ``cache_dir`` as ``remap_<hash>.npy``. Later calls memory-map
+    it. The hash covers the source CRS, transform and shape, so replacing a
+    template produces a new table instead of reusing a stale one.
+    """
+    if cache_dir is None:
+        return _compute_remap_table(
+            src_crs, src_transform, src_shape, dst_transform, dst_shape
+        )
+
+    cache_dir = Path(cache_dir)
+    key = _remap_key(src_crs, src_transform, src_shape, dst_transform, dst_shape)
+    path = cache_dir / f"remap_{key}.npy"
+    if path.exists():
+        return np.load(path, mmap_mode="r")
+
+    table = _compute_remap_table(
+        src_crs, src_transform, src_shape, dst_transform, dst_shape
+    )
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, table)
+    os.replace(tmp, path)
+    return np.load(path, mmap_mode="r")
+
+
+def reproject_with_table(src, table):
+    # one gather; the appended zero pixel is what `nodata` indices pick up
+    flat = src.reshape((-1,) + src.shape[2:])
+    padded = np.concatenate([flat, np.zeros((1,) + src.shape[2:], dtype=src.dtype)])
+    return np.take(padded, table, axis=0)
+
+
+def rain_intensity(arr):
+    """
+    uint8 rank of echo strength per pixel, for comparing stations. Radar
+    palettes run blue → green → yellow → red → violet as reflectivity
+    rises, i.e. backwards around the hue circle, so the rank is the hue
+    distance below INTENSITY_HUE_ORIGIN. Single-band rasters already hold
+    levels and are returned as they are.
+    """
+    if arr.ndim == 2:
+        return arr
+    hue = cv2.cvtColor(np.ascontiguousarray(arr[..., :3]), cv2.COLOR_RGB2HSV_FULL)
+    return np.uint8(INTENSITY_HUE_ORIGIN) - hue[..., 0]
+
+
+def rain_levels(arr):
+    """rain_intensity with 0 where there is no echo and at least 1 where there is."""
+    levels = rain_intensity(arr)
+    return np.where(coverage_mask(arr), np.maximum(levels, 1), 0).astype(np.uint8)
+
+
+def station_center(crs, transform, width, height):
+    """EPSG:3857 position of the radar, the centre of its station image."""
+    x, y = transform * (width / 2, height / 2)
+    if crs == WEB_MERCATOR:
+        return x, y
+    xs, ys = rasterio.warp.transform(crs, WEB_MERCATOR, [x], [y])
+    return xs[0], ys[0]
+
+
+def _blend_alpha(view, warped, has_data, weights):
+    # running alpha-weighted mean of the colours drawn so far; the output
+    # alpha is the most opaque input
+    if warped.ndim == 3:
+        alpha = warped[..., -1:].astype(np.float32)
+        colour, prior = warped[..., :-1], view[..., :-1]
+    else:
+        alpha = has_data[..., None].astype(np.float32)
+        colour, prior = warped[..., None], view[..., None]
+    w = weights[..., None]
+    total = w + alpha
+    mean = (prior * w + colour * alpha) / np.maximum(total, 1e-6)
+    np.copyto(prior, np.rint(mean).astype(view.dtype), where=has_data[..., None])
+    if warped.ndim == 3:
+        np.maximum(view[..., -1], warped[..., -1], out=view[..., -1])
+    weights += alpha[..., 0]
+
+
+def mosaic_stations(stations, zoom=None, cache_dir=None, rule="last"):
+    """
+    Warp georeferenced station rasters onto one EPSG:3857 grid.
+
+    ``stations`` is a list of ``(array, crs, transform)`` with HxWxC arrays.
+    ``zoom`` picks the tile-grid resolution of the mosaic; by default the
+    finest station resolution is kept. Each station only touches the
+    window of its own footprint. ``rule`` decides overlaps:
+
+    - ``"last"``: like ``gdalbuildvrt``, later stations are drawn over
+      earlier ones
+    - ``"max"``: the strongest echo wins (see rain_intensity)
+    - ``"nearest"``: the station whose radar is closest wins
+    - ``"alpha"``: colours are averaged, weighted by alpha
+
+    Ties go to the later station.
+
+    Returns ``(mosaic, transform)``.
+    """
+    if not stations:
+        raise ValueError("No stations to mosaic")
+    if rule not in COMPOSITE_RULES:
+        raise ValueError(f"Unknown composite rule '{rule}'")
+
+    footprints = []
+    finest = 0
+    for arr, crs, transform in stations:
+        h, w = arr.shape[:2]
+        fp = footprint_3857(crs, transform, w, h)
+        footprints.append(fp)
+        finest = max(finest, grid_zoom_for((fp[2] - fp[0]) / w))
+    if zoom is None:
+        zoom = finest
+    res = tile_resolution(zoom)
+
+    placed = []
+    for (arr, crs, src_tf), fp in zip(stations, footprints):
+        grid_tf, gw, gh = aligned_grid(fp, zoom)
+        placed.append((arr, crs, src_tf, grid_tf, gw, gh))
+
+    left = min(p[3].c for p in placed)
+    top = max(p[3].f for p in placed)
+    right = max(p[3].c + p[4] * res for p in placed)
+    bottom = min(p[3].f - p[5] * res for p in placed)
+    transform, width, height = aligned_grid((left, bottom, right, top), zoom)
+
+    sample = stations[0][0]
+    mosaic = np.zeros((height, width) + sample.shape[2:], dtype=sample.dtype)
+    if rule == "alpha":
+        weights = np.zeros((height, width), dtype=np.float32)
+    elif rule != "last":
+        # score of the station currently drawn at each pixel
+        score = np.full((height, width), -np.inf, dtype=np.float32)
+    for arr, crs, src_tf, grid_tf, gw, gh in placed:
+        table = remap_table(crs, src_tf, arr.shape[:2], grid_tf, (gh, gw), cache_dir)
+        warped = reproject_with_table(arr, table)
+        col = round((grid_tf.c - transform.c) / res)
+        row = round((transform.f - grid_tf.f) / res)
+        window = (slice(row, row + gh), slice(col, col + gw))
+        view = mosaic[window]
+        has_data = coverage_mask(warped)
+        if rule == "alpha":
+            _blend_alpha(view, warped, has_data, weights[window])
+            continue
+        if rule == "max":
+            candidate = rain_intensity(warped).astype(np.float32)
+        elif rule == "nearest":
+            cx, cy = station_center(crs, src_tf, arr.shape[1], arr.shape[0])
+            dx = grid_tf.c + (np.arange(gw, dtype=np.float32) + 0.5) * res - cx
+            dy = grid_tf.f - (np.arange(gh, dtype=np.float32) + 0.5) * res - cy
+            candidate = -(dy[:, None] ** 2 + dx[None, :] ** 2)
+        if rule != "last":
+            has_data &= candidate >= score[window]
+            np.copyto(score[window], candidate, where=has_data)
+        np.copyto(
+            view, warped, where=has_data[..., None] if warped.ndim == 3 else has_data
+        )
+
+    return mosaic, transform
+
+
 # ---------------- Main ----------------
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--template_tif", required=True)
-    ap.add_argument("--input_png", required=True)
+    ap.add_argument("--template_tif")
+    ap.add_argument("--input_png")
     ap.add_argument("--workdir", default="work")
 
     ap.add_argument("--h_low", type=int, default=25)
@@ -237,68 +1158,136 @@ def main():
     ap.add_argument("--red_high", type=int, default=15)
     ap.add_argument("--disk_shrink", type=float, default=0.96)
     ap.add_argument("--left_crop_frac", type=float, default=0.18)
+    ap.add_argument(
+        "--style",
+        default="echoes",
+        choices=["echoes", "heatmap"],
+        help="Gap-repaired radar colours, or a soft colour-ramp heatmap",
+    )
 
     # tiling params
     ap.add_argument("--zmin", type=int, default=5)
     ap.add_argument("--zmax", type=int, default=11)
     ap.add_argument("--skip_tiles", action="store_true")
+    ap.add_argument(
+        "--mosaic_tif",
+        help="Tile an EPSG:3857 RGBA mosaic instead of processing a station",
+    )
+    ap.add_argument(
+        "--georef_tifs",
+        nargs="+",
+        help="Mosaic georeferenced station TIFFs and tile them",
+    )
+    ap.add_argument(
+        "--composite",
+        default="last",
+        choices=COMPOSITE_RULES,
+        help="Where stations overlap: later on top, strongest echo, nearest "
+        "radar, or alpha-weighted mean",
+    )
+    ap.add_argument("--cache_dir", default="cache", help="Remap table cache")
+    ap.add_argument("--tiles_dir", default=None)
+    ap.add_argument(
+        "--previous_tiles",
+        default=None,
+        help="Previous tile set; unchanged tiles are hard-linked from it",
+    )
+    ap.add_argument("--resampling", default="near", choices=["near", "average"])
+    ap.add_argument(
+        "--tile_format",
+        default="dir",
+        choices=["dir", "pack", "cog"],
+        help="One PNG per tile, a single tiles.pack archive, or a COG the web "
+        "service renders tiles from on request",
+    )
+    ap.add_argument(
+        "--webp", action="store_true", help="Also write lossless WebP tiles"
+    )
+    ap.add_argument("--workers", type=int, default=None)
+    ap.add_argument(
+        "--debug_dump",
+        "--debug-dump",
+        action="store_true",
+        help="Also write the intermediate images (masked, smoothed) to --workdir",
+    )
 
     args = ap.parse_args()
 
-    which_or_die("gdalwarp")
-    which_or_die("gdal2tiles.py")
-    which_or_die("gdal_translate")
+    if args.mosaic_tif or args.georef_tifs:
+        tiles_dir = Path(args.tiles_dir or Path(args.workdir) / "tiles")
+        if args.georef_tifs:
+            stations = [read_raster(p) for p in args.georef_tifs]
+            mosaic, transform = mosaic_stations(
+                stations, cache_dir=args.cache_dir, rule=args.composite
+            )
+            print(
+                f"[OK] Mosaic {mosaic.shape[1]}x{mosaic.shape[0]} from {len(stations)} stations"
+            )
+        else:
+            mosaic, _, transform = read_raster(args.mosaic_tif)
+        tiles = build_tile_pyramid(
+            mosaic,
+            transform,
+            tiles_dir,
+            zmin=args.zmin,
+            zmax=args.zmax,
+            resampling=args.resampling,
+            workers=args.workers,
+            previous_dir=args.previous_tiles,
+            tile_format=args.tile_format,
+            encodings=("png", "webp") if args.webp else ("png",),
+        )
+        print(f"[DONE] {len(tiles)} tiles at: {tiles_dir}")
+        return
+
+    if not args.template_tif or not args.input_png:
+        ap.error("--template_tif and --input_png are required")
 
     work = Path(args.workdir)
     work.mkdir(parents=True, exist_ok=True)
 
-    masked_png = work / "rain_only.png"
-    masked_heatmap_png = work / "rain_only_smooth.png"
     georef_tif = work / "rain_only_georef.tif"
     webm_tif = work / "rain_only_3857.tif"
     webm_rgba_tif = work / "rain_only_3857_rgba.tif"
     tiles_dir = work / "tiles"
 
-    # 1) Mask
-    mask_rain_from_png(
+    # 1) Mask → gap repair / heatmap → georeference, in memory
+    rgba, crs, transform = render_station(
         args.input_png,
-        str(masked_png),
-        h_low=args.h_low,
-        h_high=args.h_high,
-        s_min=args.s_min,
-        v_min=args.v_min,
-        include_red=args.include_red,
-        red_low=args.red_low,
-        red_high=args.red_high,
-        disk_shrink=args.disk_shrink,
-        left_crop_frac=args.left_crop_frac,
-    )
-    print(f"[OK] Masked PNG → {masked_png}")
-
-    # create_radar_heatmap(
-    #     input_path=masked_png,
-    #     smooth_px=8,
-    #     gamma=0.85,
-    #     low_cut=0.15,
-    #     feather=0.12,
-    #     use_green_only=False,
-    # )
-
-    out = fix_radar_gaps(
-        img_bgra=cv2.imread(str(masked_png), cv2.IMREAD_UNCHANGED),
-        nonblack_threshold=5,
-        neighbor_kernel_size=3,
-        min_neighbors=3,
-        disk_dilate=31,
-        inpaint_radius=3,
-    )
-
-    cv2.imwrite(str(masked_heatmap_png), out)
-
-    copy_georef_from_template(
-        args.template_tif, str(masked_heatmap_png), str(georef_tif)
+        args.template_tif,
+        mask=dict(
+            h_low=args.h_low,
+            h_high=args.h_high,
+            s_min=args.s_min,
+            v_min=args.v_min,
+            include_red=args.include_red,
+            red_low=args.red_low,
+            red_high=args.red_high,
+            disk_shrink=args.disk_shrink,
+            left_crop_frac=args.left_crop_frac,
+        ),
+        gaps=dict(
+            nonblack_threshold=5,
+            neighbor_kernel_size=3,
+            min_neighbors=3,
+            disk_dilate=31,
+            inpaint_radius=3,
+            roi=True,
+        ),
+        style=args.style,
+        heatmap=dict(
+            smooth_px=8,
+            gamma=0.85,
+            low_cut=0.15,
+            feather=0.12,
+            use_green_only=False,
+        ),
+        cache_dir=args.cache_dir,
+        dump_dir=work if args.debug_dump else None,
     )
-    # print(f"[OK] Georeferenced TIFF → {georef_tif}")
+    if not args.debug_dump:
+        write_georef(georef_tif, rgba, crs, transform)
+    print(f"[OK] Georeferenced TIFF → {georef_tif}")
 
     # if args.skip_tiles:
     #     return
@@ -0,0 +1,211 @@
+import json
+import math
+import os
+import threading
+
+import numpy as np
+
+# Coarse per-frame rain grid for point and area queries. Next to its tiles
+# every frame holds grid.npy, the uint8 rain level of the mosaic (0 = no
+# echo, higher = stronger) max-pooled onto the EPSG:3857 pixel grid of
+# GRID_ZOOM, and grid.json with the grid's zoom and its origin in that
+# zoom's global pixel coordinates. Grids of all frames therefore share pixel
+# edges and the web service stacks them into one (frames, rows, cols) array.
+GRID_NAME = "grid.npy"
+GRID_META = "grid.json"
+# ~1.2 km pixels at the equator, ~1.1 km over Thailand
+GRID_ZOOM = 7
+TILE_SIZE = 256
+ORIGIN_SHIFT = math.pi * 6378137.0
+
+
+def resolution(zoom):
+    return 2 * ORIGIN_SHIFT / (TILE_SIZE * 2**zoom)
+
+
+def downsample(levels, transform, zoom=GRID_ZOOM):
+    """
+    ``(grid, zoom, col, row)`` of an HxW level array on a tile-aligned
+    EPSG:3857 grid: every grid pixel holds the strongest level of the
+    pixels it covers. Grids finer than ``zoom`` are pooled onto ``zoom``.
+    """
+    res = transform.a
+    src_zoom = round(math.log2(2 * ORIGIN_SHIFT / (TILE_SIZE * res)))
+    zoom = min(zoom, src_zoom)
+    f = 2 ** (src_zoom - zoom)
+    col = round((transform.c + ORIGIN_SHIFT) / res)
+    row = round((ORIGIN_SHIFT - transform.f) / res)
+    # pad at the top left so the blocks line up with the coarse pixels
+    pc, pr = col % f, row % f
+    h, w = levels.shape
+    gh, gw = -(-(h + pr) // f), -(-(w + pc) // f)
+    padded = np.zeros((gh * f, gw * f), dtype=np.uint8)
+    padded[pr : pr + h, pc : pc + w] = levels
+    grid = padded.reshape(gh, f, gw, f).max(axis=(1, 3))
+    return grid, zoom, col // f, row // f
+
+
+def write_grid(frame_dir, levels, transform, zoom=GRID_ZOOM):
+    """Downsample ``levels`` and write the frame's grid.npy and grid.json."""
+    grid, zoom, col, row = downsample(levels, transform, zoom)
+    tmp = os.path.join(frame_dir, f"{GRID_NAME}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, grid)
+    os.replace(tmp, os.path.join(frame_dir, GRID_NAME))
+    with open(os.path.join(frame_dir, GRID_META), "w", encoding="utf-8") as f:
+        json.dump({"zoom": zoom, "col": col, "row": row}, f)
+    return grid
+
+
+def read_grid(frame_dir):
+    """``(grid, zoom, col, row)`` of a frame, or None if it has no grid."""
+    try:
+        with open(os.path.join(frame_dir, GRID_META), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        grid = np.load(os.path.join(frame_dir, GRID_NAME), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    return grid, meta["zoom"], meta["col"], meta["row"]
+
+
+def lonlat_to_pixel(lon, lat, zoom):
+    """Global pixel (col, row) of ``zoom`` containing WGS84 lon/lat."""
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.0511, 85.0511)
+    x = lon * ORIGIN_SHIFT / 180.0
+    y = np.log(np.tan((90.0 + lat) * math.pi / 360.0)) * ORIGIN_SHIFT / math.pi
+    res = resolution(zoom)
+    col = np.floor((x + ORIGIN_SHIFT) / res).astype(np.int64)
+    row = np.floor((ORIGIN_SHIFT - y) / res).astype(np.int64)
+    return col, row
+
+
+class GridStack:
+    """
+    Grids of the listed frames stacked into one (frames, rows, cols) uint8
+    array over the union of their extents, oldest frame first. ``update``
+    loads new frames and drops unlisted ones; queries read a snapshot, so
+    they never wait for an update. With ``mmap_path`` the stack lives in a
+    memory-mapped .npy file instead of the heap.
+    """
+
+    def __init__(self, radar_dir, mmap_path=None, zoom=GRID_ZOOM):
+        self.radar_dir = radar_dir
+        self.mmap_path = mmap_path
+        self.zoom = zoom
+        self._lock = threading.Lock()
+        # the listed times the stack was built for; the same list object
+        # is handed back by the manifest cache while nothing changes
+        self._source = None
+        self._listed = []
+        # (times, stack, col0, row0)
+        self._state = (np.zeros(0, dtype=np.int64), np.zeros((0, 0, 0), np.uint8), 0, 0)
+
+    def _allocate(self, shape):
+        if self.mmap_path is None:
+            return np.zeros(shape, dtype=np.uint8)
+        # a fresh file each time: queries may still hold the previous map
+        tmp = f"{self.mmap_path}.{os.getpid()}.tmp"
+        stack = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.uint8, shape=shape)
+        os.replace(tmp, self.mmap_path)
+        return stack
+
+    def update(self, times):
+        """Stack the grids of frames ``times``; frames without one are left out."""
+        if times is self._source:
+            return self
+        with self._lock:
+            if times is self._source or list(times) == self._listed:
+                self._source = times
+                return self
+            old_times, old, old_col, old_row = self._state
+            index = {t: i for i, t in enumerate(old_times.tolist())}
+            grids = {}
+            for t in times:
+                if t in index:
+                    continue
+                loaded = read_grid(os.path.join(self.radar_dir, str(t)))
+                if loaded is not None and loaded[1] == self.zoom:
+                    grids[t] = loaded
+            keep = sorted(t for t in set(times) if t in index or t in grids)
+
+            boxes = [
+                (c, r, c + g.shape[1], r + g.shape[0]) for g, _, c, r in grids.values()
+            ]
+            if any(t in index for t in keep):
+                boxes.append(
+                    (old_col, old_row, old_col + old.shape[2], old_row + old.shape[1])
+                )
+            if boxes:
+                col0 = min(b[0] for b in boxes)
+                row0 = min(b[1] for b in boxes)
+                width = max(b[2] for b in boxes) - col0
+                height = max(b[3] for b in boxes) - row0
+            else:
+                col0 = row0 = width = height = 0
+
+            stack = self._allocate((len(keep), height, width))
+            kept = [(i, index[t]) for i, t in enumerate(keep) if t in index]
+            if kept:
+                dst, src = (list(v) for v in zip(*kept))
+                r, c = old_row - row0, old_col - col0
+                stack[dst, r : r + old.shape[1], c : c + old.shape[2]] = old[src]
+            for i, t in enumerate(keep):
+                if t in grids:
+                    grid, _, c, r = grids[t]
+                    r, c = r - row0, c - col0
+                    stack[i, r : r + grid.shape[0], c : c + grid.shape[1]] = grid
+
+            self._state = (np.array(keep, dtype=np.int64), stack, col0, row0)
+            self._source = times
+            self._listed = list(times)
+        return self
+
+    def _frames(self, times, start, end):
+        lo = 0 if start is None else np.searchsorted(times, start, "left")
+        hi = len(times) if end is None else np.searchsorted(times, end, "right")
+        return slice(lo, hi)
+
+    def point(self, lon, lat, start=None, end=None):
+        """``(times, levels)`` of the grid pixel containing lon/lat."""
+        times, stack, col0, row0 = self._state
+        frames = self._frames(times, start, end)
+        col, row = lonlat_to_pixel(lon, lat, self.zoom)
+        c, r = int(col) - col0, int(row) - row0
+        if not (0 <= r < stack.shape[1] and 0 <= c < stack.shape[2]):
+            return times[frames], np.zeros(len(times[frames]), dtype=np.uint8)
+        return times[frames], stack[frames, r, c]
+
+    def area(self, west, south, east, north, start=None, end=None):
+        """
+        ``(times, stats)`` over the grid pixels of a lon/lat box: per frame
+        the strongest level, the mean level of the pixels with rain and the
+        share of pixels with rain. ``cells`` counts the pixels the stack
+        covers.
+        """
+        times, stack, col0, row0 = self._state
+        frames = self._frames(times, start, end)
+        cols, rows = lonlat_to_pixel([west, east], [north, south], self.zoom)
+        c0 = max(int(cols[0]) - col0, 0)
+        r0 = max(int(rows[0]) - row0, 0)
+        c1 = min(int(cols[1]) - col0 + 1, stack.shape[2])
+        r1 = min(int(rows[1]) - row0 + 1, stack.shape[1])
+        n = len(times[frames])
+        if c1 <= c0 or r1 <= r0 or n == 0:
+            # outside the stack, or no frames in the time range
+            zeros = np.zeros(n)
+            return times[frames], {
+                "max": zeros.astype(np.uint8),
+                "mean": zeros,
+                "coverage": zeros,
+                "cells": max(c1 - c0, 0) * max(r1 - r0, 0),
+            }
+        window = stack[frames, r0:r1, c0:c1].reshape(n, -1)
+        wet = np.count_nonzero(window, axis=1)
+        total = window.sum(axis=1, dtype=np.int64)
+        return times[frames], {
+            "max": window.max(axis=1),
+            "mean": total / np.maximum(wet, 1),
+            "coverage": wet / window.shape[1],
+            "cells": window.shape[1],
+        }
@@ -0,0 +1,106 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch
+
+BODY = b"\x89PNG station image" * 100
+
+
+class Handler(BaseHTTPRequestHandler):
+    # per-path request counts, reset by the server fixture
+    hits = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        hits = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.path == "/image":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_body(BODY, ETag='"v1"')
+        elif self.path == "/flaky":
+            if hits <= 2:
+                self.send_error(503)
+                return
+            self.send_body(BODY)
+        elif self.path == "/stall":
+            # headers arrive late, then the body stops halfway
+            self.server.release.wait(0.6)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY[:100])
+            self.wfile.flush()
+            self.server.release.wait(5)
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, **headers):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    Handler.hits = {}
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.release = threading.Event()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.release.set()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_not_modified_reads_the_cached_copy(server, tmp_path):
+    first = fetch.fetch(f"{server}/image", tmp_path)
+    assert first["status"] == 200 and first["data"] == BODY
+    assert fetch.read_validators(tmp_path, f"{server}/image")["etag"] == '"v1"'
+
+    second = fetch.fetch(f"{server}/image", tmp_path)
+    assert second["status"] == 304
+    assert second["data"] == BODY
+    assert Handler.hits["/image"] == 2
+
+
+def test_server_errors_are_retried_with_backoff(server, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(fetch.time, "sleep", sleeps.append)
+    result = fetch.fetch(f"{server}/flaky", retries=2, backoff=0.5)
+    assert result["status"] == 200 and result["data"] == BODY
+    assert result["attempts"] == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_server_errors_give_up_after_the_retries(server, monkeypatch):
+    monkeypatch.setattr(fetch.time, "sleep", lambda s: None)
+    with pytest.raises(fetch.urllib.error.HTTPError) as e:
+        fetch.fetch(f"{server}/flaky", retries=1)
+    assert e.value.code == 503
+    assert Handler.hits["/flaky"] == 2
+
+
+def test_client_errors_are_not_retried(server):
+    with pytest.raises(fetch.urllib.error.HTTPError):
+        fetch.fetch(f"{server}/missing", retries=2)
+    assert Handler.hits["/missing"] == 1
+
+
+def test_stalled_body_times_out_at_the_deadline(server):
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        fetch.fetch(f"{server}/stall", timeout=1.0, retries=0)
+    # the read after the late headers only gets the time that is left
+    assert time.monotonic() - started < 1.4
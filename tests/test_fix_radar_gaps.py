@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import radar_process as rp
+
+# fix_radar_gaps(roi=True) must match the full-frame path pixel for pixel
+COLORS = [(0, 170, 0), (0, 229, 0), (0, 247, 247), (0, 200, 255), (0, 0, 241)]
+PARAMS = [
+    {},
+    {"nonblack_threshold": 5, "neighbor_kernel_size": 3, "min_neighbors": 3},
+    {"disk_dilate": 15, "inpaint_radius": 5, "feather_px": 3, "antialias_sigma": 1.5},
+]
+
+
+def synthetic_frame(seed, h=240, w=320, levels=False):
+    """Random echo blobs, some overrunning the frame edges, with speckle gaps."""
+    rng = np.random.default_rng(seed)
+    frame = np.zeros((h, w) if levels else (h, w, 4), dtype=np.uint8)
+    yy, xx = np.ogrid[:h, :w]
+    # one blob in a corner and one along an edge every time
+    centres = [(0, 0), (rng.integers(h), w - 1)]
+    centres += [
+        (rng.integers(-30, h + 30), rng.integers(-30, w + 30))
+        for _ in range(rng.integers(0, 6))
+    ]
+    for cy, cx in centres:
+        r = rng.integers(4, 60)
+        blob = (yy - cy) ** 2 + (xx - cx) ** 2 <= r * r
+        if levels:
+            frame[blob] = rng.integers(1, 22)
+        else:
+            frame[blob] = (*COLORS[rng.integers(len(COLORS))], 255)
+    frame[rng.random((h, w)) < rng.uniform(0.0, 0.15)] = 0
+    return frame
+
+
+@pytest.mark.parametrize("levels", [False, True], ids=["bgra", "levels"])
+@pytest.mark.parametrize("params", PARAMS, ids=["default", "pipeline", "wide"])
+@pytest.mark.parametrize("seed", range(12))
+def test_roi_matches_full_frame(seed, params, levels):
+    frame = synthetic_frame(seed, levels=levels)
+    full = rp.fix_radar_gaps(frame, roi=False, **params)
+    roi = rp.fix_radar_gaps(frame, roi=True, **params)
+    assert roi.dtype == full.dtype
+    np.testing.assert_array_equal(roi, full)
+
+
+@pytest.mark.parametrize("levels", [False, True], ids=["bgra", "levels"])
+def test_roi_without_echoes(levels):
+    frame = synthetic_frame(0, levels=levels) * 0
+    np.testing.assert_array_equal(
+        rp.fix_radar_gaps(frame, roi=True), rp.fix_radar_gaps(frame, roi=False)
+    )
+
+
+def test_gaps_are_filled():
+    frame = np.zeros((64, 64, 4), dtype=np.uint8)
+    frame[16:48, 16:48] = (0, 229, 0, 255)
+    frame[32, 32] = 0
+    out = rp.fix_radar_gaps(frame, roi=True)
+    assert out[32, 32, 3] == 255
+    # TELEA rounds the inpainted colour
+    np.testing.assert_allclose(out[32, 32, :3], (0, 229, 0), atol=1)
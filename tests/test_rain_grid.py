@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from rasterio.transform import Affine
+
+import rain_grid
+
+TIMES = [1_760_000_000, 1_760_000_600]
+LON, LAT = 100.5, 13.75
+
+
+@pytest.fixture
+def stack(tmp_path):
+    """A GridStack of two frames around LON/LAT: dry, then raining there."""
+    col, row = (int(v) - 32 for v in rain_grid.lonlat_to_pixel(LON, LAT, 7))
+    res = rain_grid.resolution(7)
+    transform = Affine(
+        res,
+        0,
+        col * res - rain_grid.ORIGIN_SHIFT,
+        0,
+        -res,
+        rain_grid.ORIGIN_SHIFT - row * res,
+    )
+    for i, t in enumerate(TIMES):
+        levels = np.zeros((64, 64), dtype=np.uint8)
+        levels[24:40, 24:40] = 10 * i
+        levels[32, 32] = 20 * i
+        frame_dir = tmp_path / str(t)
+        frame_dir.mkdir()
+        rain_grid.write_grid(str(frame_dir), levels, transform)
+    return rain_grid.GridStack(str(tmp_path)).update(TIMES)
+
+
+def test_point(stack):
+    times, levels = stack.point(LON, LAT)
+    assert times.tolist() == TIMES
+    assert levels.tolist() == [0, 20]
+
+
+def test_point_outside_the_stack(stack):
+    times, levels = stack.point(0.0, 0.0)
+    assert times.tolist() == TIMES
+    assert levels.tolist() == [0, 0]
+
+
+def test_area(stack):
+    times, stats = stack.area(LON - 0.5, LAT - 0.5, LON + 0.5, LAT + 0.5)
+    assert times.tolist() == TIMES
+    assert stats["cells"] > 0
+    assert stats["max"].tolist() == [0, 20]
+    assert stats["coverage"][0] == 0 and 0 < stats["coverage"][1] < 1
+    assert 10 < stats["mean"][1] < 20
+
+
+def test_area_outside_the_stack(stack):
+    times, stats = stack.area(0.0, 0.0, 1.0, 1.0)
+    assert times.tolist() == TIMES
+    assert stats["cells"] == 0
+    assert stats["max"].tolist() == [0, 0]
+
+
+@pytest.mark.parametrize("start, end", [(9_999_999_999, None), (None, 0)])
+def test_empty_time_range(stack, start, end):
+    times, levels = stack.point(LON, LAT, start, end)
+    assert len(times) == 0 and len(levels) == 0
+    times, stats = stack.area(LON - 0.5, LAT - 0.5, LON + 0.5, LAT + 0.5, start, end)
+    assert len(times) == 0
+    assert stats["cells"] > 0
+    assert len(stats["max"]) == len(stats["mean"]) == len(stats["coverage"]) == 0
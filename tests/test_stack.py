@@ -0,0 +1,91 @@
+import io
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import frames
+import main
+import tile_codec
+
+START = 1_760_000_000
+STEP = 600
+
+
+@pytest.fixture
+def radar(tmp_path, monkeypatch):
+    """A radar directory of published frames, each with tile 7/101/60."""
+    tile = np.zeros((256, 256, 4), dtype=np.uint8)
+    tile[64:192, 64:192] = (0, 229, 0, 255)
+    png = tile_codec.encode(tile)
+
+    def publish(count):
+        entries = []
+        for i in range(count):
+            t = START + i * STEP
+            tile_dir = tmp_path / str(t) / "7" / "101"
+            tile_dir.mkdir(parents=True)
+            (tile_dir / "60.png").write_bytes(png)
+            (tmp_path / str(t) / main.FRAME_INDEX).write_text("{}")
+            entries.append({"time": t, "format": "dir", "zmin": 7, "zmax": 7})
+        frames.add_frames(tmp_path, entries)
+
+    monkeypatch.setattr(main, "RADAR_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "manifest_cache", frames.ManifestCache(str(tmp_path)))
+    for name in ("tile_cache", "stack_cache", "synth_cache"):
+        monkeypatch.setattr(main, name, main.TileCache(1 << 26))
+    return publish
+
+
+def get_stack(ext, **params):
+    query = "&".join(f"{k}={v}" for k, v in {"start": 0, **params}.items())
+    return TestClient(main.app).get(
+        f"/api/v1/stack/7/101/60.{ext}?{query}",
+        headers={"Accept": "image/webp,image/png"},
+    )
+
+
+def test_negative_limit_is_rejected(radar):
+    radar(main.STACK_MAX_FRAMES + 8)
+    assert get_stack("bin", limit=-1).status_code == 422
+
+
+def test_frame_count_is_capped(radar):
+    radar(main.STACK_MAX_FRAMES + 8)
+    for params in ({}, {"limit": main.STACK_MAX_FRAMES + 8}):
+        response = get_stack("bin", **params)
+        times = response.headers["X-Radar-Frames"].split(",")
+        assert len(times) == main.STACK_MAX_FRAMES
+        # the most recent frames
+        assert int(times[-1]) == START + (main.STACK_MAX_FRAMES + 7) * STEP
+
+
+def test_limit_above_the_frame_count_keeps_every_frame(radar):
+    radar(40)
+    response = get_stack("bin", limit=50)
+    assert len(response.headers["X-Radar-Frames"].split(",")) == 40
+
+
+def test_tall_sprite_falls_back_to_png(radar):
+    count = tile_codec.WEBP_MAX_SIZE // 256 + 1
+    radar(count)
+    response = get_stack("png")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    sheet = Image.open(io.BytesIO(response.content))
+    assert sheet.size == (256, 256 * count)
+
+
+def test_short_sprite_is_webp(radar):
+    radar(3)
+    response = get_stack("png")
+    assert response.headers["content-type"] == "image/webp"
+    assert Image.open(io.BytesIO(response.content)).size == (256, 768)
+
+
+def test_sprite_without_frames(radar):
+    radar(3)
+    response = get_stack("png", start=9_999_999_999)
+    assert response.status_code == 204
+    assert response.headers["X-Radar-Frames"] == ""
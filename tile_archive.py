@@ -0,0 +1,105 @@
+import hashlib
+import mmap
+import os
+import struct
+
+# One file per frame holding every tile of the pyramid:
+#
+#   header  magic, tile count
+#   index   count entries sorted by (z, x, y):
+#           z, x, y (TMS), blob offset, blob length, blake2b-128 of the blob
+#   blobs   encoded tiles; identical tiles share one blob
+#
+# The pipeline writes it in one sequential pass; the tile server memory-maps
+# it and hands out slices of the mapping.
+ARCHIVE_NAME = "tiles.pack"
+MAGIC = b"OTRPACK1"
+HEADER = struct.Struct("<8sI")
+ENTRY = struct.Struct("<IIIQI16s")
+
+
+def tile_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def write_archive(path, tiles):
+    """
+    Write ``{(z, x, y): encoded tile bytes}`` to ``path``. The file is
+    written next to its final name and renamed into place, so readers never
+    see a partial archive.
+    """
+    items = sorted(tiles.items())
+    offset = HEADER.size + ENTRY.size * len(items)
+    entries = []
+    blobs = []
+    offsets = {}
+    for (z, x, y), data in items:
+        digest = tile_hash(data)
+        if digest not in offsets:
+            offsets[digest] = offset
+            blobs.append(data)
+            offset += len(data)
+        entries.append(ENTRY.pack(z, x, y, offsets[digest], len(data), digest))
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(items)))
+        f.write(b"".join(entries))
+        for data in blobs:
+            f.write(data)
+    os.replace(tmp, path)
+    return path
+
+
+class TileArchive:
+    """Read-only, memory-mapped view of a tile archive."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a tile archive")
+        self._view = memoryview(self._mmap)
+        end = HEADER.size + ENTRY.size * count
+        self._index = {
+            (z, x, y): (offset, length, digest)
+            for z, x, y, offset, length, digest in ENTRY.iter_unpack(
+                self._view[HEADER.size : end]
+            )
+        }
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, z, x, y):
+        """Tile bytes as a zero-copy memoryview, or None if absent."""
+        entry = self._index.get((z, x, y))
+        if entry is None:
+            return None
+        offset, length, _ = entry
+        return self._view[offset : offset + length]
+
+    def digest(self, z, x, y):
+        entry = self._index.get((z, x, y))
+        return entry[2] if entry is not None else None
+
+
+def archive_name(encoding="png"):
+    # PNG tiles keep the original name; other encodings get their own archive
+    return ARCHIVE_NAME if encoding == "png" else f"tiles.{encoding}.pack"
+
+
+def open_archive(frame_dir, encoding="png"):
+    """TileArchive of a frame directory, or None if it has no archive."""
+    path = os.path.join(frame_dir, archive_name(encoding))
+    if not os.path.exists(path):
+        return None
+    return TileArchive(path)
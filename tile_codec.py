@@ -0,0 +1,176 @@
+import io
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# Tile encodings. Radar tiles hold a few dozen colours at most, so PNGs are
+# written as 8-bit palette images with the alpha of each palette entry in a
+# tRNS chunk; tiles with more than 256 colours (heatmaps) fall back to RGBA.
+# Lossless WebP is the optional second encoding, smaller again for clients
+# that accept it. Single-band tiles of legend levels are colourized with a
+# palette (see palettes.py) here: PNGs keep the levels as palette indices,
+# so a tile's colours can be swapped by rewriting its PLTE and tRNS chunks.
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp"}
+PNG_COMPRESS_LEVEL = 6
+# libwebp lossless effort: method 0-6 and quality 0-100. Past method 1 the
+# files barely shrink while encoding gets several times slower.
+WEBP_METHOD = 1
+WEBP_QUALITY = 0
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# largest width or height of a WebP image
+WEBP_MAX_SIZE = 16383
+
+
+def _prepare(tile):
+    # invisible pixels all become 0,0,0,0: their colour never shows and
+    # collapsing them keeps the palette small and the encoders' runs long
+    tile = np.ascontiguousarray(tile)
+    if tile.ndim == 3 and tile.shape[2] == 4:
+        # alpha is the high byte of a little-endian RGBA word
+        words = tile.view("<u4")
+        tile = np.where(words >= 1 << 24, words, 0).view(np.uint8)
+    return tile
+
+
+def quantize(tile):
+    """
+    ``(indices, palette)`` of an RGBA tile with at most 256 distinct
+    colours: HxW uint8 indices into an Nx4 RGBA palette. None when the tile
+    has more colours.
+    """
+    words = np.ascontiguousarray(tile).view("<u4")[..., 0]
+    colors = np.unique(words)
+    if len(colors) > 256:
+        return None
+    indices = np.searchsorted(colors, words).astype(np.uint8)
+    return indices, colors.view(np.uint8).reshape(-1, 4)
+
+
+def encode_png(tile, palette=None):
+    """
+    PNG of an RGBA (or single-band) tile; palette + tRNS where possible. A
+    single-band tile with a ``palette`` (Nx4 RGBA) becomes a palette image
+    of its own values.
+    """
+    tile = _prepare(tile)
+    if tile.ndim == 2 and palette is not None:
+        img = Image.fromarray(tile, "P")
+        img.putpalette(palette[:, :3].tobytes(), "RGB")
+        img.info["transparency"] = palette[:, 3].tobytes()
+    elif tile.ndim == 2:
+        img = Image.fromarray(tile, "L")
+    else:
+        quantized = quantize(tile)
+        if quantized is None:
+            img = Image.fromarray(tile, "RGBA")
+        else:
+            indices, palette = quantized
+            img = Image.fromarray(indices, "P")
+            img.putpalette(palette[:, :3].tobytes(), "RGB")
+            if palette[:, 3].min() < 255:
+                img.info["transparency"] = palette[:, 3].tobytes()
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+def encode_webp(tile, palette=None):
+    """Lossless WebP of an RGBA (or single-band) tile."""
+    if tile.ndim == 2 and palette is not None:
+        tile = palette[tile]
+    tile = _prepare(tile)
+    img = Image.fromarray(tile, "L" if tile.ndim == 2 else "RGBA")
+    buf = io.BytesIO()
+    img.save(
+        buf, format="WEBP", lossless=True, method=WEBP_METHOD, quality=WEBP_QUALITY
+    )
+    return buf.getvalue()
+
+
+ENCODERS = {"png": encode_png, "webp": encode_webp}
+
+
+def encode(tile, encoding="png", palette=None):
+    if not tile.size:
+        # neither format has a 0 px image
+        raise ValueError(f"cannot encode an empty {tile.shape} tile")
+    return ENCODERS[encoding](tile, palette)
+
+
+def _chunks(png):
+    # (kind, data, raw chunk bytes) of every chunk after the signature
+    pos = len(PNG_SIGNATURE)
+    while pos < len(png):
+        length, kind = struct.unpack(">I4s", png[pos : pos + 8])
+        end = pos + 12 + length
+        yield kind, png[pos + 8 : end - 4], png[pos:end]
+        pos = end
+
+
+def _chunk(kind, data):
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def _is_palette_png(png):
+    return png[:8] == PNG_SIGNATURE and png[25:26] == b"\x03"
+
+
+def png_palette(png):
+    """Nx4 RGBA palette of a palette PNG from its PLTE and tRNS, else None."""
+    if not _is_palette_png(png):
+        return None
+    palette = None
+    for kind, data, _ in _chunks(png):
+        if kind == b"PLTE":
+            palette = np.full((len(data) // 3, 4), 255, dtype=np.uint8)
+            palette[:, :3] = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        elif kind == b"tRNS" and palette is not None:
+            alpha = np.frombuffer(data, dtype=np.uint8)[: len(palette)]
+            palette[: len(alpha), 3] = alpha
+        elif kind == b"IDAT":
+            break
+    return palette
+
+
+def swap_palette(png, palette):
+    """
+    ``png`` with its PLTE and tRNS chunks replaced by ``palette`` (Nx4
+    RGBA), without decoding the pixels. None unless it is a palette PNG with
+    at most N entries and room for N at its bit depth.
+    """
+    if not _is_palette_png(png) or len(palette) > 1 << png[24]:
+        return None
+    parts = [PNG_SIGNATURE]
+    for kind, data, raw in _chunks(png):
+        if kind == b"PLTE":
+            if len(data) // 3 > len(palette):
+                return None
+            parts.append(_chunk(b"PLTE", palette[:, :3].tobytes()))
+            parts.append(_chunk(b"tRNS", palette[:, 3].tobytes()))
+        elif kind != b"tRNS":
+            parts.append(raw)
+    return b"".join(parts)
+
+
+def accepts(accept_header, encoding):
+    """True if an ``Accept`` header lists the encoding's media type."""
+    if not accept_header:
+        return False
+    media_type = MEDIA_TYPES[encoding]
+    for part in accept_header.split(","):
+        fields = [f.strip() for f in part.split(";")]
+        if fields[0] != media_type:
+            continue
+        q = [f for f in fields[1:] if f.startswith("q=")]
+        try:
+            return not q or float(q[0][2:]) > 0
+        except ValueError:
+            return False
+    return False